@@ -0,0 +1,204 @@
+"""
+This module implements an asyncio counterpart of the BlobService based on aiohttp.
+"""
+import asyncio
+import mimetypes
+import xml.etree.ElementTree as etree
+from azurepython3.blobservice import Blob, BlobPrefix, BlobService, _cors_request, _sanitize_blobname
+from azurepython3.service import BaseService
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+
+
+class AsyncBlobService(BaseService):
+    """
+    Offers the essential BlobService operations as coroutines. Requests share a pool of keep-alive connections
+    and a semaphore limits the number of requests in flight, so that a single event loop can run thousands of
+    blob operations concurrently. Errors are raised as aiohttp.ClientResponseError.
+
+    Requests are sent with aiohttp rather than a requests session, so they are neither retried nor instrumented
+    or scheduled.
+
+        async with AsyncBlobService("myaccountname", "myaccountkey") as svc:
+            await asyncio.gather(*[svc.create_blob('container', name, data) for name in names])
+    """
+
+    # maximum number of pooled connections to the storage account
+    pool_size = 100
+    # maximum number of requests in flight at the same time, further requests wait for a free slot
+    max_concurrency = 1000
+
+    def __init__(self, account_name, account_key, pool_size = None, keep_alive = None, max_concurrency = None,
+                 endpoint = None):
+        if aiohttp is None:
+            raise ImportError('AsyncBlobService requires the aiohttp package')
+
+        super().__init__(account_name, account_key, pool_size=pool_size, keep_alive=keep_alive, endpoint=endpoint)
+
+        if max_concurrency is not None:
+            self.max_concurrency = max_concurrency
+
+        self._client = None
+        self._semaphore = None
+
+    @classmethod
+    def from_service(cls, service : BlobService, **options):
+        """ Creates an AsyncBlobService for the same account as the given BlobService """
+        return cls(service.account_name, service.account_key, endpoint=service.endpoint, **options)
+
+    def _get_client(self):
+        # the client session and semaphore are bound to the running event loop, so they are created lazily
+        if self._client is None or self._client.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, force_close=not self.keep_alive)
+            self._client = aiohttp.ClientSession(connector=connector)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        return self._client
+
+    async def close(self):
+        """ Closes all pooled connections """
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _request(self, method, uri, headers = None, params = None, content = None):
+        """
+        Signs and sends a request to the storage service. Returns the response along with its content.
+        """
+        if content is None:
+            content = b''
+        elif isinstance(content, str):
+            content = content.encode('utf-8')
+
+        # filter empty headers and parameters
+        headers = dict(self._headers(), **{ key: value for key, value in (headers or {}).items() if value != None })
+        params = { key: str(value) for key, value in dict(self._params(), **(params or {})).items() if value != None }
+
+        # Give content length for modifying requests
+        if method.lower() in ['put', 'post', 'merge', 'delete'] and not content:
+            headers['Content-Length'] = '0'
+
+        url = self.get_url(uri)
+        headers['Authorization'] = self.auth.sign(method, url, headers, params, len(content))
+
+        client = self._get_client()
+        async with self._semaphore:
+            # the URL is already quoted the way it was signed. Empty bodies are omitted, since aiohttp would
+            # otherwise add an unsigned Content-Length header.
+            async with client.request(method.upper(), URL(url, encoded=True), params=params, headers=headers,
+                                      data=bytes(content) if content else None) as response:
+                body = await response.read()
+
+        # raise underlying ClientResponseError if something goes wrong
+        if response.status >= 300:
+            response.raise_for_status()
+
+        return response, body
+
+    async def create_container(self, name, access = None):
+        """
+        :param name: name containing only letters, numbers and dashes
+        :param access: container|blob|None
+        """
+        query = { 'restype': 'container' }
+        headers = { 'x-ms-blob-public-access': access }
+        response, _ = await self._request('put', '/' + name, headers, query)
+        return response.status == 201 # Created
+
+    async def list_blobs(self, container, prefix = None, delimiter = None, metadata = False):
+        """
+        Lists all blobs in a container, following continuation markers. See BlobService.list_blobs.
+        """
+        return [blob async for blob in self.iter_blobs(container, prefix, delimiter, metadata)]
+
+    async def iter_blobs(self, container, prefix = None, delimiter = None, metadata = False, marker = None,
+                         page_size = None):
+        """
+        Asynchronously iterates over the blobs in a container, requesting one page at a time.
+        See BlobService.iter_blobs.
+        """
+        query = {
+            'restype': 'container',
+            'comp': 'list',
+            'prefix': prefix if prefix else None,
+            'delimiter': delimiter,
+            'include': 'metadata' if metadata else None,
+            'maxresults': page_size
+        }
+
+        while True:
+            response, body = await self._request('get', '/' + container, params=dict(query, marker=marker))
+            root = etree.fromstring(body.decode('utf-8-sig'))
+
+            for element in root.find('Blobs'):
+                if element.tag == 'Blob':
+                    yield Blob.from_element(element, container)
+                elif element.tag == 'BlobPrefix':
+                    yield BlobPrefix.from_element(element)
+
+            marker = root.findtext('NextMarker')
+            if not marker:
+                return
+
+    async def create_blob(self, container, name, content, content_encoding = None):
+        """
+        Creates a new blob with the given bytes-like content in the destination container (which must exist).
+        """
+        name = _sanitize_blobname(name)
+        headers = { 'x-ms-blob-type': "BlockBlob", 'Content-Encoding': content_encoding }
+
+        content_type = mimetypes.guess_type(name)[0]
+        if content_type != None:
+            headers['Content-Type'] = content_type
+
+        response, _ = await self._request('put', '/%s/%s' % (container, name), headers=headers, content=content)
+        return response.status == 201 # Created
+
+    async def get_blob(self, container, name, with_content = True):
+        """
+        Gets a blob including its properties and metadata, or None if it does not exist.
+        :param with_content: Determines whether the content should be fetched along with the properties and metadata
+        """
+        name = _sanitize_blobname(name)
+
+        try:
+            response, body = await self._request('get' if with_content else 'head', "/%s/%s" % (container, name))
+        except aiohttp.ClientResponseError as e:
+            if e.status == 404:
+                return None
+            raise e
+
+        metadata = { key.replace("x-ms-meta-", ""): value for key, value in response.headers.items() if key.startswith('x-ms-meta-')}
+        blob = Blob(name, self.get_url('/%s/%s' % (container, name)), properties=response.headers, metadata=metadata,
+                    container=container)
+
+        if with_content:
+            blob.content = body
+
+        return blob
+
+    async def delete_blob(self, container, name):
+        name = _sanitize_blobname(name)
+        response, _ = await self._request('delete', '/%s/%s' % (container, name))
+        return response.status == 202 # Accepted
+
+    async def blob_exists(self, container, name):
+        return await self.get_blob(container, name, with_content=False) is not None
+
+    async def enable_cors(self, origins, allowed_methods = None, max_age_seconds = None):
+        """
+        Enables CORS for all files on the BlobService. See BlobService.enable_cors.
+        """
+        headers, params, content = _cors_request(origins, allowed_methods, max_age_seconds)
+        response, _ = await self._request('put', '/', headers, params, content)
+        return response.status == 202 # ACCEPTED
@@ -1,10 +1,24 @@
 import base64
 import hashlib
 import hmac
-from urllib.parse import urlparse
-import itertools
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
 import requests
 
+# standard headers that are part of the string to sign, in this order
+HEADERS_TO_SIGN = ('content-encoding', 'content-language', 'content-length',
+                   'content-md5', 'content-type', 'date', 'if-modified-since',
+                   'if-match', 'if-none-match', 'if-unmodified-since', 'range')
+
+# version of the Shared Access Signatures that are generated
+SAS_VERSION = '2015-04-05'
+# Shared Access Signature parameters that are part of the string to sign, in this order, with the canonicalized
+# resource following the signed expiry
+SAS_FIELDS = ('sp', 'st', 'se', None, 'si', 'sip', 'spr', 'sv', 'rscc', 'rscd', 'rsce', 'rscl', 'rsct')
+# permissions of Shared Access Signatures in the order expected by the service: read, add, create, write,
+# delete and list
+SAS_PERMISSIONS = 'racwdl'
+
 class SharedKeyAuthentication:
 
     def __init__(self, account_name, account_key):
@@ -13,50 +27,119 @@ class SharedKeyAuthentication:
         """
         self.account_name = account_name
         self.account_key = account_key
+        self._resource_prefix = '/' + account_name
+        # HMAC keyed with the decoded account key, created on first use and copied for every signature
+        self._hmac = None
 
     def auth_header(self, request : requests.Request, content_length = None):
         """ Computes the value of the Authorization header, following the form "SharedKey accountname:signature" """
-        signature = self._signature(request, content_length)
-        return 'SharedKey %s:%s' % (self.account_name, self._sign(signature))
+        return self.sign(request.method, request.url, request.headers, request.params, content_length)
 
     def authenticate(self, request : requests.Request, content_length = None):
         """ Computes and adds the Authorization header to request """
         request.headers['Authorization'] = self.auth_header(request, content_length)
 
+    def sign(self, method, url, headers, params, content_length = 0):
+        """
+        Computes the value of the Authorization header for a request given by its parts, independent of the HTTP
+        client that is going to send it.
+        """
+        signature = self._string_to_sign(method, url, headers, params, content_length)
+        return 'SharedKey %s:%s' % (self.account_name, self._sign(signature))
+
     def _signature(self, request : requests.Request, content_length = None):
         """
         Creates the signature string for this request according to
         http://msdn.microsoft.com/en-us/library/windowsazure/dd179428.aspx
         """
+        return self._string_to_sign(request.method, request.url, request.headers, request.params, content_length)
 
-        headers = {str(name).lower(): value for name, value in request.headers.items() if not value is None}
-        if content_length > 0:
+    def _string_to_sign(self, method, url, headers, params, content_length = 0):
+        headers = {str(name).lower(): value for name, value in headers.items() if not value is None}
+        if content_length:
             headers['content-length'] = str(content_length)
+        elif headers.get('content-length') == '0' and headers.get('x-ms-version', '') >= '2015-02-21':
+            # since version 2015-02-21 a zero Content-Length is signed as an empty string
+            headers['content-length'] = ''
 
-        # method to sign
-        signature = request.method.upper() + '\n'
-
-        # get headers to sign
-        headers_to_sign = ['content-encoding', 'content-language', 'content-length',
-                           'content-md5', 'content-type', 'date', 'if-modified-since',
-                           'if-match', 'if-none-match', 'if-unmodified-since', 'range']
-
-        signature += "\n".join(headers.get(h, '') for h in headers_to_sign) + "\n"
+        # method and headers to sign
+        parts = [method.upper()]
+        parts.extend(headers.get(h, '') for h in HEADERS_TO_SIGN)
+        signature = '\n'.join(parts) + '\n'
 
         # get x-ms header to sign
         signature += ''.join("%s:%s\n" % (k, v) for k, v in sorted(headers.items()) if v and 'x-ms' in k)
 
         # get account_name and uri path to sign
-        signature += '/' + self.account_name + urlparse(request.url).path
+        signature += self._resource_prefix + urlsplit(url).path
 
         # get query string to sign
-        signature += ''.join("\n%s:%s" % (k, v) for k, v in sorted(request.params.items()) if v)
+        signature += ''.join("\n%s:%s" % (k, v) for k, v in sorted(params.items()) if v)
 
         return signature
 
+    def shared_access_signature(self, container, name = None, permission = 'r', expiry = 3600, start = None,
+                                protocol = None, ip = None, cache_control = None, content_disposition = None,
+                                content_type = None):
+        """
+        Computes a Shared Access Signature, which grants access to a blob, or to all blobs in a container if no
+        name is given, to anyone who has it. It is signed locally with the account key.
+        :param permission: the granted permissions as letters, "r" (read), "a" (add), "c" (create), "w" (write),
+                           "d" (delete) and for containers "l" (list)
+        :param expiry: expiry as a datetime, or in seconds from now
+        :param start: datetime from which on the signature is valid, by default immediately
+        :param protocol: "https" to only allow requests over HTTPS, by default both HTTP and HTTPS are allowed
+        :param ip: IP address or range ("168.1.5.60-168.1.5.70") that requests must come from
+        :param cache_control: Cache-Control header of responses to read requests
+        :param content_disposition: Content-Disposition header of responses to read requests
+        :param content_type: Content-Type header of responses to read requests
+        :return: the query parameters of the signature
+        """
+        allowed = SAS_PERMISSIONS.replace('l', '') if name else SAS_PERMISSIONS
+        unknown = set(permission) - set(allowed)
+        if unknown:
+            raise ValueError('Unsupported permissions %s' % ''.join(sorted(unknown)))
+
+        if not isinstance(expiry, datetime):
+            expiry = datetime.now(timezone.utc) + timedelta(seconds=expiry)
+
+        params = {
+            'sv': SAS_VERSION,
+            'sr': 'b' if name else 'c',
+            'sp': ''.join(p for p in SAS_PERMISSIONS if p in permission),
+            'st': _sas_time(start) if start else None,
+            'se': _sas_time(expiry),
+            'sip': ip,
+            'spr': protocol,
+            'rscc': cache_control,
+            'rscd': content_disposition,
+            'rsct': content_type
+        }
+        params = { key: value for key, value in params.items() if value }
+        params['sig'] = self.sas_signature(params, container, name)
+        return params
+
+    def sas_signature(self, params, container, name = None):
+        """ Computes the signature of the parameters of a Shared Access Signature for a blob or a container """
+        resource = '/blob/%s/%s' % (self.account_name, container)
+        if name:
+            resource += '/' + name
+
+        return self._sign('\n'.join(params.get(field) or '' if field else resource for field in SAS_FIELDS))
+
     def _sign(self, string):
         " Signs given string using SHA256 with the account key. Returns the base64 encoded signature. "
-        decode_account_key = base64.b64decode(self.account_key)
-        signed_hmac_sha256 = hmac.HMAC(decode_account_key, string.encode('utf-8'), hashlib.sha256)
+        if self._hmac is None:
+            self._hmac = hmac.new(base64.b64decode(self.account_key), digestmod=hashlib.sha256)
+
+        signed_hmac_sha256 = self._hmac.copy()
+        signed_hmac_sha256.update(string.encode('utf-8'))
         digest = signed_hmac_sha256.digest()
-        return base64.b64encode(digest).decode('utf-8')
\ No newline at end of file
+        return base64.b64encode(digest).decode('utf-8')
+
+
+def _sas_time(time : datetime):
+    """ Formats a time for Shared Access Signatures. Times without a time zone are taken to be in UTC. """
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc)
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -1,52 +1,198 @@
+import array
+import base64
+import calendar
+import hashlib
+import io
+import itertools
 import json
 import mimetypes
+import mmap
+import operator
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlencode, urlsplit
 import xml.etree.ElementTree as etree
 import requests
 from requests import HTTPError
-from requests.adapters import HTTPAdapter
+from azurepython3.compression import Compression, CompressingReader, DecompressingReader, decompress
 from azurepython3.service import AzureService
 
 
+# month numbers by abbreviation, for parsing HTTP dates
+_MONTHS = { month: number for number, month in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1) }
+
+# distinct sequences of property names in listings, shared by all parsed entries, along with the positions of
+# Content-Length, Etag and Last-Modified in them
+_property_layouts = {}
+
+
+def _parse_http_date(text):
+    """ Converts an HTTP date like "Mon, 27 Jan 2014 10:27:34 GMT" to a POSIX timestamp """
+    _, day, month, year, clock, _ = text.split(' ')
+    hour, minute, second = clock.split(':')
+    return calendar.timegm((int(year), _MONTHS[month], int(day), int(hour), int(minute), int(second)))
+
+
+def _property_layout(names):
+    layout = _property_layouts.get(names)
+    if layout is None:
+        positions = tuple(names.index(key) if key in names else None
+                          for key in ('Content-Length', 'Etag', 'Last-Modified'))
+        layout = _property_layouts.setdefault(names, (names,) + positions)
+    return layout
+
+
+_tag = operator.attrgetter('tag')
+_text = operator.attrgetter('text')
+
+
+def _parse_entry(element : etree.Element):
+    """
+    Returns name, URL, property layout and values and metadata items of a listed container or blob. The property
+    names are shared between entries (see _property_layout), and the values are kept in a tuple instead of a dict.
+    """
+    properties = element.find('Properties')
+    if properties is not None:
+        layout = _property_layout(tuple(map(_tag, properties)))
+        values = tuple(map(_text, properties))
+    else:
+        layout, values = _property_layout(()), ()
+
+    metadata = element.find('Metadata')
+    metadata = tuple(zip(map(_tag, metadata), map(_text, metadata))) if metadata is not None else ()
+
+    return element.findtext('Name'), element.findtext('Url'), layout, values, metadata
+
+
 class Container:
+    """
+    A container and its properties. Containers from listings build their properties and metadata dicts only when
+    these are first accessed.
+    """
+
+    __slots__ = ('name', 'url', '_properties', '_metadata')
+
     def __init__(self, name, url = None, properties = None, metadata = None):
         self.name = name
         self.url = url
-        self.properties = properties if properties != None else {}
-        self.metadata = metadata if metadata != None else {}
+        self._properties = properties if properties != None else {}
+        self._metadata = metadata if metadata != None else {}
+
+    @property
+    def properties(self):
+        if type(self._properties) is tuple:
+            self._properties = dict(zip(*self._properties))
+        return self._properties
+
+    @properties.setter
+    def properties(self, properties):
+        self._properties = properties
+
+    @property
+    def metadata(self):
+        if type(self._metadata) is tuple:
+            self._metadata = dict(self._metadata)
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self._metadata = metadata
 
     @classmethod
     def from_element(cls, element : etree.Element):
-        url = element.find('Url').text
-        properties = dict([(p.tag, p.text) for p in element.find('Properties')])
+        name, url, layout, values, metadata = _parse_entry(element)
+        return Container(name, url, (layout[0], values), metadata)
 
-        if element.find('Metadata') != None:
-            metadata = dict([(e.tag, e.text) for e in element.find('Metadata')])
-        else:
-            metadata = {}
 
-        container = Container(element.find('Name').text, url, properties, metadata)
-        return container
+class Blob:
+    """
+    A blob along with its properties and metadata. Size, ETag and modification time are available as typed
+    attributes. Blobs from listings are stored compactly and build their properties and metadata dicts only when
+    these are first accessed.
+    """
 
+    __slots__ = ('name', '_url', '_properties', '_metadata', 'content', 'container', 'service', 'size', 'etag',
+                 '_last_modified')
 
-class Blob:
-    def __init__(self, name, url = None, properties = None, metadata = None):
+    def __init__(self, name, url = None, properties = None, metadata = None, container = None, service = None):
         self.name = name
-        self.url = url
-        self.properties = properties if properties != None else {}
-        self.metadata = metadata if metadata != None else {}
+        self._url = url
+        self._properties = properties if properties != None else {}
+        self._metadata = metadata if metadata != None else {}
         self.content = None
+        # the container and service the blob was retrieved from, if known
+        self.container = container
+        self.service = service
+
+        size = self._properties.get('Content-Length')
+        self.size = int(size) if size is not None else None
+        self.etag = self._properties.get('ETag')
+        self._last_modified = self._properties.get('Last-Modified')
+
+    @property
+    def url(self):
+        # blobs from listings derive their URL from the service
+        if self._url is None and self.service is not None and self.container is not None:
+            self._url = self.service.get_blob_url(self.container, self.name)
+        return self._url
+
+    @url.setter
+    def url(self, url):
+        self._url = url
+
+    @property
+    def properties(self):
+        if type(self._properties) is tuple:
+            self._properties = dict(zip(*self._properties))
+        return self._properties
+
+    @properties.setter
+    def properties(self, properties):
+        self._properties = properties
+
+    @property
+    def metadata(self):
+        if type(self._metadata) is tuple:
+            self._metadata = dict(self._metadata)
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self._metadata = metadata
+
+    @property
+    def last_modified(self) -> datetime:
+        """ The time of the last modification in UTC, or None if unknown """
+        if self._last_modified is None:
+            return None
+        return datetime.fromtimestamp(_parse_http_date(self._last_modified), timezone.utc)
 
     def content_length(self):
         """ Returns the size of the blob's content in bytes """
+        if self.size is not None:
+            return self.size
         return int(self.properties['Content-Length'])
 
+    def _get(self):
+        if self.service is not None and self.container is not None:
+            # signed, retried, instrumented and scheduled like all requests of the service
+            return self.service._request('get', '/%s/%s' % (self.container, self.name))
+        return requests.get(self.url)
+
     def download_text(self, encoding = None):
         """
         Downloads the blob context as text. If no encoding is provided it is determined automatically  based
         on the content-encoding header of the response. Alternatively a specific content encoding can be
         specified through the second argument.
         """
-        response = requests.get(self.url)
+        response = self._get()
 
         if encoding != None:
             response.encoding = encoding
@@ -55,42 +201,468 @@ class Blob:
 
         return response.text
 
-    def download_bytes(self):
+    def download_bytes(self, max_connections = None):
         """
-        Downloads the binary content of the file.
+        Downloads the binary content of the file. If max_connections is given and the blob was retrieved through
+        a BlobService, the content is downloaded in ranges over that many parallel connections into a bytearray.
         """
-        return requests.get(self.url).content
+        if max_connections and self.service is not None:
+            # the ranges hold the content as stored, which is decoded like the response to a single request
+            content, headers = self.service._download_ranges(self.container, self.name,
+                                                             max_connections=max_connections)
+            encoding = headers.get('Content-Encoding')
+            if encoding in ('gzip', 'deflate', 'br'):
+                return bytearray(decompress(content, encoding))
+            return content
 
+        return self._get().content
+
+    @classmethod
+    def from_element(cls, element : etree.Element, container = None, service = None):
+        name, url, layout, values, metadata = _parse_entry(element)
+        names, size, etag, last_modified = layout
+        blob = Blob.__new__(Blob)
+        blob.name = name
+        # the URL can be derived from the service when needed
+        blob._url = url if service is None else None
+        blob._properties = (names, values)
+        blob._metadata = metadata
+        blob.content = None
+        blob.container = container
+        blob.service = service
+
+        blob.size = int(values[size]) if size is not None and values[size] else None
+        blob.etag = values[etag] if etag is not None else None
+        blob._last_modified = values[last_modified] if last_modified is not None else None
+        return blob
+
+    def __str__(self):
+        return self.url
+
+
+def content_md5(file, chunk_size = 1024 * 1024):
+    """
+    Computes the base64 encoded MD5 hash of a binary file's remaining content, as used for the Content-MD5 of
+    blobs. The file is read in chunks and repositioned afterwards. Returns the hash and the number of bytes read.
+    """
+    position = file.tell()
+    md5 = hashlib.md5()
+    size = 0
+
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        md5.update(chunk)
+        size += len(chunk)
+
+    file.seek(position)
+    return base64.b64encode(md5.digest()).decode('ascii'), size
+
+
+def _readinto_exactly(stream, view):
+    """ Fills the memoryview with bytes read from the stream """
+    while len(view):
+        count = stream.readinto(view)
+        if not count:
+            raise IOError('Connection closed before the expected content was received')
+        view = view[count:]
+
+
+def _cors_request(origins, allowed_methods = None, max_age_seconds = None):
+    """ Returns headers, query parameters and content of the request that sets the CORS rules """
+    if not allowed_methods:
+        allowed_methods = ['GET', 'PUT']
+
+    if not max_age_seconds:
+        max_age_seconds = 500
+
+    headers = {
+        'x-ms-version': '2013-08-15'
+    }
+
+    params = {
+        'restype': 'service',
+        'comp': 'properties'
+    }
+
+    if type(origins) is list or type(origins) is tuple:
+        origins = ",".join(origins)
+
+    if type(allowed_methods) is list or type(allowed_methods) is tuple:
+        allowed_methods = ",".join(allowed_methods)
+
+    content = '''<?xml version="1.0" encoding="utf-8"?>
+        <StorageServiceProperties>
+            <Cors>
+                <CorsRule>
+                    <AllowedOrigins>{origins}</AllowedOrigins>
+                    <AllowedMethods>{methods}</AllowedMethods>
+                    <MaxAgeInSeconds>{age}</MaxAgeInSeconds>
+                    <ExposedHeaders>x-ms-meta-data*,x-ms-meta-customheader</ExposedHeaders>
+                    <AllowedHeaders>x-ms-meta-target*,x-ms-meta-customheader</AllowedHeaders>
+                </CorsRule>
+            </Cors>
+            <DefaultServiceVersion>{version}</DefaultServiceVersion>
+        </StorageServiceProperties>'''.format(origins=origins, age=max_age_seconds,
+                                              methods=allowed_methods, version=headers['x-ms-version'])
+
+    return headers, params, content
+
+
+def _sanitize_blobname(blobname):
+    # on windows paths use backslashes, which is not compatible to URLs. So convert them to slashes.
+    return blobname.replace("\\", "/")
+
+
+class BlobPrefix:
+    """ A common prefix of blob names, as returned by listings with a delimiter. Comparable to a directory. """
+
+    def __init__(self, name):
+        self.name = name
 
     @classmethod
     def from_element(cls, element : etree.Element):
-        name = element.find('Name').text
-        url = element.find('Url').text
-        properties = dict([(p.tag, p.text) for p in element.find('Properties')])
+        return BlobPrefix(element.find('Name').text)
+
+    def __str__(self):
+        return self.name
+
+
+class BlobColumns:
+    """
+    A blob listing in columnar form, for analyzing large numbers of blobs. Names, sizes and modification times are
+    stored in parallel sequences, the latter two as compact arrays of integers and POSIX timestamps.
+    """
+
+    __slots__ = ('names', 'sizes', 'last_modified')
+
+    def __init__(self):
+        self.names = []
+        self.sizes = array.array('q')
+        self.last_modified = array.array('d')
+
+    def append(self, element : etree.Element):
+        """ Adds the blob described by a listing element """
+        name, _, layout, values, _ = _parse_entry(element)
+        _, size, _, last_modified = layout
+        self.names.append(name)
+        self.sizes.append(int(values[size]) if size is not None and values[size] else 0)
+        self.last_modified.append(_parse_http_date(values[last_modified]) if last_modified is not None else 0)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        """ Iterates over the blobs as (name, size, last_modified) tuples """
+        return zip(self.names, self.sizes, self.last_modified)
+
+
+class ListingPage:
+    """
+    A page of a container or blob listing. The response is parsed incrementally while iterating over the page
+    and each entry is discarded from the parsed tree once it has been converted. After the page has been iterated
+    completely, next_marker contains the marker of the next page, or None if it was the last page.
+    """
+
+    def __init__(self, response, factories):
+        """
+        :param response: streamed response of a list operation
+        :param factories: maps tag names of listed entries to functions converting their elements
+        """
+        self.response = response
+        self.factories = factories
+        self.next_marker = None
+        self._entries = self._parse()
+
+    def _parse(self):
+        with self.response:
+            self.response.raw.decode_content = True
+
+            # only end events are needed, which halves the events to process per entry
+            for _, element in etree.iterparse(self.response.raw):
+                if element.tag in self.factories:
+                    entry = self.factories[element.tag](element)
+                    # drop the content of converted entries from the tree, the factories keep what they need
+                    element.clear()
+                    yield entry
+                elif element.tag == 'NextMarker':
+                    self.next_marker = element.text or None
+
+    def __iter__(self):
+        return self._entries
+
+    def exhaust(self):
+        """ Parses the remainder of the page, discarding its entries """
+        for _ in self._entries:
+            pass
+
+
+class BlobReader(io.RawIOBase):
+    """
+    A read-only, seekable file object for the content of a blob. Nothing is downloaded upfront, instead each
+    read fetches the requested byte range, at least read_ahead_size bytes at a time, and reading the remainder
+    of the blob takes a single request. All ranges are read from the version of the blob that was seen first,
+    if the blob is replaced meanwhile, reading raises an IOError. Use BlobService.open_blob to get a reader with a
+    read-ahead buffer.
+    """
+
+    def __init__(self, service, container, name, read_ahead_size = 0):
+        self.service = service
+        self.container = container
+        # not "name", which file objects use for local paths
+        self.blob_name = name
+        self.mode = 'rb'
+        self.read_ahead_size = read_ahead_size
+        # properties of the blob, available after the first read
+        self.properties = None
+        self.etag = None
+        self._size = None
+        self._position = 0
+        # content fetched beyond the end of a smaller read, and the position it starts at
+        self._ahead = b''
+        self._ahead_position = 0
+
+    @property
+    def size(self):
+        """ The size of the blob's content in bytes """
+        if self._size is None:
+            blob = self.service.get_blob(self.container, self.blob_name, with_content=False)
+            if blob is None:
+                raise FileNotFoundError('Blob "%s" does not exist in container "%s"'
+                                        % (self.blob_name, self.container))
+            self._size = blob.content_length()
+            self.properties = blob.properties
+            self.etag = self.etag or blob.properties.get('ETag')
 
-        if element.find('Metadata') != None:
-            metadata = dict([(e.tag, e.text) for e in element.find('Metadata')])
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
         else:
-            metadata = {}
+            raise ValueError('Invalid whence (%r)' % whence)
 
-        return Blob(name, url, properties, metadata)
+        if position < 0:
+            raise ValueError('Negative seek position %d' % position)
 
-    def __str__(self):
-        return self.url
+        self._position = position
+        return position
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        if not len(view) or (self._size is not None and self._position >= self._size):
+            return 0
+
+        offset = self._position - self._ahead_position
+        if not 0 <= offset < len(self._ahead):
+            if len(view) >= self.read_ahead_size:
+                length = self._fetch_into(view)
+                self._position += length
+                return length
+
+            # smaller reads fetch read_ahead_size bytes, and the following reads are served from the surplus
+            ahead = bytearray(self.read_ahead_size)
+            del ahead[self._fetch_into(memoryview(ahead)):]
+            self._ahead, self._ahead_position, offset = ahead, self._position, 0
+
+        length = min(len(view), len(self._ahead) - offset)
+        view[:length] = self._ahead[offset:offset + length]
+        self._position += length
+        return length
+
+    def readall(self):
+        """ Reads the remainder of the blob with a single request """
+        chunks = []
+        offset = self._position - self._ahead_position
+        if 0 <= offset < len(self._ahead):
+            chunks.append(bytes(self._ahead[offset:]))
+            self._position += len(chunks[0])
+
+        if self._size is None or self._position < self._size:
+            response = self._get('bytes=%d-' % self._position)
+            if response is not None:
+                with response:
+                    chunks.append(response.content)
+                self._position += len(chunks[-1])
+
+        return b''.join(chunks)
+
+    def _fetch_into(self, view):
+        """ Reads the range starting at the current position into the memoryview and returns its length """
+        response = self._get('bytes=%d-%d' % (self._position, self._position + len(view) - 1))
+        if response is None:
+            return 0
+
+        with response:
+            length = int(response.headers['Content-Length'])
+            _readinto_exactly(response.raw, view[:length])
+        return length
+
+    def _get(self, range):
+        """ Requests a range of the blob's content, or returns None if it starts past the end """
+        headers = { 'x-ms-range': range, 'If-Match': self.etag }
+
+        try:
+            response = self.service._request('get', '/%s/%s' % (self.container, self.blob_name), headers,
+                                             stream=True)
+        except HTTPError as e:
+            if e.response.status_code == 412: # Precondition Failed
+                raise IOError('Blob "%s" in container "%s" was modified while it was read'
+                              % (self.blob_name, self.container))
+            if e.response.status_code == 416: # Requested range not satisfiable, i.e. reading past the end
+                return None
+            raise e
+
+        if self._size is None:
+            self._size = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+            self.properties = response.headers
+        if self.etag is None:
+            self.etag = response.headers.get('ETag')
+        return response
+
+
+class AppendBlobWriter(io.BufferedIOBase):
+    """
+    A file object appending to an append blob. Writes are buffered and appended in blocks of flush_size bytes,
+    and if a flush_interval is given, buffered data is appended at the latest that many seconds after it was
+    written. Each append is conditional on the expected size of the blob, so that appends can be retried safely
+    and concurrent writers are detected. Use BlobService.open_append_blob to create a writer.
+    """
+
+    def __init__(self, service, container, name, position = 0, flush_size = None, flush_interval = None):
+        self.service = service
+        self.container = container
+        self.name = name
+        # the size of the blob, at which the next block is appended
+        self.position = position
+        self.flush_size = min(flush_size or service.append_block_size, service.append_block_size)
+        self.flush_interval = flush_interval
+        self._buffer = bytearray()
+        self._lock = threading.RLock()
+        self._timer = None
+        # an error of a timed flush, raised by the next write or flush
+        self._error = None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        with self._lock:
+            if self.closed:
+                raise ValueError('Write to closed blob')
+            self._raise_error()
+
+            self._buffer += data
+            while len(self._buffer) >= self.flush_size:
+                self._append(self.flush_size)
+
+            if self._buffer and self.flush_interval and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self._timed_flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        return len(data)
+
+    def flush(self):
+        """ Appends all buffered data """
+        with self._lock:
+            self._raise_error()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            while self._buffer:
+                self._append(min(len(self._buffer), self.flush_size))
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except Exception as e:
+            self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _append(self, size):
+        block = bytes(self._buffer[:size])
+        self.service.append_block(self.container, self.name, block, append_position=self.position)
+        del self._buffer[:size]
+        self.position += len(block)
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                try:
+                    self.flush()
+                finally:
+                    super().close()
 
 
 class BlobService(AzureService):
 
-    def __init__(self, account_name, account_key):
-        super().__init__(account_name, account_key)
+    # payloads up to this size are uploaded with a single request, larger ones in blocks
+    single_put_threshold = 32 * 1024 * 1024
+    # size of the blocks that larger payloads are split into (Put Block accepts at most 4 MB)
+    block_size = 4 * 1024 * 1024
+    # number of blocks or ranges that are transferred in parallel
+    max_connections = 4
+    # size of the ranges that download_blob requests in parallel
+    download_chunk_size = 4 * 1024 * 1024
+    # number of bytes that blobs opened with open_blob read ahead
+    read_ahead_size = 256 * 1024
+    # maximum number of operations in a single Blob Batch request
+    max_batch_size = 256
+    # service version used for Blob Batch requests
+    batch_version = '2019-07-07'
+    # error codes of 400 responses to batch requests that the service or the account does not support, which
+    # fall back to single requests for that call
+    batch_error_codes = ('InvalidQueryParameterValue', 'UnsupportedQueryParameter', 'UnsupportedHttpVerb',
+                         'FeatureVersionMismatch', 'NotImplemented')
+    # set to False once the service lacked the batch endpoint, falling back to single requests from then on
+    _batch_supported = True
+    # an azurepython3.cache.DiskCache for the contents returned by get_blob_content, if set
+    content_cache = None
+    # decides which contents create_blob compresses if called with compress=True
+    compression = Compression()
+    # service version used for append blobs, which were introduced in 2015-02-21
+    append_version = '2015-02-21'
+    # maximum size of a single Append Block request
+    append_block_size = 4 * 1024 * 1024
+    # service version used for copying blobs, which the service may complete asynchronously since 2012-02-12
+    copy_version = '2012-02-12'
+    # seconds between status requests while waiting for a pending copy
+    copy_poll_interval = 1
+    # service version used for uploads that set Content-Disposition, which was introduced in 2013-08-15
+    disposition_version = '2013-08-15'
+
+    def __init__(self, account_name, account_key, **options):
+        """
+        Creates a BlobService for the given account. Further keyword options (pool_size, keep_alive, warm_up,
+        endpoint) configure the service's connection pool and host, see AzureService.
+        """
+        super().__init__(account_name, account_key, **options)
 
     @classmethod
     def from_config(self, filename):
         with open(filename, "r") as file:
             credentials = json.load(file)
 
-        # create the blob service
-        return BlobService(credentials['account_name'], credentials['account_key'])
+        # create the blob service, optionally for a custom endpoint
+        return BlobService(credentials['account_name'], credentials['account_key'],
+                           endpoint=credentials.get('endpoint'))
 
     @classmethod
     def discover(cls):
@@ -122,75 +694,594 @@ class BlobService(AzureService):
         return response.status_code == 202 # Accepted?
 
     def list_containers(self, prefix=None, metadata=False):
+        """
+        Lists all containers of the account, following continuation markers. Use iter_containers to avoid
+        holding the whole listing in memory.
+        """
+        return list(self.iter_containers(prefix, metadata))
+
+    def iter_containers(self, prefix=None, metadata=False, marker=None, page_size=None):
+        """
+        Lazily iterates over the containers of the account. Pages are requested and parsed one at a time as
+        the iteration proceeds, so memory use does not depend on the number of containers.
+        :param marker: continuation marker of a previous listing to resume from
+        :param page_size: maximum number of containers requested per page (at most 5000)
+        """
+        for page in self.list_container_pages(prefix, metadata, marker, page_size):
+            yield from page
+
+    def list_container_pages(self, prefix=None, metadata=False, marker=None, page_size=None):
+        """
+        Lazily iterates over the pages of the container listing, see ListingPage.
+        """
         query = {
             'comp': 'list',
             'prefix': prefix,
-            'include': 'metadata' if metadata else None
+            'include': 'metadata' if metadata else None,
+            'marker': marker,
+            'maxresults': page_size
         }
 
-        response = self._request('get', '/', params=query)
-        root = etree.fromstring(response.text)
-        assert root.tag == 'EnumerationResults'
-        assert root[0].tag == 'Containers'
-
-        # list containers
-        # TODO: handle <NextMarker> for paginated results
-        return [Container.from_element(x) for x in root.iter('Container')]
+        return self._list_pages('/', query, { 'Container': Container.from_element })
 
-    def list_blobs(self, container, prefix = None):
+    def list_blobs(self, container, prefix = None, delimiter = None, metadata = False):
         """
-        Lists blobs in a container. This implementation does not yet consider markers and maxresults
-        for paginated lists of more than 5000 entries.
+        Lists all blobs in a container, following continuation markers. Use iter_blobs to avoid holding the whole
+        listing in memory.
         :param container: container name
         :param prefix: common blob name prefix
+        :param delimiter: if given, blobs whose names contain the delimiter after the prefix are grouped into
+                          BlobPrefix entries, much like directories
+        :param metadata: whether to include the blobs' metadata
+        """
+        return list(self.iter_blobs(container, prefix, delimiter, metadata))
+
+    def iter_blobs(self, container, prefix = None, delimiter = None, metadata = False, marker = None, page_size = None):
+        """
+        Lazily iterates over the blobs in a container, see list_blobs. Pages are requested and parsed one at a time
+        as the iteration proceeds, so memory use does not depend on the number of blobs.
+        :param marker: continuation marker of a previous listing to resume from
+        :param page_size: maximum number of blobs requested per page (at most 5000)
         """
+        for page in self.list_blob_pages(container, prefix, delimiter, metadata, marker, page_size):
+            yield from page
 
+    def list_blob_pages(self, container, prefix = None, delimiter = None, metadata = False, marker = None,
+                        page_size = None):
+        """
+        Lazily iterates over the pages of the blob listing, see ListingPage. The next_marker of a page can be
+        used to resume the listing later on.
+        """
         query = {
             'restype': 'container',
             'comp': 'list',
-            'prefix': prefix if prefix else None
+            'prefix': prefix if prefix else None,
+            'delimiter': delimiter,
+            'include': 'metadata' if metadata else None,
+            'marker': marker,
+            'maxresults': page_size
         }
 
-        response = self._request('get', '/' + container, params = query)
-        root = etree.fromstring(response.text)
+        factories = {
+            'Blob': lambda element: Blob.from_element(element, container, self),
+            'BlobPrefix': BlobPrefix.from_element
+        }
 
-        return [Blob.from_element(x) for x in root.iter('Blob')]
+        return self._list_pages('/' + container, query, factories)
 
-    def create_blob(self, container, name, content, content_encoding = None):
+    def list_blob_columns(self, container, prefix = None, marker = None, page_size = None) -> BlobColumns:
         """
-        Creates a new blob in the destination container (which must exist). Content is expected to be an iterable
-        of bytes, such as a bytearray.
+        Lists all blobs in a container in columnar form, as parallel sequences of names, sizes and modification
+        times. Considerably less memory and time is spent per blob than with list_blobs, since no objects are
+        created for the blobs, which suits listings of millions of blobs.
+        """
+        columns = BlobColumns()
+        query = {
+            'restype': 'container',
+            'comp': 'list',
+            'prefix': prefix if prefix else None,
+            'marker': marker,
+            'maxresults': page_size
+        }
+
+        for page in self._list_pages('/' + container, query, { 'Blob': columns.append }):
+            page.exhaust()
+
+        return columns
+
+    def _list_pages(self, uri, query, factories):
+        while True:
+            page = ListingPage(self._request('get', uri, params=query, stream=True), factories)
+            yield page
+
+            # the marker is only known once the page has been parsed completely
+            page.exhaust()
+            if not page.next_marker:
+                return
+
+            query = dict(query, marker=page.next_marker)
+
+    def create_blob(self, container, name, content, content_encoding = None,
+                    block_size = None, max_connections = None, max_memory = None, content_md5 = None,
+                    compress = None, cache_control = None, content_disposition = None):
+        """
+        Creates a new blob in the destination container (which must exist). Content can be bytes-like, such as
+        bytes, a bytearray, a memoryview or a mmap, or a binary file-like object.
+
+        Payloads up to BlobService.single_put_threshold bytes are uploaded with a single request. Larger payloads
+        are streamed in blocks that are uploaded concurrently and committed afterwards, so only a bounded amount
+        of the content has to be held in memory at any time.
         :param container: container name
         :param name: blob name
-        :param content: byte content
+        :param content: byte content or binary file-like object
+        :param block_size: size of the uploaded blocks in bytes (at most 4 MB)
+        :param max_connections: number of blocks that are uploaded in parallel
+        :param max_memory: upper bound for the bytes of content held in memory while uploading blocks
+        :param content_md5: base64 encoded MD5 hash of the whole content, stored as the blob's Content-MD5
+        :param compress: True to compress content of compressible MIME types according to BlobService.compression,
+                         or an azurepython3.compression.Compression, or a content encoding ("gzip" or "br").
+                         The content is compressed while it is uploaded and Content-Encoding is set accordingly.
+                         Content that already has a content_encoding is not compressed.
+        :param cache_control: Cache-Control header returned when the blob is read, e.g. "public, max-age=86400"
+        :param content_disposition: Content-Disposition header returned when the blob is read, e.g. "attachment"
         """
-        name = self._sanitize_blobname(name)
-        headers = { 'x-ms-blob-type': "BlockBlob", 'Content-Encoding': content_encoding }
-
+        name = _sanitize_blobname(name)
         content_type = mimetypes.guess_type(name)[0]
+
+        if compress and not content_encoding:
+            compression = self.compression if compress is True else compress
+            if isinstance(compression, str):
+                compression = Compression(compression, types=('*',))
+
+            content_encoding = compression.encoding_for(content_type)
+            if content_encoding:
+                content = CompressingReader(content, compression.compressor(content_encoding))
+                # the hash of the uncompressed content doesn't apply anymore
+                content_md5 = None
+
+        headers = { 'x-ms-blob-type': "BlockBlob", 'Content-Encoding': content_encoding, 'Content-MD5': content_md5,
+                    'x-ms-blob-cache-control': cache_control, 'x-ms-blob-content-disposition': content_disposition }
+
         if content_type != None:
             headers['Content-Type'] = content_type
+        if content_disposition:
+            headers['x-ms-version'] = self.disposition_version
+
+        block_size = block_size or self.block_size
+        size = self._content_size(content)
+
+        if size is not None and size <= self.single_put_threshold:
+            data = self._read_content(content, size)
+        else:
+            blocks = self._iter_blocks(content, block_size)
+            first = next(blocks, b'')
+            second = next(blocks, None)
+
+            if second is not None:
+                blocks = itertools.chain([first, second], blocks)
+                return self._create_blob_from_blocks(container, name, blocks, headers, block_size,
+                                                     max_connections or self.max_connections, max_memory)
+
+            # content of unknown size turned out to fit into a single block
+            data = bytes(first)
+
+        response = self._request('put', '/%s/%s' % (container, name), headers=headers, content = data)
+        return response.status_code == 201 # Created
+
+    def _create_blob_from_blocks(self, container, name, blocks, headers, block_size, max_connections, max_memory):
+        """
+        Uploads the blocks concurrently using Put Block and commits them with Put Block List. At most
+        max_memory bytes worth of blocks are read ahead of the uploads (by default twice the number of
+        connections).
+        """
+        if max_memory:
+            max_pending = max(1, max_memory // block_size)
+        else:
+            max_pending = 2 * max_connections
+
+        uri = '/%s/%s' % (container, name)
+        pending = threading.BoundedSemaphore(max_pending)
+        failed = threading.Event()
+        block_ids = []
+        futures = []
+
+        def put_block(block_id, block):
+            try:
+                self._request('put', uri, params={'comp': 'block', 'blockid': block_id}, content=bytes(block))
+            except Exception:
+                failed.set()
+                raise
+            finally:
+                pending.release()
+
+        with ThreadPoolExecutor(max_workers=max_connections) as executor:
+            while not failed.is_set():
+                # wait for a free slot before reading the next block into memory
+                pending.acquire()
+                block = next(blocks, None)
+                if block is None:
+                    pending.release()
+                    break
+
+                block_id = base64.b64encode(('%08d' % len(block_ids)).encode('ascii')).decode('ascii')
+                block_ids.append(block_id)
+                futures.append(executor.submit(put_block, block_id, block))
 
-        response = self._request('put', '/%s/%s' % (container, name), headers=headers, content = content)
+        # re-raise the first error, if any
+        for future in futures:
+            future.result()
+
+        block_list = ''.join('<Latest>%s</Latest>' % block_id for block_id in block_ids)
+        content = ('<?xml version="1.0" encoding="utf-8"?><BlockList>%s</BlockList>' % block_list).encode('utf-8')
+        commit_headers = {
+            'x-ms-version': headers.get('x-ms-version'),
+            'x-ms-blob-content-type': headers.get('Content-Type'),
+            'x-ms-blob-content-encoding': headers.get('Content-Encoding'),
+            'x-ms-blob-content-md5': headers.get('Content-MD5'),
+            'x-ms-blob-cache-control': headers.get('x-ms-blob-cache-control'),
+            'x-ms-blob-content-disposition': headers.get('x-ms-blob-content-disposition')
+        }
+
+        response = self._request('put', uri, headers=commit_headers, params={'comp': 'blocklist'}, content=content)
         return response.status_code == 201 # Created
 
-    def delete_blob(self, container, name):
-        name = self._sanitize_blobname(name)
-        response = self._request('delete', '/%s/%s' % (container, name))
+    @staticmethod
+    def _content_size(content):
+        """ Returns the number of remaining bytes of the content, or None if it cannot be determined upfront """
+        # mmaps have a file-like interface, but their seek() doesn't return the position
+        if hasattr(content, 'read') and not isinstance(content, mmap.mmap):
+            try:
+                position = content.tell()
+                end = content.seek(0, os.SEEK_END)
+                content.seek(position)
+                return end - position
+            except (AttributeError, OSError, ValueError):
+                return None
+
+        try:
+            return memoryview(content).nbytes
+        except TypeError:
+            return len(content)
+
+    @staticmethod
+    def _read_content(content, size):
+        """ Returns content that is small enough for a single request in a form accepted by requests """
+        if isinstance(content, (memoryview, mmap.mmap)):
+            return bytes(content)
+        if hasattr(content, 'read'):
+            return content.read(size)
+        return content
+
+    @staticmethod
+    def _iter_blocks(content, block_size):
+        """ Splits file-like or bytes-like content into blocks, without copying bytes-like content """
+        if hasattr(content, 'read') and not isinstance(content, mmap.mmap):
+            while True:
+                block = content.read(block_size)
+                if not block:
+                    return
+                yield block
+        else:
+            view = memoryview(content).cast('B')
+            for offset in range(0, len(view), block_size):
+                yield view[offset:offset + block_size]
+
+    def delete_blob(self, container, name, etag = None):
+        """
+        Deletes a blob.
+        :param etag: if given, the blob is only deleted if it still has this ETag. Otherwise an HTTPError 412
+                     (Precondition Failed) is raised.
+        """
+        name = _sanitize_blobname(name)
+        response = self._request('delete', '/%s/%s' % (container, name), {'If-Match': etag})
         return response.status_code == 202 # Accepted
 
+    def create_append_blob(self, container, name, content_encoding = None, metadata = None, overwrite = True):
+        """
+        Creates an empty append blob, to which blocks can be appended with append_block or open_append_blob.
+        :param overwrite: whether an existing blob is replaced. If False, an HTTPError 409 (Conflict) is raised
+                          if the blob already exists.
+        """
+        name = _sanitize_blobname(name)
+        headers = dict(self._metadata_headers(metadata or {}), **{
+            'x-ms-version': self.append_version,
+            'x-ms-blob-type': 'AppendBlob',
+            'x-ms-blob-content-type': mimetypes.guess_type(name)[0],
+            'x-ms-blob-content-encoding': content_encoding,
+            'If-None-Match': None if overwrite else '*'
+        })
+
+        response = self._request('put', '/%s/%s' % (container, name), headers, operation='create_append_blob')
+        return response.status_code == 201 # Created
+
+    def append_block(self, container, name, content, append_position = None, max_size = None):
+        """
+        Appends up to append_block_size bytes to an append blob. Only the appended bytes are transferred.
+        :param append_position: if given, the block is only appended if the blob has exactly this size, otherwise
+                                an HTTPError 412 (Precondition Failed) is raised. This also allows retrying the
+                                request safely, which is not done without it.
+        :param max_size: if given, the block is only appended if the blob doesn't grow beyond this size
+        :return: the offset at which the block was appended
+        """
+        name = _sanitize_blobname(name)
+        content = bytes(content)
+        if len(content) > self.append_block_size:
+            raise ValueError('Blocks can have at most %d bytes, got %d' % (self.append_block_size, len(content)))
+
+        headers = {
+            'x-ms-version': self.append_version,
+            'x-ms-blob-condition-appendpos': str(append_position) if append_position is not None else None,
+            'x-ms-blob-condition-maxsize': str(max_size) if max_size is not None else None
+        }
+
+        response = self._request('put', '/%s/%s' % (container, name), headers, {'comp': 'appendblock'}, content,
+                                 idempotent=append_position is not None)
+        return int(response.headers['x-ms-blob-append-offset'])
+
+    def open_append_blob(self, container, name, create = True, flush_size = None, flush_interval = None):
+        """
+        Opens an append blob for buffered writing, see AppendBlobWriter.
+        :param create: whether to create the blob if it doesn't exist yet
+        """
+        name = _sanitize_blobname(name)
+        blob = self.get_blob(container, name, with_content=False)
+
+        if blob is None:
+            if not create:
+                raise FileNotFoundError('Blob "%s" does not exist in container "%s"' % (name, container))
+            self.create_append_blob(container, name, overwrite=False)
+            position = 0
+        else:
+            position = blob.content_length()
+
+        return AppendBlobWriter(self, container, name, position, flush_size, flush_interval)
+
+    def copy_blob(self, container, name, source_container, source_name, metadata = None, wait = True, timeout = None):
+        """
+        Copies a blob within the storage account. The service copies the content itself, so it is not transferred
+        through the client. See copy_blob_from_url.
+        """
+        source_name = _sanitize_blobname(source_name)
+        return self.copy_blob_from_url(container, name, self.get_blob_url(source_container, source_name), metadata,
+                                       wait, timeout)
+
+    def copy_blob_from_url(self, container, name, url, metadata = None, wait = True, timeout = None):
+        """
+        Copies a blob from the given URL, which must refer to a blob of the same account or be readable without
+        authentication. Larger copies may be completed asynchronously by the service.
+        :param metadata: metadata of the copy, by default the metadata of the source blob is copied
+        :param wait: whether to wait until a pending copy has completed
+        :param timeout: maximum number of seconds to wait for a pending copy
+        :return: the status of the copy, "success" or "pending" if wait is False
+        """
+        name = _sanitize_blobname(name)
+        uri = '/%s/%s' % (container, name)
+
+        headers = self._metadata_headers(metadata) if metadata else {}
+        headers.update({ 'x-ms-version': self.copy_version, 'x-ms-copy-source': url })
+        response = self._request('put', uri, headers, operation='copy_blob')
+        status = response.headers.get('x-ms-copy-status', 'success')
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        while wait and status == 'pending':
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError('Copy of "%s" to "%s" did not complete within %s seconds' % (url, uri, timeout))
+
+            time.sleep(self.copy_poll_interval)
+            response = self._request('head', uri, { 'x-ms-version': self.copy_version })
+            status = response.headers.get('x-ms-copy-status', 'success')
+
+        if status in ('failed', 'aborted'):
+            raise IOError('Copy of "%s" to "%s" %s: %s' % (url, uri, status,
+                                                           response.headers.get('x-ms-copy-status-description')))
+
+        return status
+
+    def move_blob(self, container, name, source_container, source_name, metadata = None):
+        """
+        Moves a blob within the storage account by copying it on the server side and deleting the source.
+        """
+        self.copy_blob(container, name, source_container, source_name, metadata)
+        return self.delete_blob(source_container, source_name)
+
+    def delete_blobs(self, container, names, max_connections = None):
+        """
+        Deletes many blobs with Blob Batch requests, each containing up to max_batch_size deletions. If the batch
+        endpoint is not available, or a batch fails despite retries, its blobs are deleted with concurrent single
+        requests instead.
+        :param names: names of the blobs to delete
+        :param max_connections: number of requests sent in parallel
+        :return: dict mapping each name to the HTTP status code of its deletion (202 if it was deleted, 404 if it
+                 didn't exist), or to the exception if no response was received
+        """
+        names = [_sanitize_blobname(name) for name in names]
+        batches = [names[i:i + self.max_batch_size] for i in range(0, len(names), self.max_batch_size)]
+        results = {}
+
+        if self._batch_supported:
+            def delete_batch(batch):
+                # deletions can be repeated, so failed batches are retried like single deletions
+                return self._batch(batch, [('delete', '/%s/%s' % (container, name)) for name in batch],
+                                   idempotent=True)
+
+            with ThreadPoolExecutor(max_workers=max_connections or self.max_connections) as executor:
+                futures = [executor.submit(delete_batch, batch) for batch in batches]
+
+            for batch, future in zip(batches, futures):
+                try:
+                    # operations without a response part are retried with single requests below
+                    results.update((name, status) for name, status in zip(batch, future.result()) if status)
+                except HTTPError as e:
+                    status = e.response.status_code
+                    if status in (404, 405, 501):
+                        # the service does not provide the batch endpoint at all
+                        self._batch_supported = False
+                    elif status == 400 and e.response.headers.get('x-ms-error-code') not in self.batch_error_codes:
+                        # e.g. a malformed request, which single requests would not fix either
+                        raise e
+                    # names of refused batches, or of batches that failed despite retries, are deleted one by one
+                except requests.RequestException:
+                    pass
+
+        remaining = [name for name in names if name not in results]
+        results.update(self._bulk(remaining, lambda name: self._request('delete', '/%s/%s' % (container, name)),
+                                  max_connections))
+        return results
+
+    def set_blob_metadata(self, container, name, metadata, etag = None):
+        """
+        Replaces the metadata of a blob with the given dict.
+        :param etag: if given, the metadata is only replaced if the blob still has this ETag. Otherwise an
+                     HTTPError 412 (Precondition Failed) is raised.
+        """
+        name = _sanitize_blobname(name)
+        headers = dict(self._metadata_headers(metadata), **{'If-Match': etag})
+        response = self._request('put', '/%s/%s' % (container, name), headers, {'comp': 'metadata'})
+        return response.status_code == 200 # OK
+
+    def set_blobs_metadata(self, container, metadata, max_connections = None):
+        """
+        Replaces the metadata of many blobs with concurrent requests (Blob Batch does not support this operation).
+        :param metadata: dict mapping blob names to their new metadata
+        :return: dict mapping each name to the HTTP status code of its update (200 on success), or to the exception
+                 if no response was received
+        """
+        metadata = { _sanitize_blobname(name): values for name, values in metadata.items() }
+        return self._bulk(list(metadata), lambda name: self._request(
+            'put', '/%s/%s' % (container, name), self._metadata_headers(metadata[name]), {'comp': 'metadata'}),
+            max_connections)
+
+    def set_blob_properties(self, container, name, content_type = None, content_encoding = None,
+                            content_language = None, cache_control = None):
+        """
+        Sets the system properties of a blob. Note that properties which are not given are cleared.
+        """
+        name = _sanitize_blobname(name)
+        headers = self._properties_headers(content_type, content_encoding, content_language, cache_control)
+        response = self._request('put', '/%s/%s' % (container, name), headers, {'comp': 'properties'})
+        return response.status_code == 200 # OK
+
+    def set_blobs_properties(self, container, names, content_type = None, content_encoding = None,
+                             content_language = None, cache_control = None, max_connections = None):
+        """
+        Sets the same system properties on many blobs with concurrent requests (Blob Batch does not support this
+        operation). Note that properties which are not given are cleared.
+        :return: dict mapping each name to the HTTP status code of its update (200 on success), or to the exception
+                 if no response was received
+        """
+        names = [_sanitize_blobname(name) for name in names]
+        headers = self._properties_headers(content_type, content_encoding, content_language, cache_control)
+        return self._bulk(names, lambda name: self._request(
+            'put', '/%s/%s' % (container, name), headers, {'comp': 'properties'}), max_connections)
+
+    @staticmethod
+    def _metadata_headers(metadata):
+        return { 'x-ms-meta-' + key: value for key, value in metadata.items() }
+
+    @staticmethod
+    def _properties_headers(content_type, content_encoding, content_language, cache_control):
+        return {
+            'x-ms-blob-content-type': content_type,
+            'x-ms-blob-content-encoding': content_encoding,
+            'x-ms-blob-content-language': content_language,
+            'x-ms-blob-cache-control': cache_control
+        }
+
+    def _bulk(self, names, request, max_connections = None):
+        """
+        Sends request(name) for every name concurrently and returns the status codes of the responses by name.
+        """
+        def status(name):
+            try:
+                return request(name).status_code
+            except HTTPError as e:
+                return e.response.status_code
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max_connections or self.max_connections) as executor:
+            return dict(zip(names, executor.map(status, names)))
+
+    def _batch(self, keys, operations, idempotent = None):
+        """
+        Sends the operations, given as (method, uri) tuples, in a single Blob Batch request. Each operation is
+        signed on its own. Returns the status codes of the operations in the given order.
+        :param idempotent: whether the batch may be retried, by default it is not
+        """
+        boundary = 'batch_' + uuid.uuid4().hex
+        date = self._headers()['x-ms-date']
+        parts = []
+
+        for index, (method, uri) in enumerate(operations):
+            path = urlsplit(self.get_url(uri)).path
+            headers = { 'x-ms-date': date }
+            headers['Authorization'] = self.auth.sign(method, self.get_url(uri), headers, {}, 0)
+
+            parts.append('--%s\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n'
+                         'Content-ID: %d\r\n\r\n%s %s HTTP/1.1\r\n%sContent-Length: 0\r\n\r\n'
+                         % (boundary, index, method.upper(), path,
+                            ''.join('%s: %s\r\n' % header for header in headers.items())))
+
+        content = (''.join(parts) + '--%s--\r\n' % boundary).encode('utf-8')
+        headers = {
+            'x-ms-version': self.batch_version,
+            'Content-Type': 'multipart/mixed; boundary=%s' % boundary
+        }
+
+        response = self._request('post', '/', headers, {'comp': 'batch'}, content, idempotent=idempotent)
+
+        # the response consists of one part per operation, identified by its Content-ID
+        statuses = [None] * len(operations)
+        response_boundary = response.headers['Content-Type'].split('boundary=', 1)[1].strip('"')
+
+        for part in response.content.split(b'--' + response_boundary.encode('ascii')):
+            content_id = re.search(br'Content-ID:\s*(\d+)', part, re.IGNORECASE)
+            status = re.search(br'HTTP/1\.\d (\d{3})', part)
+            if content_id and status:
+                statuses[int(content_id.group(1))] = int(status.group(1))
+
+        return statuses
+
     def get_blob_url(self, container, name, protocol=None):
         """
         Returns the URL that refers to the blob by this name in the given container.
         """
         return self.get_url('/%s/%s' % (container, name), protocol=protocol)
 
+    def get_blob_sas_url(self, container, name, permission = 'r', expiry = 3600, **options):
+        """
+        Returns the URL of the blob with a Shared Access Signature, which grants the permissions to anyone who has
+        the URL until it expires. The signature is computed locally, without a request to the service.
+        :param permission: the granted permissions, such as "r" for reading or "cw" for uploading
+        :param expiry: expiry as a datetime, or in seconds from now
+        Further options are those of SharedKeyAuthentication.shared_access_signature.
+        """
+        name = _sanitize_blobname(name)
+        params = self.auth.shared_access_signature(container, name, permission, expiry, **options)
+        return self.get_blob_url(container, name, options.get('protocol')) + '?' + urlencode(params)
+
+    def get_container_sas(self, container, permission = 'r', expiry = 3600, **options):
+        """
+        Returns the query string of a Shared Access Signature that grants the permissions on every blob of the
+        container, to be appended to their URLs. The signature cannot be restricted to a prefix, so it covers the
+        whole container. With permission "l" it also allows listing the container.
+        """
+        return urlencode(self.auth.shared_access_signature(container, None, permission, expiry, **options))
+
+    def get_upload_url(self, container, name, expiry = 3600, **options):
+        """
+        Returns a signed URL to which a client can upload the blob directly, with a PUT request of the content
+        that has the header "x-ms-blob-type: BlockBlob". Uploads from browsers additionally require CORS to be
+        enabled for PUT requests, see enable_cors.
+        """
+        return self.get_blob_sas_url(container, name, 'cw', expiry, **options)
+
     def get_blob(self, container, name, with_content = True):
         """
         Gets a blob including its properties and metadata.
         :param with_content: Determines whether the content should be fetched along with the properties and metadata
         """
-        name = self._sanitize_blobname(name)
+        name = _sanitize_blobname(name)
 
         try:
             response = self._request('get' if with_content else 'head', "/%s/%s" % (container, name))
@@ -204,7 +1295,8 @@ class BlobService(AzureService):
             response.raise_for_status()
 
         metadata = { key.replace("x-ms-meta-", ""): value for key, value in response.headers.items() if key.startswith('x-ms-meta-')}
-        blob = Blob(name, self.get_blob_url(container, name), properties = response.headers, metadata=metadata)
+        blob = Blob(name, self.get_blob_url(container, name), properties = response.headers, metadata=metadata,
+                    container=container, service=self)
 
         if with_content:
             blob.content = response.content
@@ -212,23 +1304,248 @@ class BlobService(AzureService):
         return blob
 
     def blob_exists(self, container, name):
-        url = self.get_blob_url(container, name, protocol='http')
-        session = requests.session()
-        session.mount('http://', HTTPAdapter(max_retries=5))
-        resp = session.head(url)
-        return resp.status_code == 200
+        return self.get_blob(container, name, with_content=False) is not None
 
-    def get_blob_content(self, container, name, text = False):
+    def get_blob_content(self, container, name, text = False, max_connections = None):
         """
         Directly downloads the content of a blob and by default returns the content as bytes.
         If text is set to True it will return the content as encoded text instead.
+        If max_connections is given the content is downloaded in parallel ranges and returned as a bytearray,
+        see download_blob. Encoded content is decoded in either case.
+        If the service has a content_cache, cached contents are only transferred again if the blob has changed.
         """
-        name = self._sanitize_blobname(name)
-        blob = Blob(name, self.get_url('/%s/%s' % (container, name)))
+        name = _sanitize_blobname(name)
+
+        if self.content_cache is not None:
+            content = self._get_cached_content(container, name)
+            return content.decode('utf-8-sig') if text else content
+
+        blob = Blob(name, self.get_url('/%s/%s' % (container, name)), container=container, service=self)
         if text:
             return blob.download_text()
         else:
-            return blob.download_bytes()
+            return blob.download_bytes(max_connections)
+
+    def _get_cached_content(self, container, name):
+        """ Returns the content of a blob from the content cache, validating it with the blob's ETag """
+        uri = '/%s/%s' % (container, name)
+
+        def download(etag):
+            try:
+                response = self._request('get', uri, headers={'If-None-Match': etag})
+            except HTTPError as e:
+                if e.response.status_code == 404:
+                    self.content_cache.invalidate(uri)
+                raise e
+
+            if response.status_code == 304: # Not Modified
+                return None
+            return response.headers.get('ETag'), response.content
+
+        return self.content_cache.fetch(uri, download)
+
+    def open_blob(self, container, name, read_ahead_size = None, decompress = False):
+        """
+        Opens a blob as a lazy, seekable binary file. Content is fetched in byte ranges as it is read,
+        at least read_ahead_size bytes at a time, so reading only parts of a large blob is cheap.
+        :param decompress: if True and the blob's content is gzip or brotli encoded, the file returns the decoded
+                           content. Such files are not seekable.
+        """
+        name = _sanitize_blobname(name)
+        buffer_size = read_ahead_size or self.read_ahead_size
+        reader = BlobReader(self, container, name, buffer_size)
+
+        if decompress:
+            # the properties are fetched along with the size
+            reader.size
+            encoding = reader.properties.get('Content-Encoding')
+            if encoding in ('gzip', 'deflate', 'br'):
+                return io.BufferedReader(DecompressingReader(io.BufferedReader(reader, buffer_size), encoding))
+
+        return io.BufferedReader(reader, buffer_size=buffer_size)
+
+    def download_blob(self, container, name, target = None, max_connections = None, chunk_size = None):
+        """
+        Downloads the content of a blob in ranges of chunk_size bytes, which are fetched in parallel and written
+        straight into the target as they arrive, without assembling the content in memory first.
+        :param target: a binary file opened for writing, which is written from its current position on, or a
+                       writable buffer that is large enough for the content, such as a bytearray or a mmap.
+                       If omitted, a bytearray of the blob's size is allocated.
+        :param max_connections: number of ranges that are downloaded in parallel
+        :param chunk_size: size of the downloaded ranges in bytes
+        :return: the target
+        """
+        return self._download_ranges(container, name, target, max_connections, chunk_size)[0]
+
+    def _download_ranges(self, container, name, target = None, max_connections = None, chunk_size = None):
+        """ Implements download_blob, additionally returning the headers of the first response """
+        name = _sanitize_blobname(name)
+        uri = '/%s/%s' % (container, name)
+        chunk_size = chunk_size or self.download_chunk_size
+
+        def get_range(start, end):
+            return self._request('get', uri, headers={'x-ms-range': 'bytes=%d-%d' % (start, end)}, stream=True)
+
+        # the response to the first range also reveals the total size of the blob
+        try:
+            response = get_range(0, chunk_size - 1)
+        except HTTPError as e:
+            if e.response.status_code != 416: # Requested range not satisfiable, i.e. empty blob
+                raise e
+            response, size, headers = None, 0, e.response.headers
+        else:
+            headers = response.headers
+            if response.status_code == 206: # Partial Content
+                size = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+            else:
+                size = int(response.headers['Content-Length'])
+
+        if target is None:
+            target = bytearray(size)
+
+        write = self._range_writer(target, size)
+
+        if response is not None:
+            with response:
+                write(0, min(size, chunk_size), response.raw)
+
+        def download(start):
+            end = min(start + chunk_size, size)
+            with get_range(start, end - 1) as response:
+                write(start, end - start, response.raw)
+
+        with ThreadPoolExecutor(max_workers=max_connections or self.max_connections) as executor:
+            futures = [executor.submit(download, start) for start in range(chunk_size, size, chunk_size)]
+
+        # re-raise the first error, if any
+        for future in futures:
+            future.result()
+
+        if write.end is not None:
+            # leave files positioned after the downloaded content
+            target.seek(write.end)
+
+        return target, headers
+
+    @staticmethod
+    def _range_writer(target, size):
+        """
+        Returns a function write(offset, length, stream) that reads length bytes from the stream into the target
+        at the given offset. It is safe to call from multiple threads at once.
+        """
+        if isinstance(target, mmap.mmap) or not hasattr(target, 'write'):
+            view = memoryview(target).cast('B')
+            if len(view) < size:
+                raise ValueError('Target buffer is too small for %d bytes' % size)
+
+            def write(offset, length, stream):
+                _readinto_exactly(stream, view[offset:offset + length])
+
+            write.end = None
+            return write
+
+        base = target.tell()
+        lock = threading.Lock()
+
+        try:
+            fileno = target.fileno()
+            target.flush()
+        except (AttributeError, OSError, ValueError):
+            fileno = None
+
+        def write(offset, length, stream):
+            buffer = bytearray(min(length, 64 * 1024))
+            position = base + offset
+
+            while length > 0:
+                chunk = memoryview(buffer)[:min(length, len(buffer))]
+                _readinto_exactly(stream, chunk)
+
+                if fileno is not None and hasattr(os, 'pwrite'):
+                    # positional writes don't interfere with each other
+                    os.pwrite(fileno, chunk, position)
+                else:
+                    with lock:
+                        target.seek(position)
+                        target.write(chunk)
+
+                position += len(chunk)
+                length -= len(chunk)
+
+        write.end = base + size
+        return write
+
+    def download_blobs(self, container, directory, prefix = None, max_connections = None, skip_unchanged = True,
+                       callback = None):
+        """
+        Downloads the blobs of a container into files below the directory, at the paths given by their names. The
+        container is listed page by page while a pool of workers streams each blob into a temporary file, which
+        replaces the target file once complete, so memory use is bounded however large the container is.
+        :param prefix: only download blobs whose names start with the prefix
+        :param max_connections: number of blobs downloaded in parallel
+        :param skip_unchanged: skip blobs whose file already exists with the same size and modification time.
+                               Downloaded files get the modification time of their blob.
+        :param callback: called as callback(blob, result) from the workers after each blob, e.g. to report progress
+        :return: dict mapping each name to "downloaded", "skipped" or the exception that prevented the download
+        """
+        directory = os.path.abspath(directory)
+        workers = max_connections or self.max_connections
+        # limits the listed blobs waiting for a worker
+        slots = threading.BoundedSemaphore(workers * 2)
+        results = {}
+
+        def export(blob):
+            try:
+                result = self._download_to_file(container, blob, directory, skip_unchanged)
+            except Exception as e:
+                result = e
+            finally:
+                slots.release()
+
+            results[blob.name] = result
+            if callback is not None:
+                callback(blob, result)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for blob in self.iter_blobs(container, prefix=prefix):
+                slots.acquire()
+                executor.submit(export, blob)
+
+        return results
+
+    def _download_to_file(self, container, blob, directory, skip_unchanged):
+        if blob.name.endswith('/'):
+            # placeholder of an empty directory
+            return 'skipped'
+
+        path = os.path.normpath(os.path.join(directory, *blob.name.split('/')))
+        if os.path.commonpath([directory, path]) != directory:
+            raise ValueError('Blob name "%s" leads outside of the directory' % blob.name)
+
+        mtime = blob.last_modified.timestamp() if blob.last_modified is not None else None
+
+        if skip_unchanged and mtime is not None:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                pass
+            else:
+                if stat.st_size == blob.content_length() and int(stat.st_mtime) == int(mtime):
+                    return 'skipped'
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                self.download_blob(container, blob.name, file, max_connections=1)
+            if mtime is not None:
+                os.utime(temp, (mtime, mtime))
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+        return 'downloaded'
 
     def enable_cors(self, origins, allowed_methods = None, max_age_seconds = None):
         """
@@ -239,42 +1556,7 @@ class BlobService(AzureService):
         :type allowed_methods: string|list|tuple
         :param max_age_seconds: how long to cache preflight answers
         """
-
-        if not allowed_methods:
-            allowed_methods = ['GET', 'PUT']
-
-        if not max_age_seconds:
-            max_age_seconds = 500
-
-        headers = {
-            'x-ms-version': '2013-08-15'
-        }
-
-        params = {
-            'restype': 'service',
-            'comp': 'properties'
-        }
-
-        if type(origins) is list or type(origins) is tuple:
-            origins = ",".join(origins)
-
-        if type(allowed_methods) is list or type(allowed_methods) is tuple:
-            allowed_methods = ",".join(allowed_methods)
-
-        content = '''<?xml version="1.0" encoding="utf-8"?>
-            <StorageServiceProperties>
-                <Cors>
-                    <CorsRule>
-                        <AllowedOrigins>{origins}</AllowedOrigins>
-                        <AllowedMethods>{methods}</AllowedMethods>
-                        <MaxAgeInSeconds>{age}</MaxAgeInSeconds>
-                        <ExposedHeaders>x-ms-meta-data*,x-ms-meta-customheader</ExposedHeaders>
-                        <AllowedHeaders>x-ms-meta-target*,x-ms-meta-customheader</AllowedHeaders>
-                    </CorsRule>
-                </Cors>
-                <DefaultServiceVersion>{version}</DefaultServiceVersion>
-            </StorageServiceProperties>'''.format(origins=origins, age=max_age_seconds,
-                                                  methods=allowed_methods, version=headers['x-ms-version'])
+        headers, params, content = _cors_request(origins, allowed_methods, max_age_seconds)
 
         try:
             response = self._request('put', '/', headers, params, content)
@@ -282,7 +1564,3 @@ class BlobService(AzureService):
             raise e
 
         return response.status_code == 202 # ACCEPTED
-
-    def _sanitize_blobname(self, blobname):
-        # on windows paths use backslashes, which is not compatible to URLs. So convert them to slashes.
-        return blobname.replace("\\", "/")
\ No newline at end of file
@@ -0,0 +1,234 @@
+"""
+This module implements caches that save round trips to the storage service.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class BlobMetadata:
+    """ The properties of a blob that are commonly queried, as cached by MetadataCache """
+
+    def __init__(self, exists, size = 0, last_modified = None, etag = None, content_md5 = None):
+        self.exists = exists
+        self.size = size
+        self.last_modified = last_modified
+        self.etag = etag
+        self.content_md5 = content_md5
+
+
+class MetadataCache:
+    """
+    A thread-safe in-process cache. Entries expire ttl seconds after they were stored, and once the cache holds
+    max_entries entries the least recently used ones are evicted.
+    """
+
+    def __init__(self, ttl = 60, max_entries = 10000, clock = time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the cached value for key, or None if there is no valid entry """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            if entry is not None:
+                del self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ Returns the number of hits, misses, evictions and entries as well as the hit ratio """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+class DiskCache:
+    """
+    A local cache of blob contents, validated with the blobs' ETags. Each entry is stored in a file of its own,
+    which is written to a temporary file first and then atomically moved into place, so that multiple processes
+    can share the same directory. Once the entries exceed max_size bytes, the least recently used ones are evicted.
+    """
+
+    # prefix of files that are still being written
+    TEMP_PREFIX = '.tmp-'
+
+    def __init__(self, directory, max_size = 1024 * 1024 * 1024, max_entry_size = None):
+        """
+        :param directory: directory holding the cached contents, created if necessary
+        :param max_size: maximum total size of the cached contents in bytes
+        :param max_entry_size: contents larger than this are not cached, by default a tenth of max_size
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size if max_entry_size is not None else max_size // 10
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """ Returns the ETag and content cached for key, or None """
+        try:
+            with open(self._path(key), 'rb') as file:
+                etag = file.readline()[:-1].decode('utf-8')
+                return etag, file.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, etag, content):
+        """ Stores the content of a blob along with its ETag """
+        if len(content) > self.max_entry_size:
+            return
+
+        fd, temp = tempfile.mkstemp(dir=self.directory, prefix=self.TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(etag.encode('utf-8') + b'\n')
+                file.write(content)
+            os.replace(temp, self._path(key))
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+        with self._lock:
+            if self._size is not None:
+                self._size += len(content)
+            if self._size is None or self._size > self.max_size:
+                self._evict()
+
+    def fetch(self, key, download):
+        """
+        Returns the content for key, validating a cached entry or downloading it if necessary.
+        :param download: called with the ETag of the cached entry or None. Returns None if the cached entry is
+                         still valid, otherwise the ETag and content of the blob.
+        """
+        entry = self.get(key)
+        result = download(entry[0] if entry is not None else None)
+
+        if result is None and entry is not None:
+            self._touch(key)
+            with self._lock:
+                self.hits += 1
+            return entry[1]
+
+        with self._lock:
+            self.misses += 1
+
+        etag, content = result
+        if etag:
+            self.set(key, etag, content)
+        return content
+
+    def _touch(self, key):
+        # the modification time of the entries reflects their last use, even across processes
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def invalidate(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            for entry in self._entries():
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+            self._size = 0
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.directory)
+                if entry.is_file() and not entry.name.startswith(self.TEMP_PREFIX)]
+
+    def _stat_entries(self):
+        """ Returns modification time, size and path of all entries """
+        entries = []
+        for entry in self._entries():
+            try:
+                entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+            except FileNotFoundError:
+                pass
+        return entries
+
+    def _evict(self):
+        """ Removes the least recently used entries until the cache fits into max_size """
+        entries = self._stat_entries()
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+        self._size = size
+
+    def stats(self):
+        """ Returns the number of hits, misses and evictions, the size of the cached contents and the hit ratio """
+        with self._lock:
+            if self._size is None:
+                # only measured, entries are evicted when the next content is stored
+                self._size = sum(entry_size for _, entry_size, _ in self._stat_entries())
+
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': self._size,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
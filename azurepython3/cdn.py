@@ -0,0 +1,47 @@
+"""
+This module implements the caching headers and CDN URLs of blobs that are served to browsers. Headers such as
+Cache-Control are chosen by rules that match the name or the MIME type of a blob:
+
+    cache_control = HeaderRules({'static/': 'public, max-age=31536000, immutable', 'image/*': 'public, max-age=86400'})
+    svc.create_blob('container', 'static/app.js', file, cache_control=cache_control.value_for('static/app.js'))
+    cdn_url('https://cdn.example.com', svc.get_blob_url('container', 'static/app.js'))
+"""
+import fnmatch
+import mimetypes
+from urllib.parse import quote, urlsplit
+
+
+class HeaderRules:
+    """
+    Chooses the value of a header for a blob by rules, which map name prefixes such as "static/" or MIME type
+    patterns such as "image/*" to values. The first matching rule applies.
+    """
+
+    def __init__(self, rules):
+        """
+        :param rules: dict or sequence of (prefix or pattern, value) pairs
+        """
+        self.rules = list(rules.items()) if hasattr(rules, 'items') else list(rules)
+
+    def value_for(self, name, content_type = None):
+        """ Returns the value for the blob, or None if no rule matches. The MIME type is guessed if omitted. """
+        if content_type is None:
+            content_type = mimetypes.guess_type(name)[0]
+
+        for rule, value in self.rules:
+            if name.startswith(rule) or (content_type and fnmatch.fnmatchcase(content_type, rule)):
+                return value
+        return None
+
+
+def cdn_url(host, url, version = None):
+    """
+    Returns the URL of a blob, as given by BlobService.get_blob_url, on a CDN whose origin is the storage account,
+    such as "https://cdn.example.com". A version, such as a hash of the content, is added to the query string, so
+    that changed content gets a new URL and cached copies can be kept for a long time.
+    """
+    parts = urlsplit(url)
+    url = host.rstrip('/') + parts.path
+    if version:
+        url += '?v=' + quote(version, safe='')
+    return url
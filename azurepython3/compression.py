@@ -0,0 +1,180 @@
+"""
+This module implements the streaming compression of blob contents on upload and their decompression on download.
+Contents are compressed with gzip, or with brotli if the brotli package is installed and requested, depending on
+their MIME type:
+
+    compression = Compression(encoding='br', types=('text/*', 'application/json'))
+    svc.create_blob('container', 'data.json', file, compress=compression)
+"""
+import fnmatch
+import io
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# MIME types of contents that compress well, as patterns
+COMPRESSIBLE_TYPES = (
+    'text/*',
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/rss+xml',
+    'application/atom+xml',
+    'image/svg+xml',
+    'image/x-icon',
+    'font/ttf',
+    'font/otf',
+)
+
+# content encodings that can be applied
+ENCODINGS = ('gzip', 'br')
+
+
+class Compression:
+    """ Decides whether and how contents are compressed, based on their MIME types """
+
+    def __init__(self, encoding = 'gzip', types = COMPRESSIBLE_TYPES, level = None):
+        """
+        :param encoding: "gzip", or "br" for brotli. Falls back to gzip if the brotli package is not installed.
+        :param types: MIME types that are compressed, as patterns such as "text/*"
+        :param level: compression level, by default 6 for gzip and 5 for brotli
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError('Unsupported content encoding %r' % encoding)
+
+        self.encoding = encoding if encoding != 'br' or brotli is not None else 'gzip'
+        self.types = tuple(types)
+        self.level = level
+
+    def encoding_for(self, content_type):
+        """ Returns the content encoding to apply to content of the given MIME type, or None """
+        if content_type and any(fnmatch.fnmatchcase(content_type, pattern) for pattern in self.types):
+            return self.encoding
+        return None
+
+    def compressor(self, encoding):
+        if encoding == 'br':
+            return _BrotliCompressor(self.level if self.level is not None else 5)
+        return zlib.compressobj(self.level if self.level is not None else 6, zlib.DEFLATED, 31)
+
+
+class _BrotliCompressor:
+    """ Adapts brotli.Compressor to the interface of zlib's compress objects """
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+class _BrotliDecompressor:
+    """ Adapts brotli.Decompressor to the interface of zlib's decompress objects """
+
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, data):
+        return self._decompressor.process(data)
+
+    def flush(self):
+        return b''
+
+
+def _decompressor(encoding):
+    if encoding == 'br':
+        if brotli is None:
+            raise ImportError('Decompressing brotli encoded content requires the brotli package')
+        return _BrotliDecompressor()
+
+    if encoding in ('gzip', 'deflate'):
+        # detect gzip and zlib headers automatically
+        return zlib.decompressobj(47)
+
+    raise ValueError('Unsupported content encoding %r' % encoding)
+
+
+def decompress(content, encoding):
+    """ Returns the decompressed content, or the content itself if it is not encoded """
+    if not encoding or encoding == 'identity':
+        return content
+    return _decompressor(encoding).decompress(content)
+
+
+class _TransformingReader(io.RawIOBase):
+    """ A file object that reads a source file in chunks and returns them transformed """
+
+    # bytes read from the source at a time
+    chunk_size = 64 * 1024
+
+    def __init__(self, source):
+        self.source = source
+        self._pending = bytearray()
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        # fill the buffer as far as possible, so that uploads get blocks of the full size
+        view = memoryview(buffer).cast('B')
+
+        while len(self._pending) < len(view) and not self._eof:
+            chunk = self.source.read(self.chunk_size)
+            if chunk:
+                self._pending += self._transform(chunk)
+            else:
+                self._pending += self._finish()
+                self._eof = True
+
+        count = min(len(view), len(self._pending))
+        view[:count] = self._pending[:count]
+        del self._pending[:count]
+        return count
+
+    def _transform(self, chunk):
+        raise NotImplementedError
+
+    def _finish(self):
+        raise NotImplementedError
+
+
+class CompressingReader(_TransformingReader):
+    """ Reads the content of a binary file or bytes-like object compressed """
+
+    def __init__(self, source, compressor):
+        if not hasattr(source, 'read'):
+            source = io.BytesIO(source)
+        super().__init__(source)
+        self._compressor = compressor
+
+    def _transform(self, chunk):
+        return self._compressor.compress(chunk)
+
+    def _finish(self):
+        return self._compressor.flush()
+
+
+class DecompressingReader(_TransformingReader):
+    """ Reads the decompressed content of a binary file with gzip or brotli encoded content """
+
+    def __init__(self, source, encoding):
+        super().__init__(source)
+        self._decompressor = _decompressor(encoding)
+
+    def _transform(self, chunk):
+        return self._decompressor.decompress(chunk)
+
+    def _finish(self):
+        return self._decompressor.flush()
+
+    def close(self):
+        self.source.close()
+        super().close()
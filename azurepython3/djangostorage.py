@@ -1,11 +1,18 @@
 """
 This module implements a custom Django storage based on the BlobService.
 """
-import os
-from tempfile import SpooledTemporaryFile
+import base64
+import io
+import posixpath
+from django.core.exceptions import SuspiciousFileOperation
 from django.core.files import File
+from django.utils.crypto import get_random_string
 from requests import HTTPError
-from azurepython3.blobservice import BlobService
+from azurepython3.blobservice import BlobPrefix, BlobService, content_md5
+from azurepython3.cache import BlobMetadata, DiskCache, MetadataCache
+from azurepython3.cdn import HeaderRules, cdn_url
+from azurepython3.compression import Compression, COMPRESSIBLE_TYPES
+from azurepython3.sharding import HashRing, transfer_blob
 from datetime import datetime
 
 try:
@@ -22,9 +29,34 @@ except ImportError:
 
 class AzureStorage(Storage):
 
-    def __init__(self, container = None, account_name = None, account_key = None):
+    # metadata key holding the number of saved files that share a deduplicated blob
+    REFERENCES_KEY = 'references'
+
+    def __init__(self, container = None, account_name = None, account_key = None, metadata_cache_ttl = None,
+                 content_cache_dir = None, deduplicate = None, compression = None, url_expiry = None,
+                 cache_control = None, content_disposition = None, cdn_host = None, cdn_versioning = None):
         """
         Creates a new AzureStorage. The container is not automatically created and therefore must already exist.
+        :param metadata_cache_ttl: if given, existence, size and modification time of blobs are cached for that
+                                   many seconds (see also the AZURE_METADATA_CACHE_TTL setting)
+        :param content_cache_dir: if given, opened files are cached in that directory and only downloaded again
+                                  once they changed (see also the AZURE_CONTENT_CACHE_DIR setting)
+        :param deduplicate: if True, files are stored under the MD5 hash of their content, and files that are
+                            already stored are not uploaded again (see also the AZURE_DEDUPLICATE setting)
+        :param compression: "gzip" or "br" to compress files of compressible types when saving them (see also the
+                            AZURE_COMPRESSION setting). Compressed files are decompressed when opened in any case.
+        :param url_expiry: if given, url() returns URLs with a Shared Access Signature that allows reading the file
+                           for that many seconds, as needed for private containers (see also the AZURE_URL_EXPIRY
+                           setting)
+        :param cache_control: Cache-Control headers of saved files, as a dict mapping name prefixes or MIME type
+                              patterns to values (see also the AZURE_CACHE_CONTROL setting and HeaderRules)
+        :param content_disposition: Content-Disposition headers of saved files, in the same form (see also the
+                                    AZURE_CONTENT_DISPOSITION setting)
+        :param cdn_host: if given, url() returns unsigned URLs on this CDN host, such as "https://cdn.example.com"
+                         (see also the AZURE_CDN_HOST setting)
+        :param cdn_versioning: if True, CDN URLs include a hash of the file's content (see also the
+                               AZURE_CDN_VERSIONING setting). The hash is read from the file's properties, so
+                               this requires the metadata cache.
         """
         if container is None:
             if hasattr(settings, 'AZURE_DEFAULT_CONTAINER'):
@@ -35,59 +67,441 @@ class AzureStorage(Storage):
             self.container = container
 
         if account_name and account_key:
-            self.service = BlobService(account_name, account_key)
+            self.service = self._create_service(account_name, account_key)
+        else:
+            self.service = self._create_service(settings.AZURE_ACCOUNT_NAME, settings.AZURE_ACCOUNT_KEY)
+
+        if metadata_cache_ttl is None:
+            metadata_cache_ttl = getattr(settings, 'AZURE_METADATA_CACHE_TTL', None)
+
+        if metadata_cache_ttl:
+            self.metadata_cache = MetadataCache(metadata_cache_ttl, getattr(settings, 'AZURE_METADATA_CACHE_SIZE', 10000))
+        else:
+            self.metadata_cache = None
+
+        if content_cache_dir is None:
+            content_cache_dir = getattr(settings, 'AZURE_CONTENT_CACHE_DIR', None)
+
+        if content_cache_dir:
+            self.service.content_cache = DiskCache(content_cache_dir,
+                                                   getattr(settings, 'AZURE_CONTENT_CACHE_SIZE', 1024 * 1024 * 1024))
+
+        if deduplicate is None:
+            deduplicate = getattr(settings, 'AZURE_DEDUPLICATE', False)
+        self.deduplicate = deduplicate
+
+        if compression is None:
+            compression = getattr(settings, 'AZURE_COMPRESSION', None)
+
+        if compression:
+            self.compression = Compression(compression, getattr(settings, 'AZURE_COMPRESSION_TYPES', COMPRESSIBLE_TYPES))
         else:
-            self.service = BlobService(settings.AZURE_ACCOUNT_NAME, settings.AZURE_ACCOUNT_KEY)
+            self.compression = None
+
+        if url_expiry is None:
+            url_expiry = getattr(settings, 'AZURE_URL_EXPIRY', None)
+        self.url_expiry = url_expiry
+
+        if cache_control is None:
+            cache_control = getattr(settings, 'AZURE_CACHE_CONTROL', None)
+        self.cache_control = HeaderRules(cache_control) if cache_control else None
+
+        if content_disposition is None:
+            content_disposition = getattr(settings, 'AZURE_CONTENT_DISPOSITION', None)
+        self.content_disposition = HeaderRules(content_disposition) if content_disposition else None
+
+        if cdn_host is None:
+            cdn_host = getattr(settings, 'AZURE_CDN_HOST', None)
+        self.cdn_host = cdn_host
+
+        if cdn_versioning is None:
+            cdn_versioning = getattr(settings, 'AZURE_CDN_VERSIONING', False)
+        if cdn_host and cdn_versioning and self.metadata_cache is None:
+            # otherwise every call of url() would send a request for the file's properties
+            raise ValueError('CDN versioning requires the metadata cache, see the AZURE_METADATA_CACHE_TTL setting')
+        self.cdn_versioning = cdn_versioning
 
     def _transform_name(self, name):
         return name.replace("\\", "/")
 
     def _open(self, name, mode = 'rb') -> File:
         name = self._transform_name(name)
-        content = self.service.get_blob_content(self.container, name)
-        file = SpooledTemporaryFile()
-        file.write(content)
-        file.seek(0) # explicitly reset to allow reading from the beginning afterwards as-is
 
-        return File(file)
+        service = self._locate(name)
+
+        if service.content_cache is not None and self._metadata(name).size <= service.content_cache.max_entry_size:
+            # encoded content is already decoded when it is downloaded completely
+            return File(io.BytesIO(service.get_blob_content(self.container, name)), name)
+
+        # the content is fetched lazily in ranges as the file is read, so files too large to be cached are not
+        # loaded into memory. Whether it is decompressed depends on the blob's content encoding, not on the
+        # current settings, which may have changed since it was saved.
+        file = File(service.open_blob(self.container, name, decompress=True), name)
+        if not file.file.seekable():
+            # the decoded size of decompressed files is unknown until they are read, and Django would try to seek
+            file.size = None
+        return file
 
     def _save(self, name, content):
         name = self._transform_name(name)
         content.open(mode='rb')
-        data = bytearray(content.read())
-        self.service.create_blob(self.container, name, data)
+
+        if self.deduplicate:
+            return self._save_deduplicated(name, content)
+
+        # the content is streamed to the service, so large files don't have to be loaded into memory
+        self._service(name).create_blob(self.container, name, content, compress=self.compression,
+                                        **self._upload_headers(name))
+        self._invalidate(name)
+        return name
+
+    def _upload_headers(self, name):
+        """ Returns the Cache-Control and Content-Disposition headers of a file by the configured rules """
+        return {
+            'cache_control': self.cache_control.value_for(name) if self.cache_control else None,
+            'content_disposition': self.content_disposition.value_for(name) if self.content_disposition else None
+        }
+
+    def _save_deduplicated(self, name, content):
+        """
+        Saves the content under the MD5 hash of its content, in the directory and with the extension of the given
+        name. If a blob with the same hash and size is already stored, it is not uploaded again.
+        """
+        md5, size = content_md5(content)
+        dir_name, file_name = posixpath.split(name)
+        name = posixpath.join(dir_name, base64.b64decode(md5).hex() + posixpath.splitext(file_name)[1])
+
+        service = self._service(name)
+        existing = service.get_blob(self.container, name, with_content=False)
+        if existing is not None:
+            # compressed blobs can't be compared, but their name already identifies their content
+            if existing.properties.get('Content-Encoding') or (
+                    existing.properties.get('Content-MD5') == md5 and existing.content_length() == size):
+                if self._change_references(service, name, 1, existing) is not None:
+                    return name
+
+        service.create_blob(self.container, name, content, content_md5=md5, compress=self.compression,
+                            **self._upload_headers(name))
+        self._invalidate(name)
+        return name
+
+    def _change_references(self, service, name, change, blob = None):
+        """
+        Changes the number of saved files that share a deduplicated blob, which is kept in its metadata. Blobs
+        without the count are referenced once. A blob is deleted once its last reference is removed. The update
+        is conditional on the blob's ETag and repeated if the blob was changed concurrently.
+        :return: the remaining number of references, or None if the blob does not exist
+        """
+        while True:
+            if blob is None:
+                blob = service.get_blob(self.container, name, with_content=False)
+                if blob is None:
+                    return None
+
+            references = int(blob.metadata.get(self.REFERENCES_KEY, 1)) + change
+            try:
+                if references > 0:
+                    service.set_blob_metadata(self.container, name, dict(blob.metadata, **{
+                        self.REFERENCES_KEY: str(references)}), etag=blob.properties.get('ETag'))
+                else:
+                    service.delete_blob(self.container, name, etag=blob.properties.get('ETag'))
+                return references
+            except HTTPError as e:
+                if e.response.status_code not in (404, 412):
+                    raise e
+                blob = None
+
+    def get_available_name(self, name, max_length = None):
+        """
+        Returns a name that is free in the container. Instead of checking candidates one by one, all names
+        starting like the given one are fetched with a single listing.
+        """
+        name = self._transform_name(name)
+        if self.deduplicate:
+            # the name is derived from the content when saving
+            return name
+
+        dir_name, file_name = posixpath.split(name)
+        file_root, file_ext = posixpath.splitext(file_name)
+        taken = self._names(posixpath.join(dir_name, file_root))
+
+        while name in taken or (max_length and len(name) > max_length):
+            name = posixpath.join(dir_name, '%s_%s%s' % (file_root, get_random_string(7), file_ext))
+
+            if max_length is not None and len(name) > max_length:
+                truncation = len(name) - max_length
+                file_root = file_root[:-truncation]
+                if not file_root:
+                    raise SuspiciousFileOperation('Storage can not find an available filename for "%s". Please make '
+                                                  'sure that the corresponding file field allows sufficient '
+                                                  '"max_length".' % name)
+                name = posixpath.join(dir_name, '%s_%s%s' % (file_root, get_random_string(7), file_ext))
+                taken = self._names(posixpath.join(dir_name, file_root))
+
         return name
 
+    def _names(self, prefix):
+        """ Returns the set of names of the files starting with the prefix in its directory """
+        return set(entry.name for service in self._services()
+                   for entry in service.iter_blobs(self.container, prefix=prefix, delimiter='/')
+                   if not isinstance(entry, BlobPrefix))
+
     def delete(self, name):
+        """
+        Deletes a file. With deduplication, a blob saved for several files is only deleted with the last of them.
+        """
         name = self._transform_name(name)
-        self.service.delete_blob(self.container, name)
+        if self.deduplicate:
+            self._change_references(self._locate(name), name, -1)
+        else:
+            self._locate(name).delete_blob(self.container, name)
+        self._invalidate(name)
         return name
 
+    def copy(self, name, target_name):
+        """ Copies a file on the server side and returns the name of the copy """
+        name = self._transform_name(name)
+        target_name = self._transform_name(target_name)
+        self._copy(name, target_name)
+        if self.deduplicate:
+            # the copy is a file of its own, not another reference to the blob it was copied from
+            self._drop_references(target_name)
+        self._invalidate(target_name)
+        return target_name
+
+    def _copy(self, name, target_name):
+        self.service.copy_blob(self.container, target_name, self.container, name)
+
+    def _drop_references(self, name):
+        """ Removes the reference count that a blob took over from the blob it was copied from """
+        service = self._service(name)
+        blob = service.get_blob(self.container, name, with_content=False)
+        if blob is not None and self.REFERENCES_KEY in blob.metadata:
+            metadata = { key: value for key, value in blob.metadata.items() if key != self.REFERENCES_KEY }
+            service.set_blob_metadata(self.container, name, metadata, etag=blob.properties.get('ETag'))
+
+    def move(self, name, target_name):
+        """ Moves a file on the server side and returns its new name """
+        target_name = self.copy(name, target_name)
+        self.delete(name)
+        return target_name
+
     def exists(self, name):
         if not name:
             return False
         name = self._transform_name(name)
-        return self.service.blob_exists(self.container, name)
+
+        if self.metadata_cache is not None:
+            return self._metadata(name).exists
+
+        return self._find(name)[1] is not None
 
     def listdir(self, path = None):
-        path = self._transform_name(path)
-        blobs = self.service.list_blobs(self.container, prefix = path)
-        paths = [os.path.split(blob.name) for blob in blobs]
-        dirs = [path[0] for path in paths]
-        files = [path[1] for path in paths]
+        """
+        Lists the immediate subdirectories and files of a directory. Only the entries of the directory itself are
+        listed, however many blobs are stored below it.
+        """
+        path = self._transform_name(path or '').strip('/')
+        prefix = path + '/' if path else None
+        dirs, files = [], []
+
+        for service in self._services():
+            for entry in service.iter_blobs(self.container, prefix=prefix, delimiter='/'):
+                name = entry.name[len(prefix or ''):]
+                if isinstance(entry, BlobPrefix):
+                    dirs.append(name.rstrip('/'))
+                else:
+                    files.append(name)
+
+        if len(self._services()) > 1:
+            # a directory can have blobs on several accounts, and blobs that are being moved are on two of them
+            dirs = sorted(set(dirs))
+            files = sorted(set(files))
+
         return (dirs, files)
 
     def size(self, name):
         name = self._transform_name(name)
-        blob = self.service.get_blob(self.container, name, with_content=False)
-        return blob.content_length() if blob != None else 0
+        return self._metadata(name).size
+
+    def url(self, name, expiry = None):
+        """
+        Returns the URL of a file. If an expiry in seconds is given or configured, the URL is signed and allows
+        reading the file until then. Otherwise it refers to the CDN host, if configured.
+        """
+        name = self._transform_name(name)
+        expiry = expiry or self.url_expiry
+
+        if expiry:
+            return self._locate(name).get_blob_sas_url(self.container, name, 'r', expiry)
 
-    def url(self, name):
+        url = self._locate(name).get_blob_url(self.container, name)
+
+        if self.cdn_host:
+            return cdn_url(self.cdn_host, url, self._version(name) if self.cdn_versioning else None)
+
+        return url
+
+    def upload_url(self, name, expiry = 3600):
+        """
+        Returns a signed URL to which a client can upload a file directly within the given number of seconds,
+        with a PUT request that has the header "x-ms-blob-type: BlockBlob". The name should be made available
+        with get_available_name first.
+        """
         name = self._transform_name(name)
-        return self.service.get_blob_url(self.container, name)
+        return self._service(name).get_upload_url(self.container, name, expiry)
+
+    def _version(self, name):
+        """ Returns a short hash of the file's content, or of its ETag if the service stored no Content-MD5 """
+        metadata = self._metadata(name)
+        if metadata.content_md5:
+            return base64.b64decode(metadata.content_md5).hex()[:12]
+        if metadata.etag:
+            return metadata.etag.strip('"').lower()[-12:]
+        return None
 
     def modified_time(self, name):
         name = self._transform_name(name)
-        blob = self.service.get_blob(self.container, name, with_content=False)
-        return datetime.strptime(blob.properties['Last-Modified'], "%a, %d %b %Y %H:%M:%S GMT")
+        metadata = self._metadata(name)
+        if not metadata.exists:
+            raise FileNotFoundError('Blob "%s" does not exist in container "%s"' % (name, self.container))
+        return metadata.last_modified
+
+    def _metadata(self, name) -> BlobMetadata:
+        """ Returns existence, size, modification time and ETag of a blob, fetched with a single HEAD request """
+        if self.metadata_cache is not None:
+            metadata = self.metadata_cache.get((self.container, name))
+            if metadata is not None:
+                return metadata
+
+        blob = self._find(name)[1]
+        if blob is None:
+            metadata = BlobMetadata(False)
+        else:
+            last_modified = datetime.strptime(blob.properties['Last-Modified'], "%a, %d %b %Y %H:%M:%S GMT")
+            metadata = BlobMetadata(True, blob.content_length(), last_modified, blob.properties.get('ETag'),
+                                    blob.properties.get('Content-MD5'))
+
+        if self.metadata_cache is not None:
+            self.metadata_cache.set((self.container, name), metadata)
+
+        return metadata
+
+    def _invalidate(self, name):
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate((self.container, name))
+        content_cache = self._service(name).content_cache
+        if content_cache is not None:
+            content_cache.invalidate('/%s/%s' % (self.container, name))
+
+    def _create_service(self, account_name, account_key) -> BlobService:
+        # a custom endpoint can be configured, e.g. for a local emulator
+        return BlobService(account_name, account_key, endpoint=getattr(settings, 'AZURE_BLOB_ENDPOINT', None))
+
+    def _service(self, name) -> BlobService:
+        """ Returns the service of the account that the blob is placed on, to which it is saved """
+        return self.service
+
+    def _locate(self, name) -> BlobService:
+        """ Returns the service of the account that stores the blob, from which it is read """
+        return self._service(name)
+
+    def _find(self, name):
+        """ Returns the service of the account that stores the blob and its properties, or None if it doesn't exist """
+        service = self._service(name)
+        return service, service.get_blob(self.container, name, with_content=False)
+
+    def _services(self):
+        """ Returns the services of all accounts that store blobs of this storage """
+        return [self.service]
+
+
+def shard_services(shards, **options):
+    """
+    Returns a BlobService for every shard, by account name. Shards are dicts with "account_name", "account_key"
+    and optionally "endpoint", which defaults to the AZURE_BLOB_ENDPOINT setting.
+    """
+    endpoint = getattr(settings, 'AZURE_BLOB_ENDPOINT', None)
+    return {shard['account_name']: BlobService(shard['account_name'], shard['account_key'],
+                                               endpoint=shard.get('endpoint', endpoint), **options)
+            for shard in shards}
+
+
+class ShardedAzureStorage(AzureStorage):
+    """
+    An AzureStorage that distributes files over several storage accounts, so that their request and bandwidth
+    limits add up. Each file is placed on an account chosen by consistent hashing of its name, and every account
+    must have the container. After changing the accounts, run the "azurerebalance" command to move the files
+    that are placed on a different account now. Until it completes, files that are not moved yet are only found
+    with fallback enabled.
+    """
+
+    def __init__(self, container = None, shards = None, retired_shards = None, fallback = None, **options):
+        """
+        :param shards: list of dicts with "account_name", "account_key" and optionally "endpoint" of each
+                       account (see also the AZURE_SHARDS setting)
+        :param retired_shards: accounts in the same form that are going to be removed, whose files are still read
+                               and listed until they are moved (see also the AZURE_RETIRED_SHARDS setting)
+        :param fallback: if True, files that are missing on their account are looked for on the retired and the
+                         other accounts, which costs a request per account for files that don't exist, and files
+                         are located with a request before reading them or returning their URL (see also the
+                         AZURE_SHARD_FALLBACK setting). Enable it while the accounts are rebalanced.
+        Further options are the same as for AzureStorage.
+        """
+        if shards is None:
+            shards = getattr(settings, 'AZURE_SHARDS', None)
+        if not shards:
+            raise ValueError('ShardedAzureStorage requires at least one shard, see the AZURE_SHARDS setting')
+
+        if retired_shards is None:
+            retired_shards = getattr(settings, 'AZURE_RETIRED_SHARDS', None) or []
+        if fallback is None:
+            fallback = getattr(settings, 'AZURE_SHARD_FALLBACK', False)
+        self.fallback = fallback
+
+        self.services = shard_services(shards)
+        self.retired_services = shard_services(retired_shards)
+        self.ring = HashRing(self.services)
+
+        first = shards[0]
+        super().__init__(container, first['account_name'], first['account_key'], **options)
+
+        # all shards share the content cache set up on the first shard's service
+        for service in self._services():
+            service.content_cache = self.service.content_cache
+
+    def _create_service(self, account_name, account_key) -> BlobService:
+        return self.services[account_name]
+
+    def _service(self, name) -> BlobService:
+        return self.services[self.ring.node_for(name)]
+
+    def _locate(self, name) -> BlobService:
+        if not self.fallback:
+            return self._service(name)
+        return self._find(name)[0]
+
+    def _find(self, name):
+        service = self._service(name)
+        blob = service.get_blob(self.container, name, with_content=False)
+        if blob is not None or not self.fallback:
+            return service, blob
+
+        # while the accounts are rebalanced, the blob may still be on a retired account or its previous account
+        for other in self.retired_services.values():
+            blob = other.get_blob(self.container, name, with_content=False)
+            if blob is not None:
+                return other, blob
+        for other in self.services.values():
+            if other is not service:
+                blob = other.get_blob(self.container, name, with_content=False)
+                if blob is not None:
+                    return other, blob
+
+        return service, None
+
+    def _services(self):
+        return list(self.services.values()) + list(self.retired_services.values())
 
+    def _copy(self, name, target_name):
+        transfer_blob(self._locate(name), self._service(target_name), self.container, name, target_name)
@@ -0,0 +1,652 @@
+"""
+This module implements an in-memory stand-in for the Windows Azure Blob service. It speaks the subset of the
+REST API that this library uses, so BlobService and AzureStorage can be tested and benchmarked offline. Latency,
+bandwidth and throttling of the storage account can be simulated.
+
+The emulator can be run in-process:
+
+    with BlobEmulator(latency=0.01) as emulator:
+        svc = emulator.service()
+        svc.create_container('test')
+
+or as a standalone server on localhost, e.g. for a BlobService(..., endpoint="http://127.0.0.1:10000"):
+
+    python -m azurepython3.emulator --port 10000
+"""
+import argparse
+import base64
+import hashlib
+import random
+import re
+import threading
+import time
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, unquote, quote
+from xml.sax.saxutils import escape
+from azurepython3.auth import SharedKeyAuthentication
+from azurepython3.blobservice import BlobService
+
+
+class StorageError(Exception):
+    """ An error response of the emulated service """
+
+    def __init__(self, status, code, message = '', headers = None):
+        super().__init__(message or code)
+        self.status = status
+        self.code = code
+        self.message = message or code
+        self.headers = headers or {}
+
+
+class EmulatedBlob:
+
+    def __init__(self, content = b'', blob_type = 'BlockBlob'):
+        self.content = bytearray(content)
+        self.blob_type = blob_type
+        self.properties = {}
+        self.metadata = {}
+        # id, source and completion time of the copy that created the blob, if any
+        self.copy = None
+        # number of blocks appended to an append blob
+        self.committed_blocks = 0
+        self.touch()
+
+    def touch(self):
+        self.etag = '"0x%s"' % uuid.uuid4().hex[:15].upper()
+        self.last_modified = formatdate(usegmt=True)
+
+
+class EmulatedContainer:
+
+    def __init__(self, access = None, metadata = None):
+        self.access = access
+        self.metadata = metadata or {}
+        self.blobs = {}
+        # uncommitted blocks by blob name and block id
+        self.blocks = {}
+        self.etag = '"0x%s"' % uuid.uuid4().hex[:15].upper()
+        self.last_modified = formatdate(usegmt=True)
+
+
+# blob properties that are returned as response headers, with the request headers that set them
+BLOB_PROPERTIES = (
+    ('Content-Type', 'x-ms-blob-content-type'),
+    ('Content-Encoding', 'x-ms-blob-content-encoding'),
+    ('Content-Language', 'x-ms-blob-content-language'),
+    ('Content-MD5', 'x-ms-blob-content-md5'),
+    ('Cache-Control', 'x-ms-blob-cache-control'),
+    ('Content-Disposition', 'x-ms-blob-content-disposition'),
+)
+
+
+class BlobEmulator:
+    """
+    An in-memory Blob service running on a local HTTP server.
+    :param latency: seconds added to every response
+    :param bandwidth: bytes per second at which request and response bodies are transferred, per request
+    :param throttle_rate: fraction of requests that are randomly rejected with 503 ServerBusy
+    :param max_requests_per_second: requests beyond this rate are rejected with 503 ServerBusy
+    :param account_key: account key that requests are signed with (by default BlobEmulator.account_key)
+    :param verify_signatures: whether the SharedKey signatures of authenticated requests are verified
+    :param copy_duration: seconds that copies of blobs remain pending before they complete
+    """
+
+    account_name = 'emulator'
+    account_key = base64.b64encode(b'azurepython3 emulator account key').decode('ascii')
+
+    def __init__(self, host = '127.0.0.1', port = 0, latency = 0, bandwidth = None, throttle_rate = 0,
+                 max_requests_per_second = None, account_key = None, verify_signatures = True, seed = None,
+                 copy_duration = 0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle_rate = throttle_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.copy_duration = copy_duration
+
+        if account_key is not None:
+            self.account_key = account_key
+        self.auth = SharedKeyAuthentication(self.account_name, self.account_key) if verify_signatures else None
+
+        self.containers = {}
+        self.service_properties = None
+        # (status, error code) that batch requests are rejected with, to emulate services without Blob Batch
+        self.batch_error = None
+        self.requests = 0
+        self.lock = threading.RLock()
+        self._random = random.Random(seed)
+        self._window = (0, 0)
+
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.emulator = self
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        """ Serves requests in a background thread and returns the endpoint """
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.endpoint
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def service(self, **options) -> BlobService:
+        """ Creates a BlobService that talks to this emulator """
+        return BlobService(self.account_name, self.account_key, endpoint=self.endpoint, **options)
+
+    def delay(self, length, latency = False):
+        """ Simulates the transfer time of length bytes, plus the configured latency if requested """
+        seconds = self.latency if latency else 0
+        if self.bandwidth and length:
+            seconds += length / self.bandwidth
+        if seconds:
+            time.sleep(seconds)
+
+    def throttle(self):
+        """ Raises a ServerBusy error if the request should be rejected """
+        with self.lock:
+            self.requests += 1
+
+            if self.max_requests_per_second:
+                second, count = self._window
+                now = int(time.time())
+                count = count + 1 if second == now else 1
+                self._window = (now, count)
+                if count > self.max_requests_per_second:
+                    raise StorageError(503, 'ServerBusy', 'The server is busy.', {'Retry-After': '1'})
+
+            # random rejections don't suggest a delay, like a busy partition server
+            if self.throttle_rate and self._random.random() < self.throttle_rate:
+                raise StorageError(503, 'ServerBusy', 'The server is busy.')
+
+    def container(self, name) -> EmulatedContainer:
+        if name not in self.containers:
+            raise StorageError(404, 'ContainerNotFound', 'The specified container does not exist.')
+        return self.containers[name]
+
+    def blob(self, container, name) -> EmulatedBlob:
+        blobs = self.container(container).blobs
+        if name not in blobs:
+            raise StorageError(404, 'BlobNotFound', 'The specified blob does not exist.')
+        return blobs[name]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, which must not be delayed by Nagle's algorithm
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_operation()
+
+    def do_HEAD(self):
+        self.handle_operation()
+
+    def do_PUT(self):
+        self.handle_operation()
+
+    def do_DELETE(self):
+        self.handle_operation()
+
+    def do_POST(self):
+        self.handle_operation()
+
+    def handle_operation(self):
+        emulator = self.server.emulator
+        url = urlsplit(self.path)
+        self.query = dict(parse_qsl(url.query, keep_blank_values=True))
+        segments = url.path.lstrip('/').split('/', 1)
+        container = unquote(segments[0])
+        name = unquote(segments[1]) if len(segments) > 1 and segments[1] else None
+
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+
+        try:
+            emulator.delay(len(self.body), latency=True)
+            emulator.throttle()
+            self.authenticate(container, name)
+
+            with emulator.lock:
+                if not container:
+                    status, headers, content = self.account_operation()
+                elif name is None:
+                    status, headers, content = self.container_operation(container)
+                else:
+                    status, headers, content = self.blob_operation(container, name)
+        except StorageError as e:
+            status, headers = e.status, e.headers
+            content = ('<?xml version="1.0" encoding="utf-8"?><Error><Code>%s</Code><Message>%s</Message></Error>'
+                       % (e.code, escape(e.message))).encode('utf-8')
+            headers['x-ms-error-code'] = e.code
+            headers['Content-Type'] = 'application/xml'
+
+        self.send_response(status)
+        self.send_header('x-ms-request-id', str(uuid.uuid4()))
+        self.send_header('x-ms-version', self.headers.get('x-ms-version', ''))
+        for header, value in headers.items():
+            self.send_header(header, value)
+
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+        if self.command != 'HEAD' and content:
+            emulator.delay(len(content))
+            self.wfile.write(content)
+
+    def authenticate(self, container, name):
+        emulator = self.server.emulator
+        authorization = self.headers.get('Authorization')
+
+        if authorization is None and 'sig' in self.query:
+            self.authorize_signature(container, name)
+        elif authorization is None:
+            # anonymous requests may only read blobs of public containers
+            if (self.command not in ('GET', 'HEAD') or container not in emulator.containers
+                    or emulator.containers[container].access is None
+                    or (name is None and emulator.containers[container].access != 'container')):
+                raise StorageError(404, 'ResourceNotFound', 'The specified resource does not exist.')
+        elif emulator.auth is not None:
+            url = 'http://%s%s' % (self.headers.get('Host', 'localhost'), self.path.split('?', 1)[0])
+            params = { key: value for key, value in self.query.items() }
+            expected = emulator.auth.sign(self.command, url, dict(self.headers.items()), params, 0)
+            if authorization != expected:
+                raise StorageError(403, 'AuthenticationFailed', 'Server failed to authenticate the request.')
+
+    def authorize_signature(self, container, name):
+        """ Checks the Shared Access Signature of a request """
+        emulator = self.server.emulator
+        query = self.query
+        now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+        if emulator.auth is not None:
+            signed_name = name if query.get('sr') == 'b' else None
+            if query['sig'] != emulator.auth.sas_signature(query, container, signed_name):
+                raise StorageError(403, 'AuthenticationFailed', 'Signature did not match.')
+
+        if (query.get('sr') == 'b' and name is None) or not query.get('se') or query['se'] < now \
+                or query.get('st', now) > now:
+            raise StorageError(403, 'AuthenticationFailed', 'Signature is not valid for the resource or time.')
+
+        if self.command in ('GET', 'HEAD'):
+            required = 'r' if name is not None else 'l'
+        elif self.command == 'DELETE':
+            required = 'd'
+        else:
+            required = 'cw' if self.command == 'PUT' and name is not None and query.get('comp') is None else 'w'
+
+        if not set(required) & set(query.get('sp', '')):
+            raise StorageError(403, 'AuthorizationPermissionMismatch',
+                               'This request is not authorized to perform this operation using this permission.')
+
+    # account level
+
+    def account_operation(self):
+        emulator = self.server.emulator
+        comp = self.query.get('comp')
+
+        if self.command == 'GET' and comp == 'list':
+            return self.list_containers()
+        if self.command == 'PUT' and comp == 'properties':
+            emulator.service_properties = self.body
+            return 202, {}, b''
+        if self.command == 'POST' and comp == 'batch':
+            return self.batch()
+
+        raise StorageError(400, 'UnsupportedHttpVerb', 'The operation is not supported by the emulator.')
+
+    def list_containers(self):
+        emulator = self.server.emulator
+        names = sorted(emulator.containers)
+        entries = []
+
+        for name in names:
+            container = emulator.containers[name]
+            metadata = ''
+            if self.query.get('include') == 'metadata':
+                metadata = '<Metadata>%s</Metadata>' % ''.join(
+                    '<%s>%s</%s>' % (key, escape(value), key) for key, value in container.metadata.items())
+            entries.append((name, '<Container><Name>%s</Name><Url>%s/%s</Url><Properties>'
+                                  '<Last-Modified>%s</Last-Modified><Etag>%s</Etag></Properties>%s</Container>'
+                                  % (escape(name), emulator.endpoint, quote(name), container.last_modified,
+                                     container.etag, metadata)))
+
+        return self.enumeration(entries, 'Containers')
+
+    def batch(self):
+        if self.server.emulator.batch_error is not None:
+            raise StorageError(*self.server.emulator.batch_error)
+
+        boundary = self.headers['Content-Type'].split('boundary=', 1)[1]
+        parts = []
+
+        for part in self.body.decode('utf-8').split('--' + boundary):
+            content_id = re.search(r'Content-ID:\s*(\d+)', part)
+            request = re.search(r'^(\w+) (\S+) HTTP/1\.1', part, re.MULTILINE)
+            if not content_id or not request:
+                continue
+
+            method, path = request.groups()
+            container, name = [unquote(segment) for segment in path.lstrip('/').split('/', 1)]
+
+            try:
+                if method != 'DELETE':
+                    raise StorageError(400, 'UnsupportedHttpVerb')
+                self.server.emulator.blob(container, name)
+                del self.server.emulator.containers[container].blobs[name]
+                status, reason = 202, 'Accepted'
+            except StorageError as e:
+                status, reason = e.status, e.code
+
+            parts.append('--batchresponse\r\nContent-Type: application/http\r\nContent-ID: %s\r\n\r\n'
+                         'HTTP/1.1 %d %s\r\nx-ms-version: 2019-07-07\r\n\r\n' % (content_id.group(1), status, reason))
+
+        content = (''.join(parts) + '--batchresponse--\r\n').encode('utf-8')
+        return 202, {'Content-Type': 'multipart/mixed; boundary=batchresponse'}, content
+
+    # container level
+
+    def container_operation(self, name):
+        emulator = self.server.emulator
+        restype, comp = self.query.get('restype'), self.query.get('comp')
+
+        if restype != 'container':
+            raise StorageError(400, 'InvalidQueryParameterValue', 'restype must be container.')
+
+        if self.command == 'PUT' and comp is None:
+            if name in emulator.containers:
+                raise StorageError(409, 'ContainerAlreadyExists', 'The specified container already exists.')
+            emulator.containers[name] = EmulatedContainer(self.headers.get('x-ms-blob-public-access'),
+                                                          self.request_metadata())
+            return 201, {}, b''
+
+        if self.command == 'DELETE' and comp is None:
+            emulator.container(name)
+            del emulator.containers[name]
+            return 202, {}, b''
+
+        if self.command == 'GET' and comp == 'list':
+            return self.list_blobs(name)
+
+        raise StorageError(400, 'UnsupportedHttpVerb', 'The operation is not supported by the emulator.')
+
+    def list_blobs(self, container_name):
+        emulator = self.server.emulator
+        container = emulator.container(container_name)
+        prefix = self.query.get('prefix', '')
+        delimiter = self.query.get('delimiter')
+        include_metadata = 'metadata' in self.query.get('include', '')
+        entries = []
+        prefixes = set()
+
+        for name in sorted(container.blobs):
+            if not name.startswith(prefix):
+                continue
+
+            if delimiter and delimiter in name[len(prefix):]:
+                blob_prefix = name[:name.index(delimiter, len(prefix)) + len(delimiter)]
+                if blob_prefix not in prefixes:
+                    prefixes.add(blob_prefix)
+                    entries.append((blob_prefix, '<BlobPrefix><Name>%s</Name></BlobPrefix>' % escape(blob_prefix)))
+                continue
+
+            blob = container.blobs[name]
+            properties = ''.join('<%s>%s</%s>' % (tag, escape(value), tag) for tag, value in (
+                [('Last-Modified', blob.last_modified), ('Etag', blob.etag),
+                 ('Content-Length', str(len(blob.content)))] +
+                [(header, blob.properties.get(header, '')) for header, _ in BLOB_PROPERTIES] +
+                [('BlobType', blob.blob_type), ('LeaseStatus', 'unlocked')]))
+            metadata = ''
+            if include_metadata:
+                metadata = '<Metadata>%s</Metadata>' % ''.join(
+                    '<%s>%s</%s>' % (key, escape(value), key) for key, value in blob.metadata.items())
+
+            entries.append((name, '<Blob><Name>%s</Name><Url>%s/%s/%s</Url><Properties>%s</Properties>%s</Blob>'
+                                  % (escape(name), emulator.endpoint, quote(container_name), quote(name),
+                                     properties, metadata)))
+
+        return self.enumeration(entries, 'Blobs')
+
+    def enumeration(self, entries, tag):
+        """ Returns a page of a listing, given (name, xml) tuples of all entries sorted by name """
+        marker = self.query.get('marker', '')
+        page_size = int(self.query.get('maxresults') or 5000)
+        entries = [entry for entry in entries if entry[0] >= marker]
+        next_marker = entries[page_size][0] if len(entries) > page_size else ''
+
+        content = ('﻿<?xml version="1.0" encoding="utf-8"?><EnumerationResults><%s>%s</%s>'
+                   '<NextMarker>%s</NextMarker></EnumerationResults>'
+                   % (tag, ''.join(xml for _, xml in entries[:page_size]), tag, escape(next_marker)))
+        return 200, {'Content-Type': 'application/xml'}, content.encode('utf-8')
+
+    # blob level
+
+    def blob_operation(self, container_name, name):
+        emulator = self.server.emulator
+        container = emulator.container(container_name)
+        comp = self.query.get('comp')
+
+        if self.command in ('GET', 'HEAD') and comp is None:
+            return self.get_blob(emulator.blob(container_name, name))
+
+        if self.command == 'DELETE' and comp is None:
+            self.check_condition(emulator.blob(container_name, name))
+            del container.blobs[name]
+            return 202, {}, b''
+
+        if self.command == 'PUT':
+            if comp is None and self.headers.get('x-ms-copy-source'):
+                return self.copy_blob(container, name)
+            if comp is None:
+                return self.put_blob(container, name)
+            if comp == 'block':
+                container.blocks.setdefault(name, {})[self.query['blockid']] = self.body
+                return 201, {}, b''
+            if comp == 'blocklist':
+                return self.put_block_list(container, name)
+            if comp == 'appendblock':
+                return self.append_block(emulator.blob(container_name, name))
+            if comp == 'metadata':
+                blob = emulator.blob(container_name, name)
+                self.check_condition(blob)
+                blob.metadata = self.request_metadata()
+                blob.touch()
+                return 200, {'ETag': blob.etag}, b''
+            if comp == 'properties':
+                blob = emulator.blob(container_name, name)
+                blob.properties = { header: self.headers[request_header] for header, request_header in BLOB_PROPERTIES
+                                    if self.headers.get(request_header) }
+                blob.touch()
+                return 200, {'ETag': blob.etag}, b''
+
+        raise StorageError(400, 'UnsupportedHttpVerb', 'The operation is not supported by the emulator.')
+
+    def check_condition(self, blob):
+        if self.headers.get('If-Match') not in (None, blob.etag, '*'):
+            raise StorageError(412, 'ConditionNotMet', 'The condition specified using HTTP conditional header(s) is not met.')
+
+    def get_blob(self, blob):
+        headers = self.blob_headers(blob)
+
+        if self.headers.get('If-None-Match') in (blob.etag, '*'):
+            return 304, { 'ETag': blob.etag, 'Content-Length': '0' }, b''
+        self.check_condition(blob)
+
+        content = bytes(blob.content)
+        requested = self.headers.get('x-ms-range') or self.headers.get('Range')
+
+        if requested:
+            start, end = requested.split('=', 1)[1].split('-')
+            start = int(start)
+            end = min(int(end) if end else len(content) - 1, len(content) - 1)
+            if start >= len(content):
+                raise StorageError(416, 'InvalidRange', 'The range specified is invalid for the current size of the resource.',
+                                   {'Content-Range': 'bytes */%d' % len(content)})
+
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(content))
+            content = content[start:end + 1]
+            status = 206
+        else:
+            status = 200
+
+        headers['Content-Length'] = str(len(content))
+        return status, headers, content
+
+    def blob_headers(self, blob):
+        headers = {
+            'ETag': blob.etag,
+            'Last-Modified': blob.last_modified,
+            'x-ms-blob-type': blob.blob_type,
+            'Accept-Ranges': 'bytes',
+            'Content-Type': blob.properties.get('Content-Type', 'application/octet-stream')
+        }
+
+        for header, _ in BLOB_PROPERTIES[1:]:
+            if blob.properties.get(header):
+                headers[header] = blob.properties[header]
+
+        for key, value in blob.metadata.items():
+            headers['x-ms-meta-' + key] = value
+
+        if blob.copy is not None:
+            copy_id, source, completion = blob.copy
+            headers['x-ms-copy-id'] = copy_id
+            headers['x-ms-copy-source'] = source
+            headers['x-ms-copy-status'] = 'pending' if time.time() < completion else 'success'
+
+        return headers
+
+    def put_blob(self, container, name):
+        blob_type = self.headers.get('x-ms-blob-type')
+        if blob_type not in ('BlockBlob', 'AppendBlob'):
+            raise StorageError(400, 'InvalidHeaderValue', 'Unsupported x-ms-blob-type.')
+        if self.headers.get('If-None-Match') == '*' and name in container.blobs:
+            raise StorageError(409, 'BlobAlreadyExists', 'The specified blob already exists.')
+
+        if blob_type == 'AppendBlob':
+            blob = EmulatedBlob(blob_type=blob_type)
+            blob.metadata = self.request_metadata()
+            blob.properties = { header: self.headers[request_header] for header, request_header in BLOB_PROPERTIES
+                                if self.headers.get(request_header) }
+            container.blobs[name] = blob
+            return 201, {'ETag': blob.etag}, b''
+
+        blob = EmulatedBlob(self.body, blob_type)
+        blob.metadata = self.request_metadata()
+        blob.properties = { header: self.headers.get(request_header) or self.headers[header]
+                            for header, request_header in BLOB_PROPERTIES
+                            if self.headers.get(request_header) or self.headers.get(header) }
+        blob.properties['Content-MD5'] = base64.b64encode(hashlib.md5(self.body).digest()).decode('ascii')
+
+        if self.headers.get('Content-MD5') and self.headers['Content-MD5'] != blob.properties['Content-MD5']:
+            raise StorageError(400, 'Md5Mismatch', 'The MD5 value specified in the request did not match.')
+
+        container.blobs[name] = blob
+        container.blocks.pop(name, None)
+        return 201, {'ETag': blob.etag, 'Content-MD5': blob.properties['Content-MD5']}, b''
+
+    def copy_blob(self, container, name):
+        emulator = self.server.emulator
+        source = self.headers['x-ms-copy-source']
+        segments = urlsplit(source).path.lstrip('/').split('/', 1)
+
+        if len(segments) < 2:
+            raise StorageError(400, 'InvalidHeaderValue', 'The value for the x-ms-copy-source header is invalid.')
+        try:
+            source_blob = emulator.blob(unquote(segments[0]), unquote(segments[1]))
+        except StorageError:
+            raise StorageError(404, 'CannotVerifyCopySource', 'The specified blob does not exist.')
+
+        blob = EmulatedBlob(source_blob.content, source_blob.blob_type)
+        blob.properties = dict(source_blob.properties)
+        blob.metadata = self.request_metadata() or dict(source_blob.metadata)
+        blob.copy = (str(uuid.uuid4()), source, time.time() + emulator.copy_duration)
+
+        container.blobs[name] = blob
+        status = 'pending' if emulator.copy_duration else 'success'
+        return 202, {'ETag': blob.etag, 'x-ms-copy-id': blob.copy[0], 'x-ms-copy-status': status}, b''
+
+    def append_block(self, blob):
+        if blob.blob_type != 'AppendBlob':
+            raise StorageError(409, 'InvalidBlobType', 'The blob type is invalid for this operation.')
+
+        position = self.headers.get('x-ms-blob-condition-appendpos')
+        if position is not None and int(position) != len(blob.content):
+            raise StorageError(412, 'AppendPositionConditionNotMet', 'The append position condition specified was not met.')
+
+        max_size = self.headers.get('x-ms-blob-condition-maxsize')
+        if max_size is not None and len(blob.content) + len(self.body) > int(max_size):
+            raise StorageError(412, 'MaxBlobSizeConditionNotMet', 'The max blob size condition specified was not met.')
+
+        offset = len(blob.content)
+        blob.content += self.body
+        blob.committed_blocks += 1
+        blob.touch()
+        return 201, {'ETag': blob.etag, 'x-ms-blob-append-offset': str(offset),
+                     'x-ms-blob-committed-block-count': str(blob.committed_blocks)}, b''
+
+    def put_block_list(self, container, name):
+        blocks = container.blocks.get(name, {})
+        content = bytearray()
+
+        for block_id in re.findall(r'<Latest>(.*?)</Latest>', self.body.decode('utf-8')):
+            if block_id not in blocks:
+                raise StorageError(400, 'InvalidBlockList', 'The specified block list is invalid.')
+            content += blocks[block_id]
+
+        blob = EmulatedBlob(content)
+        blob.metadata = self.request_metadata()
+        blob.properties = { header: self.headers[request_header] for header, request_header in BLOB_PROPERTIES
+                            if self.headers.get(request_header) }
+
+        container.blobs[name] = blob
+        container.blocks.pop(name, None)
+        return 201, {'ETag': blob.etag}, b''
+
+    def request_metadata(self):
+        return { key[len('x-ms-meta-'):]: value for key, value in self.headers.items()
+                 if key.lower().startswith('x-ms-meta-') }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs an in-memory Windows Azure Blob service emulator.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=10000)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second per request')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='fraction of requests rejected as busy')
+    parser.add_argument('--max-requests-per-second', type=int, default=None)
+    args = parser.parse_args()
+
+    emulator = BlobEmulator(args.host, args.port, args.latency, args.bandwidth, args.throttle_rate,
+                            args.max_requests_per_second)
+    print('Blob service emulator listening on %s (account "%s", key "%s")'
+          % (emulator.endpoint, emulator.account_name, emulator.account_key))
+
+    try:
+        emulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
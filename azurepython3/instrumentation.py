@@ -0,0 +1,172 @@
+"""
+This module implements instrumentation of the requests an AzureService sends to the storage service. Every
+request results in a RequestEvent that is passed to the sinks of the service's Instrumentation, such as the
+built-in RequestMetrics and SlowRequestLog, or any other callable:
+
+    instrumentation = svc.instrument(slow_request_threshold=1.0)
+    instrumentation.add_sink(lambda event: statsd.timing(event.operation, event.duration * 1000))
+    ...
+    print(instrumentation.metrics.snapshot())
+"""
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger('azurepython3')
+
+
+class RequestEvent:
+    """ Describes a completed request to the storage service """
+
+    def __init__(self, operation, method, container, blob, status, duration, bytes_sent, bytes_received,
+                 retries = 0, error = None):
+        """
+        :param operation: name of the operation, e.g. "get_blob" or "list"
+        :param status: HTTP status code of the response, or None if no response was received
+        :param duration: seconds from sending the request until the response headers were received
+        :param retries: number of times the request was retried before this result
+        :param error: the exception raised for the request, if any
+        """
+        self.operation = operation
+        self.method = method
+        self.container = container
+        self.blob = blob
+        self.status = status
+        self.duration = duration
+        self.bytes_sent = bytes_sent
+        self.bytes_received = bytes_received
+        self.retries = retries
+        self.error = error
+
+    def __str__(self):
+        return '%s %s/%s %s %.3fs' % (self.operation, self.container or '', self.blob or '', self.status,
+                                      self.duration)
+
+
+class OperationMetrics:
+    """ Counters and a latency histogram of a single operation """
+
+    def __init__(self, buckets):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.duration = 0.0
+        self.statuses = {}
+        # number of requests by upper bound of their duration, with a last bucket for longer ones
+        self.histogram = [0] * (len(buckets) + 1)
+
+
+class RequestMetrics:
+    """ Aggregates request events into counters and latency histograms per operation """
+
+    # upper bounds of the histogram buckets in seconds
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.operations = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event : RequestEvent):
+        with self._lock:
+            metrics = self.operations.get(event.operation)
+            if metrics is None:
+                metrics = self.operations[event.operation] = OperationMetrics(self.buckets)
+
+            metrics.requests += 1
+            metrics.retries += event.retries
+            metrics.bytes_sent += event.bytes_sent
+            metrics.bytes_received += event.bytes_received
+            metrics.duration += event.duration
+            metrics.statuses[event.status] = metrics.statuses.get(event.status, 0) + 1
+            metrics.histogram[bisect.bisect_left(self.buckets, event.duration)] += 1
+
+            if event.error is not None:
+                metrics.errors += 1
+
+    def percentile(self, operation, fraction):
+        """
+        Returns the upper bound of the histogram bucket containing the given percentile (e.g. 0.99) of the
+        operation's latencies, or None if it is beyond the last bucket or there were no requests.
+        """
+        with self._lock:
+            metrics = self.operations.get(operation)
+            if metrics is None or not metrics.requests:
+                return None
+
+            remaining = fraction * metrics.requests
+            for bound, count in zip(self.buckets, metrics.histogram):
+                remaining -= count
+                if remaining <= 0:
+                    return bound
+
+            return None
+
+    def snapshot(self):
+        """ Returns the current counters and histograms of all operations as a dict """
+        with self._lock:
+            return {
+                operation: {
+                    'requests': metrics.requests,
+                    'errors': metrics.errors,
+                    'retries': metrics.retries,
+                    'bytes_sent': metrics.bytes_sent,
+                    'bytes_received': metrics.bytes_received,
+                    'mean_duration': metrics.duration / metrics.requests,
+                    'statuses': dict(metrics.statuses),
+                    'histogram': dict(zip(self.buckets + (float('inf'),), metrics.histogram))
+                }
+                for operation, metrics in self.operations.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self.operations = {}
+
+
+class SlowRequestLog:
+    """ Logs a warning for every request that took at least threshold seconds """
+
+    def __init__(self, threshold, logger = logger):
+        self.threshold = threshold
+        self.logger = logger
+
+    def __call__(self, event : RequestEvent):
+        if event.duration >= self.threshold:
+            self.logger.warning('Slow request: %s (%d bytes sent, %d bytes received, %d retries)',
+                                event, event.bytes_sent, event.bytes_received, event.retries)
+
+
+class Instrumentation:
+    """
+    Passes the events of all requests of an AzureService to the registered sinks. A sink is any callable taking
+    a RequestEvent. Exceptions raised by sinks are logged and don't affect the requests.
+    """
+
+    def __init__(self, metrics = True, slow_request_threshold = None):
+        """
+        :param metrics: whether to aggregate events into RequestMetrics, available as the metrics attribute
+        :param slow_request_threshold: if given, requests taking at least that many seconds are logged
+        """
+        self.sinks = []
+        self.metrics = RequestMetrics() if metrics else None
+
+        if self.metrics is not None:
+            self.add_sink(self.metrics)
+        if slow_request_threshold is not None:
+            self.add_sink(SlowRequestLog(slow_request_threshold))
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def emit(self, event : RequestEvent):
+        for sink in self.sinks:
+            try:
+                sink(event)
+            except Exception:
+                logger.exception('Instrumentation sink %r failed', sink)
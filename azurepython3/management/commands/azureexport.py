@@ -0,0 +1,92 @@
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from azurepython3.blobservice import BlobService
+from azurepython3.scheduler import BACKGROUND
+
+
+class Command(BaseCommand):
+    help = """Export the blobs of a container to a local directory.
+When executing the command "azureexport" it will list the configured default container (or the given one)
+and download all blobs to files below the target directory, at the paths given by their names. Blobs are
+streamed to disk in parallel, and files that already exist with the same size and modification time are
+skipped, so an interrupted export can be resumed by running the command again."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='directory the blobs are downloaded to')
+        parser.add_argument('--container', help='container to export (default: AZURE_DEFAULT_CONTAINER)')
+        parser.add_argument('--prefix', help='only export blobs whose names start with the prefix')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='number of blobs downloaded in parallel (default: 8)')
+        parser.add_argument('--force', action='store_true',
+                            help='download all blobs, even if their files are unchanged')
+        parser.add_argument('--progress-interval', type=float, default=10,
+                            help='seconds between progress reports (default: 10)')
+
+    def handle(self, *args, **options):
+        # ensure that project has required configuration
+        if not hasattr(settings, 'AZURE_ACCOUNT_NAME'):
+            raise CommandError('AZURE_ACCOUNT_NAME setting missing')
+        if not hasattr(settings, 'AZURE_ACCOUNT_KEY'):
+            raise CommandError('AZURE_ACCOUNT_KEY setting missing')
+        if options['container'] is None and not hasattr(settings, 'AZURE_DEFAULT_CONTAINER'):
+            raise CommandError('AZURE_DEFAULT_CONTAINER settings missing')
+
+        container = options['container'] or settings.AZURE_DEFAULT_CONTAINER
+
+        # get service interface, with a connection per worker
+        service = BlobService(settings.AZURE_ACCOUNT_NAME, settings.AZURE_ACCOUNT_KEY,
+                              pool_size=options['workers'], endpoint=getattr(settings, 'AZURE_BLOB_ENDPOINT', None))
+        # leave capacity of a rate limited process to interactive requests
+        service.priority = BACKGROUND
+
+        self.stdout.write('Starting export from Cloud Storage container "%s" to "%s"'
+                          % (container, options['directory']))
+
+        self.lock = threading.Lock()
+        self.downloaded = self.downloaded_bytes = self.skipped = 0
+        self.failed = []
+        self.started = time.time()
+
+        done = threading.Event()
+        reporter = threading.Thread(target=self.report_progress, args=(done, options['progress_interval']))
+        reporter.daemon = True
+        reporter.start()
+
+        service.download_blobs(container, options['directory'], prefix=options['prefix'],
+                               max_connections=options['workers'], skip_unchanged=not options['force'],
+                               callback=self.record)
+
+        done.set()
+        reporter.join()
+        self.write_progress()
+
+        if self.failed:
+            for blobname, error in self.failed:
+                self.stdout.write('fail: %s (%s)' % (blobname, error))
+            raise CommandError('%d blobs could not be downloaded. Run the command again to retry them.'
+                               % len(self.failed))
+
+        self.stdout.write('export complete')
+
+    def record(self, blob, result):
+        with self.lock:
+            if result == 'downloaded':
+                self.downloaded += 1
+                self.downloaded_bytes += blob.content_length()
+            elif result == 'skipped':
+                self.skipped += 1
+            else:
+                self.failed.append((blob.name, result))
+
+    def report_progress(self, done, interval):
+        while not done.wait(interval):
+            self.write_progress()
+
+    def write_progress(self):
+        with self.lock:
+            elapsed = max(time.time() - self.started, 0.001)
+            self.stdout.write('%d blobs downloaded, %d skipped, %d failed, %.1f blobs/s, %.2f MB/s'
+                              % (self.downloaded, self.skipped, len(self.failed), self.downloaded / elapsed,
+                                 self.downloaded_bytes / elapsed / 1024 / 1024))
@@ -1,16 +1,35 @@
 import os
+import threading
+import time
 import traceback
-from django.core.management.base import BaseCommand, CommandError, NoArgsCommand
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from azurepython3.blobservice import BlobService
+from azurepython3.blobservice import BlobService, content_md5
+from azurepython3.scheduler import BACKGROUND
 
 
-class Command(NoArgsCommand):
+class Command(BaseCommand):
     help = """Migrate from an existing FileSystemStorage to AzureStorage.
 When executing the command "azuremigrate" it will scan for media files in MEDIA_ROOT
-and upload all the files to the configured default container."""
+and upload all the files to the configured default container. Files are uploaded in parallel,
+and files that already exist in the container with the same size (and MD5 hash, if requested)
+are skipped. Completed uploads are recorded in a manifest along with the account and container
+they were uploaded to, so an interrupted migration can be resumed by running the command again."""
 
-    def handle_noargs(self, **options):
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+                            help='number of files uploaded in parallel (default: 8)')
+        parser.add_argument('--retries', type=int, default=3,
+                            help='number of times a failed upload is retried (default: 3)')
+        parser.add_argument('--manifest', default='.azuremigrate-manifest',
+                            help='file recording completed uploads (default: .azuremigrate-manifest)')
+        parser.add_argument('--md5', action='store_true',
+                            help='compare MD5 hashes in addition to sizes to detect unchanged files')
+        parser.add_argument('--progress-interval', type=float, default=10,
+                            help='seconds between progress reports (default: 10)')
+
+    def handle(self, *args, **options):
         # ensure that project has required configuration
         if not os.path.exists(settings.MEDIA_ROOT):
             raise CommandError('Cannot migrate files from non existing MEDIA_ROOT (%s)' % settings.MEDIA_ROOT)
@@ -21,28 +40,149 @@ and upload all the files to the configured default container."""
         if not hasattr(settings, 'AZURE_DEFAULT_CONTAINER'):
             raise CommandError('AZURE_DEFAULT_CONTAINER settings missing')
 
-        # get service interface
-        service = BlobService(settings.AZURE_ACCOUNT_NAME, settings.AZURE_ACCOUNT_KEY)
+        self.container = settings.AZURE_DEFAULT_CONTAINER
+        self.use_md5 = options['md5']
+        self.retries = options['retries']
+
+        # get service interface, with a connection per worker
+        self.service = BlobService(settings.AZURE_ACCOUNT_NAME, settings.AZURE_ACCOUNT_KEY,
+                                   pool_size=options['workers'],
+                                   endpoint=getattr(settings, 'AZURE_BLOB_ENDPOINT', None))
+        # leave capacity of a rate limited process to interactive requests
+        self.service.priority = BACKGROUND
 
         self.stdout.write('Starting migration from "%s" to '
-                          'Cloud Storage container "%s"' % (settings.MEDIA_ROOT, settings.AZURE_DEFAULT_CONTAINER))
+                          'Cloud Storage container "%s"' % (settings.MEDIA_ROOT, self.container))
+
+        # entries of the manifest are only valid for the account and container they were uploaded to
+        self.destination = self.service.get_url('/%s/' % self.container)
+        manifest = self.read_manifest(options['manifest'])
+        files = [(path, blobname, size, mtime) for path, blobname, size, mtime in self.scan()
+                 if manifest.get(blobname) != (size, mtime)]
+
+        if files:
+            # one listing of the container instead of a request per file
+            self.stdout.write('Comparing %d files with the container...' % len(files))
+            existing = self.list_existing()
+            files = [file + (self.remote_md5(file, existing.get(file[1])),) for file in files
+                     if not self.is_unchanged(file, existing.get(file[1]))]
+            existing = None
+
+        self.stdout.write('%d files to upload' % len(files))
+
+        self.lock = threading.Lock()
+        self.uploaded = self.uploaded_bytes = self.skipped = 0
+        self.failed = []
+        self.total = len(files)
+        self.started = time.time()
+
+        with open(options['manifest'], 'a') as self.manifest:
+            done = threading.Event()
+            reporter = threading.Thread(target=self.report_progress, args=(done, options['progress_interval']))
+            reporter.daemon = True
+            reporter.start()
+
+            # files are submitted as workers become free, instead of queueing all of them upfront
+            pending = threading.BoundedSemaphore(options['workers'] * 2)
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                for file in files:
+                    pending.acquire()
+                    executor.submit(self.upload, *file).add_done_callback(lambda future: pending.release())
+
+            done.set()
+            reporter.join()
+
+        self.write_progress()
+
+        if self.failed:
+            for blobname, error in self.failed:
+                self.stdout.write('fail: %s (%s)' % (blobname, error))
+            raise CommandError('%d of %d files could not be uploaded. Run the command again to retry them.'
+                               % (len(self.failed), self.total))
 
+        self.stdout.write('migration complete')
+
+    def scan(self):
+        """ Yields path, blob name, size and modification time of all files in MEDIA_ROOT """
         for root, dirs, files in os.walk(settings.MEDIA_ROOT):
             for file in files:
                 path = os.path.join(root, file)
                 blobname = os.path.relpath(path, settings.MEDIA_ROOT).replace('\\', '/')
-                self.stdout.write(blobname + "...", ending='')
-                try:
-                    with open(path, 'rb') as f:
-                        if service.create_blob(settings.AZURE_DEFAULT_CONTAINER, blobname, bytearray(f.read())):
-                            self.stdout.write('ok')
-                        else:
-                            self.stdout.write('fail')
-                except Exception as e:
-                    self.stdout.write('fail')
+                stat = os.stat(path)
+                yield path, blobname, stat.st_size, int(stat.st_mtime)
+
+    def read_manifest(self, filename):
+        """
+        Returns the size and modification time of files that were uploaded to the container by previous runs,
+        by blob name. Entries are keyed by the URL of the blob, so uploads to other containers don't count.
+        """
+        manifest = {}
+
+        if os.path.exists(filename):
+            with open(filename, 'r') as file:
+                for line in file:
+                    try:
+                        url, size, mtime = line.rstrip('\n').rsplit('\t', 2)
+                        if url.startswith(self.destination):
+                            manifest[url[len(self.destination):]] = (int(size), int(mtime))
+                    except ValueError:
+                        pass # incomplete line of an interrupted run
+
+        return manifest
+
+    def list_existing(self):
+        """ Returns size and MD5 hash of the blobs in the container, by name """
+        return {blob.name: (blob.content_length(), blob.properties.get('Content-MD5'))
+                for blob in self.service.iter_blobs(self.container)}
+
+    def is_unchanged(self, file, remote):
+        """ Whether the blob has the size of the file. Hashes are compared by the workers, see remote_md5. """
+        return remote is not None and remote[0] == file[2] and not self.use_md5
+
+    def remote_md5(self, file, remote):
+        """ Returns the MD5 hash of a blob of the same size as the file, which the worker compares with the file """
+        if self.use_md5 and remote is not None and remote[0] == file[2]:
+            return remote[1]
+        return None
+
+    def upload(self, path, blobname, size, mtime, remote_md5 = None):
+        for attempt in range(self.retries + 1):
+            try:
+                with open(path, 'rb') as f:
+                    md5 = content_md5(f)[0] if self.use_md5 else None
+                    if md5 is not None and md5 == remote_md5:
+                        with self.lock:
+                            self.skipped += 1
+                        self.record(blobname, size, mtime)
+                        return
+                    self.service.create_blob(self.container, blobname, f, content_md5=md5)
+            except Exception as e:
+                if attempt == self.retries:
                     traceback.print_exc()
-                    self.stdout.write('aborted migration.')
+                    with self.lock:
+                        self.failed.append((blobname, e))
                     return
+                time.sleep(2 ** attempt)
+            else:
+                with self.lock:
+                    self.uploaded += 1
+                    self.uploaded_bytes += size
+                self.record(blobname, size, mtime)
+                return
 
-        self.stdout.write('migration complete')
+    def record(self, blobname, size, mtime):
+        """ Adds a file that is stored in the container to the manifest """
+        with self.lock:
+            self.manifest.write('%s%s\t%d\t%d\n' % (self.destination, blobname, size, mtime))
+            self.manifest.flush()
+
+    def report_progress(self, done, interval):
+        while not done.wait(interval):
+            self.write_progress()
 
+    def write_progress(self):
+        with self.lock:
+            elapsed = max(time.time() - self.started, 0.001)
+            self.stdout.write('%d/%d files uploaded, %d unchanged, %d failed, %.1f files/s, %.2f MB/s'
+                              % (self.uploaded, self.total, self.skipped, len(self.failed), self.uploaded / elapsed,
+                                 self.uploaded_bytes / elapsed / 1024 / 1024))
@@ -0,0 +1,148 @@
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from azurepython3.djangostorage import shard_services
+from azurepython3.sharding import HashRing, transfer_blob
+from azurepython3.scheduler import BACKGROUND
+
+
+class Command(BaseCommand):
+    help = """Rebalance the files of a ShardedAzureStorage after its storage accounts changed.
+When executing the command "azurerebalance" it will list the blobs of the default container on every account
+in AZURE_SHARDS and AZURE_RETIRED_SHARDS, and move each blob that is placed on a different account of
+AZURE_SHARDS now. With consistent hashing only a share of the blobs moves when accounts are added. Accounts
+that are going to be removed should be listed in AZURE_RETIRED_SHARDS until all of their blobs are moved.
+If a blob already exists on its new account, the copy that was modified last is kept and the conflict is
+reported."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+                            help='number of blobs moved in parallel (default: 8)')
+        parser.add_argument('--retries', type=int, default=3,
+                            help='number of times a failed move is retried (default: 3)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only count the blobs that would be moved')
+        parser.add_argument('--progress-interval', type=float, default=10,
+                            help='seconds between progress reports (default: 10)')
+
+    def handle(self, *args, **options):
+        # ensure that project has required configuration
+        if not getattr(settings, 'AZURE_SHARDS', None):
+            raise CommandError('AZURE_SHARDS setting missing')
+        if not hasattr(settings, 'AZURE_DEFAULT_CONTAINER'):
+            raise CommandError('AZURE_DEFAULT_CONTAINER settings missing')
+
+        self.container = settings.AZURE_DEFAULT_CONTAINER
+        self.retries = options['retries']
+
+        # get service interfaces, with a connection per worker
+        shards = list(settings.AZURE_SHARDS)
+        retired = list(getattr(settings, 'AZURE_RETIRED_SHARDS', []))
+        self.services = shard_services(shards + retired, pool_size=options['workers'])
+        for service in self.services.values():
+            # leave capacity of a rate limited process to interactive requests
+            service.priority = BACKGROUND
+        self.ring = HashRing([shard['account_name'] for shard in shards])
+
+        self.stdout.write('Rebalancing container "%s" over %d accounts%s'
+                          % (self.container, len(shards), ' (%d retired)' % len(retired) if retired else ''))
+
+        self.lock = threading.Lock()
+        self.moved = self.moved_bytes = self.total = 0
+        self.failed = []
+        self.conflicts = []
+        self.started = time.time()
+
+        done = threading.Event()
+        if not options['dry_run']:
+            reporter = threading.Thread(target=self.report_progress, args=(done, options['progress_interval']))
+            reporter.daemon = True
+            reporter.start()
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for account, blob in self.scan():
+                self.total += 1
+                if not options['dry_run']:
+                    executor.submit(self.move, account, blob)
+
+        done.set()
+
+        if options['dry_run']:
+            self.stdout.write('%d blobs to move' % self.total)
+            return
+
+        reporter.join()
+        self.write_progress()
+
+        for blobname, kept in self.conflicts:
+            self.stdout.write('conflict: %s existed on both accounts, kept the copy of %s' % (blobname, kept))
+
+        if self.failed:
+            for blobname, error in self.failed:
+                self.stdout.write('fail: %s (%s)' % (blobname, error))
+            raise CommandError('%d of %d blobs could not be moved. Run the command again to retry them.'
+                               % (len(self.failed), self.total))
+
+        self.stdout.write('rebalancing complete')
+
+    def scan(self):
+        """ Yields the account and the listed blob of all blobs that are not stored on the account they are placed on """
+        for account, service in self.services.items():
+            for blob in service.iter_blobs(self.container):
+                if self.ring.node_for(blob.name) != account:
+                    yield account, blob
+
+    def move(self, account, blob):
+        blobname, size = blob.name, blob.content_length()
+        source = self.services[account]
+        owner = self.ring.node_for(blobname)
+        target = self.services[owner]
+        # account whose copy was kept if the blob already existed on its new account
+        conflict = None
+
+        for attempt in range(self.retries + 1):
+            try:
+                if attempt:
+                    # the source may have changed or been deleted since it was listed
+                    blob = source.get_blob(self.container, blobname, with_content=False)
+                    if blob is None:
+                        return
+
+                # a blob saved on its new account since the accounts changed must not be overwritten by an older copy
+                existing = target.get_blob(self.container, blobname, with_content=False)
+                newer = existing is not None and existing.last_modified >= blob.last_modified
+                if conflict is None:
+                    conflict = existing is not None and (owner if newer else account)
+
+                if not newer:
+                    transfer_blob(source, target, self.container, blobname)
+                # the source is only deleted if it didn't change since it was checked, otherwise it's moved again
+                source.delete_blob(self.container, blobname, etag=blob.etag)
+            except Exception as e:
+                if attempt == self.retries:
+                    traceback.print_exc()
+                    with self.lock:
+                        self.failed.append((blobname, e))
+                    return
+                time.sleep(2 ** attempt)
+            else:
+                with self.lock:
+                    self.moved += 1
+                    self.moved_bytes += size
+                    if conflict:
+                        self.conflicts.append((blobname, conflict))
+                return
+
+    def report_progress(self, done, interval):
+        while not done.wait(interval):
+            self.write_progress()
+
+    def write_progress(self):
+        with self.lock:
+            elapsed = max(time.time() - self.started, 0.001)
+            self.stdout.write('%d/%d blobs moved, %d failed, %.1f blobs/s, %.2f MB/s'
+                              % (self.moved, self.total, len(self.failed), self.moved / elapsed,
+                                 self.moved_bytes / elapsed / 1024 / 1024))
@@ -0,0 +1,92 @@
+"""
+This module implements the policy that decides whether and when failed requests to the storage service are
+retried.
+"""
+import random
+import time
+from email.utils import parsedate_to_datetime
+import requests
+
+
+class RetryPolicy:
+    """
+    Retries requests that failed because of throttling (503 ServerBusy, 429), server side timeouts and errors
+    (408, 500, 502, 504), or connection problems, as long as retrying them is safe. Delays grow exponentially with
+    jitter, unless the service requests a specific delay through the Retry-After header. Optionally the total time
+    spent on an operation, including all retries, is bounded by a client side deadline.
+    """
+
+    retry_statuses = (408, 429, 500, 502, 503, 504)
+    # methods that can be repeated without changing the outcome
+    idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def __init__(self, max_retries = 4, backoff = 0.5, max_backoff = 30, jitter = True, deadline = None,
+                 deadlines = None):
+        """
+        :param max_retries: maximum number of retries of a single operation
+        :param backoff: delay before the first retry in seconds, doubled for each further retry
+        :param max_backoff: upper bound for delays in seconds
+        :param jitter: randomizes delays to spread retries of concurrent requests
+        :param deadline: default limit in seconds for the total time of an operation, including retries
+        :param deadlines: deadlines for specific operations by name (see RequestEvent.operation)
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.deadlines = deadlines or {}
+
+    def deadline_for(self, operation):
+        if self.deadlines:
+            return self.deadlines.get(operation, self.deadline)
+        return self.deadline
+
+    def should_retry(self, method, attempt, error : requests.RequestException, idempotent = None):
+        """
+        Determines whether a request that failed with the given error should be retried.
+        :param attempt: number of retries so far
+        :param idempotent: whether the request can safely be repeated, by default derived from the method
+        """
+        if attempt >= self.max_retries:
+            return False
+
+        # the request never reached the service
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+
+        if idempotent is None:
+            idempotent = method.upper() in self.idempotent_methods
+        if not idempotent:
+            return False
+
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and error.response.status_code in self.retry_statuses
+
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+    def delay(self, attempt, response = None):
+        """ Returns the number of seconds to wait before the given retry """
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        if self.jitter:
+            delay = delay / 2 + random.uniform(0, delay / 2)
+
+        return delay
+
+
+class NoRetryPolicy(RetryPolicy):
+    """ Never retries requests, but still applies deadlines """
+
+    def should_retry(self, method, attempt, error, idempotent = None):
+        return False
@@ -0,0 +1,161 @@
+"""
+This module implements a scheduler that limits the rate of requests and the bandwidth of the requests an
+AzureService sends, shared by all services of the process. Requests of INTERACTIVE priority, such as those of a
+website, are sent first, while requests of BACKGROUND priority, such as those of batch jobs, use the remaining
+capacity:
+
+    AzureService.scheduler = Scheduler(requests_per_second=2000, bytes_per_second=50 * 1024 * 1024)
+    batch_service = BlobService(account_name, account_key)
+    batch_service.priority = BACKGROUND
+    ...
+    print(AzureService.scheduler.stats())
+"""
+import collections
+import threading
+import time
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# priority classes from highest to lowest
+PRIORITIES = (INTERACTIVE, BACKGROUND)
+
+
+class TokenBucket:
+    """
+    Tokens accumulate at a fixed rate up to the capacity, and are taken for each unit of work. Work larger than
+    the capacity may take the bucket into debt, which is paid off before further work is admitted. Not thread-safe.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount):
+        """ Returns the seconds until the amount can be taken, 0 if it can be taken right away """
+        missing = min(amount, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class PriorityStats:
+    """ Queue depth and waiting times of the requests of a priority class """
+
+    def __init__(self):
+        self.queued = 0
+        self.max_queued = 0
+        self.requests = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+
+
+class Scheduler:
+    """ Admits requests according to their priority and the available request and bandwidth budgets """
+
+    def __init__(self, requests_per_second = None, bytes_per_second = None, burst = 1.0):
+        """
+        :param requests_per_second: maximum rate of requests, unlimited if None
+        :param bytes_per_second: maximum number of bytes sent and received per second, unlimited if None
+        :param burst: number of seconds of unused capacity that can be spent at once
+        """
+        self.requests = TokenBucket(requests_per_second, requests_per_second * burst) \
+            if requests_per_second else None
+        self.bytes = TokenBucket(bytes_per_second, bytes_per_second * burst) if bytes_per_second else None
+
+        self._condition = threading.Condition()
+        self._queues = {priority: collections.deque() for priority in PRIORITIES}
+        self._stats = {priority: PriorityStats() for priority in PRIORITIES}
+
+    def acquire(self, priority = INTERACTIVE, size = 0):
+        """
+        Blocks until a request of the priority that sends the given number of bytes may be sent. Requests of a
+        priority are admitted in order, and only while no request of a higher priority is waiting.
+        :return: the number of seconds waited
+        """
+        queue = self._queues[priority]
+        stats = self._stats[priority]
+        ticket = object()
+        start = time.monotonic()
+
+        with self._condition:
+            queue.append(ticket)
+            stats.queued = len(queue)
+            stats.max_queued = max(stats.max_queued, stats.queued)
+
+            try:
+                while True:
+                    if self._next() is ticket:
+                        delay = self._delay(size)
+                        if delay == 0:
+                            self._take(size)
+                            break
+                        self._condition.wait(delay)
+                    else:
+                        self._condition.wait()
+            finally:
+                queue.remove(ticket)
+                stats.queued = len(queue)
+                # the next request in line may proceed now
+                self._condition.notify_all()
+
+            wait = time.monotonic() - start
+            stats.requests += 1
+            stats.wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+
+        return wait
+
+    def consume(self, size):
+        """ Accounts for bytes that were transferred without being acquired, such as the body of a response """
+        if self.bytes is not None and size:
+            with self._condition:
+                self.bytes.refill(time.monotonic())
+                self.bytes.take(size)
+
+    def _next(self):
+        """ Returns the ticket of the request that is admitted next """
+        for priority in PRIORITIES:
+            if self._queues[priority]:
+                return self._queues[priority][0]
+
+    def _delay(self, size):
+        now = time.monotonic()
+        delay = 0
+
+        if self.requests is not None:
+            self.requests.refill(now)
+            delay = max(delay, self.requests.delay(1))
+        if self.bytes is not None:
+            self.bytes.refill(now)
+            delay = max(delay, self.bytes.delay(size))
+
+        return delay
+
+    def _take(self, size):
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.bytes is not None:
+            self.bytes.take(size)
+
+    def stats(self):
+        """
+        Returns the current and maximum queue depth, the number of admitted requests and their total, mean and
+        maximum waiting times in seconds, by priority
+        """
+        with self._condition:
+            return { priority: {
+                'queued': stats.queued,
+                'max_queued': stats.max_queued,
+                'requests': stats.requests,
+                'wait': stats.wait,
+                'mean_wait': stats.wait / stats.requests if stats.requests else 0.0,
+                'max_wait': stats.max_wait,
+            } for priority, stats in self._stats.items() }
@@ -1,7 +1,12 @@
-from datetime import datetime
+import threading
+import time
 import requests
 from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from azurepython3.auth import SharedKeyAuthentication
+from azurepython3.instrumentation import Instrumentation, RequestEvent
+from azurepython3.retry import RetryPolicy
+from azurepython3.scheduler import INTERACTIVE
 from urllib.parse import quote_plus
 
 USE_SSL = True
@@ -11,17 +16,59 @@ try:
 except ImportError:
     USE_SSL = False
 
-class AzureService:
+# the formatted x-ms-date of the current second, shared by all requests within that second
+_date_cache = (None, None)
 
+
+def _http_date():
+    """ Returns the current time formatted for the x-ms-date header """
+    global _date_cache
+    now = int(time.time())
+    second, formatted = _date_cache
+
+    if second != now:
+        formatted = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(now))
+        _date_cache = (now, formatted)
+
+    return formatted
+
+
+class BaseService:
+    """
+    The parts of a service that don't depend on the HTTP client: the account and its credentials, the host and
+    URLs of requests, and their default headers and parameters. Requests are signed with the auth.
+    """
+
+    # server side timeout of operations in seconds
     timeout = None
-    retry = True
+    # maximum number of connections kept open to the storage account
+    pool_size = 10
+    # reuse connections between requests (HTTP keep-alive)
+    keep_alive = True
 
-    def __init__(self, account_name, account_key):
+    def __init__(self, account_name, account_key, pool_size = None, keep_alive = None, endpoint = None):
+        """
+        :param endpoint: base URL of the blob service, such as "http://127.0.0.1:10000", to use instead of the
+                         account's default host (https://<account_name>.blob.core.windows.net)
+        :param pool_size: maximum number of pooled connections to the storage account
+        :param keep_alive: whether connections should be kept open and reused between requests
+        """
         self.account_name = account_name
         self.account_key = account_key
         self.auth = SharedKeyAuthentication(account_name, account_key)
+        self.endpoint = endpoint.rstrip('/') if endpoint else None
+
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if keep_alive is not None:
+            self.keep_alive = keep_alive
 
     def get_host(self, protocol=None):
+        if self.endpoint:
+            if protocol is None:
+                return self.endpoint
+            return protocol + self.endpoint[self.endpoint.index('://'):]
+
         if protocol is None:
             protocol = 'https' if USE_SSL else 'http'
         return "%s://%s.blob.core.windows.net" % (protocol, self.account_name)
@@ -30,21 +77,191 @@ class AzureService:
         return self.get_host(protocol) + quote_plus(query, safe='/')
 
     def _headers(self):
-        return {
+        headers = {
             'x-ms-version': '2011-08-18',
-            'x-ms-date': datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT'),
+            'x-ms-date': _http_date(),
             'Content-Type': 'application/octet-stream Charset=UTF-8'
         }
 
+        if not self.keep_alive:
+            headers['Connection'] = 'close'
+
+        return headers
+
     def _params(self):
         return {
             'timeout': self.timeout
         }
 
-    def _request(self, method, uri, headers = None, params = None, content = None):
+
+class AzureService(BaseService):
+    """ A service that sends its requests with a pooled requests session """
+
+    # whether failed requests are retried according to the retry_policy
+    retry = True
+    retry_policy = RetryPolicy()
+    # client side timeouts in seconds for establishing a connection and for waiting on data from the service
+    connect_timeout = 10
+    read_timeout = 120
+
+    # block when all pooled connections are in use instead of opening additional throw-away connections
+    pool_block = False
+    # receives an event for every request if set, see instrument()
+    instrumentation = None
+    # limits the rate and bandwidth of requests if set, usually on AzureService itself so that it applies to all
+    # services of the process. See azurepython3.scheduler.
+    scheduler = None
+    # priority of this service's requests in the scheduler
+    priority = INTERACTIVE
+
+    def __init__(self, account_name, account_key, pool_size = None, keep_alive = None, warm_up = 0, endpoint = None):
+        """
+        :param endpoint: base URL of the blob service, such as "http://127.0.0.1:10000", to use instead of the
+                         account's default host (https://<account_name>.blob.core.windows.net)
+        :param pool_size: maximum number of pooled connections to the storage account
+        :param keep_alive: whether connections should be kept open and reused between requests
+        :param warm_up: number of connections to open right away, so that the first requests
+                        don't have to pay for the TCP and TLS handshakes
+        """
+        super().__init__(account_name, account_key, pool_size, keep_alive, endpoint)
+
+        self._session = None
+        self._session_lock = threading.Lock()
+
+        if warm_up:
+            self.warm_up(warm_up)
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        The long-lived session owned by this service. All requests share its connection pool,
+        which is thread-safe, so a single service instance can be used from multiple threads.
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+
+        return self._session
+
+    def _create_session(self):
+        session = requests.Session()
+        # the adapter only retries failed connection attempts, everything else is up to the retry policy
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size,
+                              max_retries=Retry(total=5, read=False, redirect=False), pool_block=self.pool_block)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def warm_up(self, connections = 1):
+        """
+        Opens up to the given number of pooled connections to the storage account in parallel.
+        Returns the number of connections that could be established.
+        """
+        connections = min(connections, self.pool_size)
+        url = self.get_host()
+        opened = []
+
+        def connect():
+            try:
+                # any response will do, it's only about establishing the connection
+                self.session.head(url)
+                opened.append(True)
+            except requests.RequestException:
+                pass
+
+        threads = [threading.Thread(target=connect) for _ in range(connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return len(opened)
+
+    def close(self):
+        """ Closes all pooled connections. The service can still be used afterwards. """
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def instrument(self, metrics = True, slow_request_threshold = None) -> Instrumentation:
+        """
+        Enables instrumentation of all requests of this service and returns the Instrumentation, to which further
+        sinks can be added. See azurepython3.instrumentation.
+        """
+        self.instrumentation = Instrumentation(metrics, slow_request_threshold)
+        return self.instrumentation
+
+    def _request(self, method, uri, headers = None, params = None, content = None, stream = False, operation = None,
+                 idempotent = None, deadline = None):
+        """
+        Signs and sends a request to the storage service, retrying it according to the retry policy.
+        :param stream: if True the response body is not read upfront, but can be consumed from response.raw
+        :param operation: name of the operation reported to the instrumentation, derived from the request if omitted
+        :param idempotent: whether the request may be retried, derived from the method if omitted
+        :param deadline: maximum number of seconds for the request including retries, by default taken from
+                         the retry policy
+        """
         if content is None:
             content = dict()
 
+        policy = self.retry_policy
+        scheduler = self.scheduler
+        if deadline is None and policy is not None:
+            if policy.deadlines and operation is None:
+                operation = self._operation_name(method, params, '/' in uri.lstrip('/'))
+            deadline = policy.deadline_for(operation)
+
+        start = time.perf_counter()
+        deadline_at = start + deadline if deadline else None
+        response = error = None
+        attempt = 0
+
+        try:
+            while True:
+                try:
+                    if scheduler is not None:
+                        scheduler.acquire(self.priority, len(content))
+                    response = self._send(method, uri, headers, params, content, stream, self._timeout(deadline_at))
+                    if scheduler is not None and method.lower() != 'head':
+                        scheduler.consume(int(response.headers.get('Content-Length') or 0))
+                    error = None
+                    return response
+                except requests.RequestException as e:
+                    error = e
+                    response = e.response
+
+                    if not self.retry or policy is None or not policy.should_retry(method, attempt, e, idempotent):
+                        raise e
+
+                    delay = policy.delay(attempt, response)
+                    if deadline_at is not None and time.perf_counter() + delay >= deadline_at:
+                        raise e
+
+                    time.sleep(delay)
+                    attempt += 1
+        finally:
+            if self.instrumentation is not None:
+                self._emit(method, uri, params, content, operation, response, error, time.perf_counter() - start,
+                           attempt)
+
+    def _timeout(self, deadline_at):
+        """ Returns the (connect, read) timeout of the next attempt, limited by the remaining time until the deadline """
+        if deadline_at is None:
+            return self.connect_timeout, self.read_timeout
+
+        remaining = max(deadline_at - time.perf_counter(), 0.001)
+        return tuple(min(timeout, remaining) if timeout else remaining
+                     for timeout in (self.connect_timeout, self.read_timeout))
+
+    def _send(self, method, uri, headers, params, content, stream, timeout = None):
         # filter empty headers
         if headers != None:
             headers = { key: value for key, value in headers.items() if value != None }
@@ -61,15 +278,46 @@ class AzureService:
         self.auth.authenticate(req, len(content))
         request = req.prepare()
 
-        session = requests.session()
-        session.mount('http://', HTTPAdapter(max_retries=5))
-        session.mount('https://', HTTPAdapter(max_retries=5))
-
-        response = session.send(request)
+        response = self.session.send(request, stream=stream, timeout=timeout)
         response.encoding = 'utf-8-sig'
 
         # raise underlying HTTPError if something goes wrong
         if response.status_code >= 300:
             response.raise_for_status()
 
-        return response
\ No newline at end of file
+        return response
+
+    def _emit(self, method, uri, params, content, operation, response, error, duration, retries = 0):
+        """ Reports a request to the instrumentation """
+        segments = uri.lstrip('/').split('/', 1)
+        container = segments[0] or None
+        blob = segments[1] if len(segments) > 1 else None
+
+        if operation is None:
+            operation = self._operation_name(method, params, blob)
+
+        status = bytes_received = 0
+        if response is not None:
+            status = response.status_code
+            # responses to HEAD requests and 304 Not Modified describe a body without containing it
+            if method.upper() != 'HEAD' and status != 304:
+                bytes_received = int(response.headers.get('Content-Length') or 0)
+            # include connection retries of the adapter
+            history = getattr(getattr(response.raw, 'retries', None), 'history', None)
+            retries += len(history) if history else 0
+
+        self.instrumentation.emit(RequestEvent(operation, method.upper(), container, blob, status or None, duration,
+                                               len(content), bytes_received, retries, error))
+
+    @staticmethod
+    def _operation_name(method, params, blob):
+        """ Derives a name for the operation of a request, such as "get_blob", "list" or "block" """
+        params = params or {}
+        if params.get('comp'):
+            return params['comp']
+
+        target = 'blob' if blob else params.get('restype') or 'service'
+        method = method.lower()
+        if method == 'head':
+            return 'get_%s_properties' % target
+        return '%s_%s' % ({'put': 'create'}.get(method, method), target)
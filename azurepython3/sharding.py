@@ -0,0 +1,70 @@
+"""
+This module implements consistent hashing, which places blobs on one of several storage accounts by a stable hash
+of their names. Each account is represented by a number of virtual nodes on a ring of hash values, so adding or
+removing an account only moves the blobs between it and its neighbours on the ring:
+
+    ring = HashRing(['account1', 'account2', 'account3'])
+    ring.node_for('images/logo.png')   # e.g. 'account2'
+"""
+import bisect
+import hashlib
+
+
+def _hash(key):
+    """ Returns a stable 64 bit hash of the string """
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """ Maps keys to nodes, such that changing the set of nodes only remaps a minimal share of the keys """
+
+    def __init__(self, nodes, replicas = 128):
+        """
+        :param nodes: names of the nodes, e.g. the storage account names
+        :param replicas: number of virtual nodes per node. More virtual nodes distribute keys more evenly.
+        """
+        self.nodes = tuple(nodes)
+        if not self.nodes:
+            raise ValueError('A hash ring requires at least one node')
+        if len(set(self.nodes)) != len(self.nodes):
+            raise ValueError('The nodes of a hash ring must be unique')
+
+        self.replicas = replicas
+        points = sorted((_hash('%s#%d' % (node, i)), node) for node in self.nodes for i in range(replicas))
+        self._hashes = [point for point, node in points]
+        self._nodes = [node for point, node in points]
+
+    def node_for(self, key):
+        """ Returns the node that the key is placed on """
+        index = bisect.bisect(self._hashes, _hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+
+def transfer_blob(source, target, container, name, target_name = None):
+    """
+    Copies a blob from the account of the source BlobService to the account of the target BlobService. Within an
+    account the service copies the blob itself, across accounts the content is streamed through the client as
+    stored, keeping its content encoding, caching headers and metadata.
+    """
+    target_name = target_name or name
+
+    if source is target:
+        source.copy_blob(container, target_name, container, name)
+        return
+
+    blob = source.get_blob(container, name, with_content=False)
+    if blob is None:
+        raise FileNotFoundError('Blob "%s" does not exist in container "%s"' % (name, container))
+
+    with source.open_blob(container, name) as content:
+        target.create_blob(container, target_name, content, content_encoding=blob.properties.get('Content-Encoding'),
+                           cache_control=blob.properties.get('Cache-Control'),
+                           content_disposition=blob.properties.get('Content-Disposition'))
+    if blob.metadata:
+        target.set_blob_metadata(container, target_name, blob.metadata)
@@ -0,0 +1,288 @@
+import io
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.test import override_settings
+from azurepython3.auth import SharedKeyAuthentication
+from azurepython3.djangostorage import AzureStorage, ShardedAzureStorage
+from azurepython3.emulator import BlobEmulator
+from azurepython3.management.commands import azuremigrate, azurerebalance
+
+
+class TestAzureStorage(TestCase):
+
+    CONTAINER = 'azurepython3-storage'
+
+    def setUp(self):
+        # the storage is always tested against the local emulator
+        self.emulator = BlobEmulator()
+        self.emulator.start()
+        self.service = self.emulator.service()
+        self.service.create_container(self.CONTAINER)
+
+        self.settings = override_settings(AZURE_BLOB_ENDPOINT=self.emulator.endpoint)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.service.close()
+        self.emulator.stop()
+
+    def storage(self, **options):
+        return AzureStorage(self.CONTAINER, self.emulator.account_name, self.emulator.account_key, **options)
+
+    def test_save_and_open(self):
+        storage = self.storage()
+        name = storage.save('docs/readme.txt', ContentFile(b'THIS FILE SHOULD BE SAVED'))
+        self.assertEqual('docs/readme.txt', name)
+
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(25, storage.size(name))
+        with storage.open(name) as file:
+            self.assertEqual(25, file.size)
+            self.assertEqual(b'THIS FILE SHOULD BE SAVED', file.read())
+
+        storage.delete(name)
+        self.assertFalse(storage.exists(name))
+
+    def test_metadata_cache(self):
+        storage = self.storage(metadata_cache_ttl=60)
+        name = storage.save('file.txt', ContentFile(b'CACHED'))
+
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(6, storage.size(name))
+        storage.modified_time(name)
+        stats = storage.metadata_cache.stats()
+        self.assertEqual((2, 1), (stats['hits'], stats['misses']))
+
+        # saving and deleting through the storage invalidates the entry
+        storage.save('other.txt', ContentFile(b'OTHER'))
+        self.service.create_blob(self.CONTAINER, 'file.txt', b'CHANGED BEHIND THE CACHE')
+        self.assertEqual(6, storage.size(name))
+        storage._save(name, ContentFile(b'CHANGED'))
+        self.assertEqual(7, storage.size(name))
+
+        storage.delete(name)
+        self.assertFalse(storage.exists(name))
+
+    def test_listdir(self):
+        storage = self.storage()
+        for name in ('a.txt', 'dir/b.txt', 'dir/sub/c.txt', 'dir/sub/deeper/d.txt', 'other/e.txt'):
+            storage.save(name, ContentFile(b'x'))
+
+        self.assertEqual((['dir', 'other'], ['a.txt']), storage.listdir(''))
+        self.assertEqual((['sub'], ['b.txt']), storage.listdir('dir'))
+        self.assertEqual((['deeper'], ['c.txt']), storage.listdir('dir/sub/'))
+        self.assertEqual(([], []), storage.listdir('missing'))
+
+    def test_get_available_name(self):
+        storage = self.storage()
+        self.assertEqual('images/photo.jpg', storage.save('images/photo.jpg', ContentFile(b'first')))
+
+        second = storage.save('images/photo.jpg', ContentFile(b'second'))
+        self.assertRegex(second, r'^images/photo_\w{7}\.jpg$')
+        with storage.open('images/photo.jpg') as file:
+            self.assertEqual(b'first', file.read())
+
+        self.assertLessEqual(len(storage.get_available_name('images/photo.jpg', max_length=20)), 20)
+
+        # only the names in the directory itself are listed, not those of subdirectories
+        storage.save('images/photos/1.jpg', ContentFile(b'third'))
+        self.assertSetEqual({'images/photo.jpg', second}, storage._names('images/photo'))
+
+    def test_deduplicate(self):
+        storage = self.storage(deduplicate=True)
+        first = storage.save('uploads/photo.jpg', ContentFile(b'SAME CONTENT'))
+        second = storage.save('uploads/photo2.jpg', ContentFile(b'SAME CONTENT'))
+        third = storage.save('uploads/photo3.jpg', ContentFile(b'OTHER CONTENT'))
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, third)
+        self.assertRegex(first, r'^uploads/[0-9a-f]{32}\.jpg$')
+        self.assertEqual(2, len(storage.listdir('uploads')[1]))
+
+        # the blob is only deleted with the last file that shares it
+        storage.delete(first)
+        self.assertTrue(storage.exists(first))
+        self.assertEqual(first, storage.save('uploads/photo4.jpg', ContentFile(b'SAME CONTENT')))
+        storage.delete(first)
+        self.assertTrue(storage.exists(first))
+        storage.delete(second)
+        self.assertFalse(storage.exists(first))
+
+        # copies and moved files are files of their own, which are deleted at once
+        shared = storage.save('uploads/photo5.jpg', ContentFile(b'SHARED CONTENT'))
+        storage.save('uploads/photo6.jpg', ContentFile(b'SHARED CONTENT'))
+        storage.copy(shared, 'uploads/copy.jpg')
+        storage.delete('uploads/copy.jpg')
+        self.assertFalse(storage.exists('uploads/copy.jpg'))
+
+        storage.move(shared, 'uploads/moved.jpg')
+        self.assertTrue(storage.exists(shared))
+        storage.delete('uploads/moved.jpg')
+        self.assertFalse(storage.exists('uploads/moved.jpg'))
+        storage.delete(shared)
+        self.assertFalse(storage.exists(shared))
+
+        storage.delete(third)
+        self.assertEqual(([], []), storage.listdir('uploads'))
+
+    def test_content_cache(self):
+        with TemporaryDirectory() as directory:
+            storage = self.storage(content_cache_dir=directory)
+            storage.service.content_cache.max_entry_size = 10
+            storage.save('small.txt', ContentFile(b'SMALL'))
+            storage.save('large.txt', ContentFile(b'TOO LARGE TO BE CACHED'))
+
+            for i in range(2):
+                with storage.open('small.txt') as file:
+                    self.assertEqual(b'SMALL', file.read())
+            self.assertEqual((1, 1), (storage.service.content_cache.stats()['hits'],
+                                      storage.service.content_cache.stats()['misses']))
+
+            # larger files are streamed instead of being loaded into memory
+            with storage.open('large.txt') as file:
+                self.assertNotIsInstance(file.file, io.BytesIO)
+                self.assertEqual(b'TOO LARGE TO BE CACHED', file.read())
+            self.assertEqual(1, storage.service.content_cache.stats()['misses'])
+
+    def test_compression(self):
+        content = b'COMPRESSIBLE CONTENT ' * 100
+        storage = self.storage(compression='gzip')
+        storage.save('file.txt', ContentFile(content))
+        self.assertEqual('gzip', self.service.get_blob(self.CONTAINER, 'file.txt', with_content=False)
+                         .properties.get('Content-Encoding'))
+
+        sent = self.emulator.requests
+        with storage.open('file.txt') as file:
+            self.assertIsNone(file.size)
+            self.assertEqual(content, file.read())
+        # the properties are fetched along with the size, and the content with a single request
+        self.assertEqual(sent + 2, self.emulator.requests)
+
+        # files are decompressed by their content encoding, also after compression was disabled
+        with self.storage().open('file.txt') as file:
+            self.assertEqual(content, file.read())
+
+    def test_sharded_fallback(self):
+        # an emulator per account, each with an account name of its own
+        emulators = {}
+        for account_name in ('shard1', 'shard2', 'shard3'):
+            emulator = emulators[account_name] = BlobEmulator()
+            emulator.account_name = account_name
+            emulator.auth = SharedKeyAuthentication(account_name, emulator.account_key)
+            emulator.start()
+            emulator.service().create_container(self.CONTAINER)
+        shards = {account_name: {'account_name': account_name, 'account_key': emulator.account_key,
+                                 'endpoint': emulator.endpoint} for account_name, emulator in emulators.items()}
+
+        try:
+            names = ['file%d.txt' % i for i in range(20)]
+            storage = ShardedAzureStorage(self.CONTAINER, [shards['shard1'], shards['shard2']])
+            for name in names:
+                storage.save(name, ContentFile(name.encode('utf-8')))
+
+            # shard3 replaces shard2, whose files are not moved yet, and takes over files of shard1
+            storage = ShardedAzureStorage(self.CONTAINER, [shards['shard1'], shards['shard3']],
+                                          retired_shards=[shards['shard2']])
+            self.assertFalse(all(storage.exists(name) for name in names))
+
+            storage.fallback = True
+            self.assertEqual(sorted(names), storage.listdir('')[1])
+            for name in names:
+                self.assertTrue(storage.exists(name))
+                self.assertEqual(len(name), storage.size(name))
+                with storage.open(name) as file:
+                    self.assertEqual(name.encode('utf-8'), file.read())
+                self.assertIn(storage._locate(name).get_url(''), storage.url(name))
+            self.assertFalse(storage.exists('missing.txt'))
+
+            # a file saved on its new account before it was moved is not overwritten by the older copy
+            moving = [name for name in names if storage._locate(name) is not storage._service(name)]
+            storage._service(moving[0]).create_blob(self.CONTAINER, moving[0], b'NEWER')
+
+            output = io.StringIO()
+            with override_settings(AZURE_SHARDS=[shards['shard1'], shards['shard3']],
+                                   AZURE_RETIRED_SHARDS=[shards['shard2']], AZURE_DEFAULT_CONTAINER=self.CONTAINER):
+                call_command(azurerebalance.Command(), stdout=output)
+            self.assertIn('%d/%d blobs moved, 0 failed' % (len(moving), len(moving)), output.getvalue())
+            self.assertIn('conflict: %s existed on both accounts, kept the copy of %s'
+                          % (moving[0], storage.ring.node_for(moving[0])), output.getvalue())
+
+            storage.fallback = False
+            with storage.open(moving[0]) as file:
+                self.assertEqual(b'NEWER', file.read())
+            for name in moving[1:]:
+                with storage.open(name) as file:
+                    self.assertEqual(name.encode('utf-8'), file.read())
+            self.assertFalse(emulators['shard2'].service().list_blobs(self.CONTAINER))
+        finally:
+            for emulator in emulators.values():
+                emulator.stop()
+
+    def test_cdn_versioning(self):
+        with self.assertRaises(ValueError):
+            self.storage(cdn_host='https://cdn.example.com', cdn_versioning=True)
+
+        storage = self.storage(cdn_host='https://cdn.example.com', cdn_versioning=True, metadata_cache_ttl=60)
+        storage.save('static/app.js', ContentFile(b'var version = 1;'))
+
+        requests = self.emulator.requests
+        url = storage.url('static/app.js')
+        self.assertRegex(url, r'^https://cdn\.example\.com/%s/static/app\.js\?v=\w{12}$' % self.CONTAINER)
+        self.assertEqual(url, storage.url('static/app.js'))
+        self.assertEqual(requests + 1, self.emulator.requests)
+
+        # replacing the file changes its version
+        storage.delete('static/app.js')
+        storage.save('static/app.js', ContentFile(b'var version = 2;'))
+        self.assertNotEqual(url, storage.url('static/app.js'))
+
+    def test_migrate(self):
+        self.service.create_container('other')
+
+        with TemporaryDirectory() as media_root, TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(media_root, 'dir'))
+            for name, content in (('a.txt', b'FIRST FILE'), ('dir/b.txt', b'SECOND FILE')):
+                with open(os.path.join(media_root, name), 'wb') as file:
+                    file.write(content)
+            manifest = os.path.join(directory, 'manifest')
+
+            def migrate(container = self.CONTAINER, **options):
+                output = io.StringIO()
+                with override_settings(MEDIA_ROOT=media_root, AZURE_ACCOUNT_NAME=self.emulator.account_name,
+                                       AZURE_ACCOUNT_KEY=self.emulator.account_key, AZURE_DEFAULT_CONTAINER=container):
+                    call_command(azuremigrate.Command(), manifest=manifest, stdout=output, **options)
+                return output.getvalue()
+
+            self.assertIn('2 files to upload', migrate())
+            self.assertEqual(b'SECOND FILE', self.service.get_blob_content(self.CONTAINER, 'dir/b.txt'))
+
+            # files in the manifest are skipped without comparing them with the container
+            sent = self.emulator.requests
+            self.assertIn('0 files to upload', migrate())
+            self.assertEqual(sent, self.emulator.requests)
+
+            # the manifest only applies to the container it was written for
+            self.assertIn('2 files to upload', migrate('other'))
+            self.assertEqual(b'FIRST FILE', self.service.get_blob_content('other', 'a.txt'))
+
+            # without a manifest, files with the size of their blobs are skipped
+            os.unlink(manifest)
+            self.assertIn('0 files to upload', migrate())
+
+            # unless their hashes differ
+            os.unlink(manifest)
+            with open(os.path.join(media_root, 'a.txt'), 'wb') as file:
+                file.write(b'FIRST EDIT')
+            output = migrate(md5=True)
+            self.assertIn('2 files to upload', output)
+            self.assertIn('1/2 files uploaded, 1 unchanged, 0 failed', output)
+            self.assertEqual(b'FIRST EDIT', self.service.get_blob_content(self.CONTAINER, 'a.txt'))
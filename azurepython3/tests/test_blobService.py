@@ -1,10 +1,22 @@
+import asyncio
 import json
+import mmap
 import os
+import threading
+import time
 from random import random
-from tempfile import TemporaryFile
-from unittest import TestCase
-from requests import HTTPError
-from azurepython3.blobservice import BlobService
+from tempfile import TemporaryDirectory, TemporaryFile
+from unittest import TestCase, skipIf
+import requests
+from requests import HTTPError, Timeout
+from azurepython3.asyncblobservice import AsyncBlobService, aiohttp
+from azurepython3.blobservice import BlobReader, BlobService
+from azurepython3.cache import DiskCache
+from azurepython3.cdn import HeaderRules, cdn_url
+from azurepython3.emulator import BlobEmulator
+from azurepython3.retry import RetryPolicy
+from azurepython3.scheduler import BACKGROUND, INTERACTIVE, Scheduler
+from azurepython3.sharding import HashRing, transfer_blob
 
 
 class TestBlobService(TestCase):
@@ -16,15 +28,20 @@ class TestBlobService(TestCase):
 
     def setUp(self):
         # find azure credentials for testing. expects them in cwd
-        if not os.path.exists(self.CREDENTIALS_PATH):
-            raise Exception('Azure Credentials file at "%s" does not exist' % os.path.abspath(self.CREDENTIALS_PATH))
+        if os.path.exists(self.CREDENTIALS_PATH):
+            # read json formatted credentials ("account_name" and "account_key")
+            with open(self.CREDENTIALS_PATH, "r") as file:
+                self.credentials = json.load(file)
 
-        # read json formatted credentials ("account_name" and "account_key")
-        with open(self.CREDENTIALS_PATH, "r") as file:
-            self.credentials = json.load(file)
-
-        # create the blob service
-        self.service = BlobService(self.credentials['account_name'], self.credentials['account_key'])
+            # create the blob service
+            self.emulator = None
+            self.service = BlobService(self.credentials['account_name'], self.credentials['account_key'],
+                                       endpoint=self.credentials.get('endpoint'))
+        else:
+            # without credentials test against the local emulator
+            self.emulator = BlobEmulator()
+            self.emulator.start()
+            self.service = self.emulator.service()
 
         # generate names for the test containers
         self.container_names = ["%s-%d" % (self.CONTAINER_PREFIX, i) for i in range(5)]
@@ -40,7 +57,15 @@ class TestBlobService(TestCase):
     def tearDown(self):
         # delete the test containers
         for name in self.container_names:
-            self.service.delete_container(name)
+            try:
+                self.service.delete_container(name)
+            except HTTPError as e:
+                if e.response.status_code != 404:
+                    raise e
+
+        self.service.close()
+        if self.emulator is not None:
+            self.emulator.stop()
 
     def list_containers(self):
         containers = self.service.list_containers()
@@ -70,6 +95,32 @@ class TestBlobService(TestCase):
         # delete the container
         self.service.delete_container(container)
 
+    def test_create_blob_in_blocks(self):
+        container = '%s-test17' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+
+        # upload anything above 100 KB in blocks of 64 KB
+        self.service.single_put_threshold = 100 * 1024
+        content = os.urandom(300 * 1024)
+
+        with TemporaryFile() as file:
+            file.write(content)
+            file.flush()
+            file.seek(0)
+            inputs = {'bytes': content, 'bytearray': bytearray(content), 'memoryview': memoryview(content),
+                      'mmap': mmap.mmap(file.fileno(), 0), 'file': file}
+
+            for kind, data in inputs.items():
+                self.assertTrue(self.service.create_blob(container, kind, data, block_size=64 * 1024))
+                self.assertEqual(content, self.service.get_blob(container, kind).content, kind)
+
+            # small mmaps are uploaded with a single request
+            inputs['mmap'].close()
+            with mmap.mmap(file.fileno(), 1000) as data:
+                self.assertTrue(self.service.create_blob(container, 'small-mmap', data))
+            self.assertEqual(content[:1000], self.service.get_blob(container, 'small-mmap').content)
+
     def test_delete_blob(self):
         container = '%s-test2' % self.CONTAINER_PREFIX
 
@@ -79,6 +130,15 @@ class TestBlobService(TestCase):
         # create a file
         self.service.create_blob(container, 'file-to-delete.ext', bytearray(b'THIS FILE SHOULD BE DELETED'))
 
+        # changes conditional on an outdated ETag are refused
+        etag = self.service.get_blob(container, 'file-to-delete.ext', with_content=False).properties['ETag']
+        self.assertTrue(self.service.set_blob_metadata(container, 'file-to-delete.ext', {'changed': 'yes'}, etag=etag))
+        for change in (lambda: self.service.set_blob_metadata(container, 'file-to-delete.ext', {}, etag=etag),
+                       lambda: self.service.delete_blob(container, 'file-to-delete.ext', etag=etag)):
+            with self.assertRaises(HTTPError) as context:
+                change()
+            self.assertEqual(412, context.exception.response.status_code)
+
         # delete the file
         self.assertTrue(self.service.delete_blob(container, 'file-to-delete.ext'))
 
@@ -104,4 +164,535 @@ class TestBlobService(TestCase):
         blobs3 = self.service.list_blobs(container, prefix = 'folder2')
         self.assertSetEqual({'folder2/file3.ext'}, set([blob.name for blob in blobs3]))
 
-        self.service.delete_container(container)
\ No newline at end of file
+        self.service.delete_container(container)
+
+    def test_list_blobs_paginated(self):
+        container = '%s-test4' % self.CONTAINER_PREFIX
+        self.create_container(container)
+
+        names = {'folder1/file%d.ext' % i for i in range(5)} | {'file5.ext'}
+        for name in names:
+            self.service.create_blob(container, name, bytearray(b'THIS FILE SHOULD BE LISTED'))
+
+        blobs = list(self.service.iter_blobs(container, page_size=2))
+        self.assertSetEqual(names, set([blob.name for blob in blobs]))
+
+        # resume the listing after the first page
+        page = next(self.service.list_blob_pages(container, page_size=4))
+        first = [blob.name for blob in page]
+        rest = [blob.name for blob in self.service.iter_blobs(container, marker=page.next_marker)]
+        self.assertEqual(4, len(first))
+        self.assertSetEqual(names, set(first + rest))
+
+        entries = self.service.list_blobs(container, delimiter='/')
+        self.assertSetEqual({'folder1/', 'file5.ext'}, set([entry.name for entry in entries]))
+
+        # listed blobs carry typed core properties, the remaining ones are available as dicts
+        blob = self.service.list_blobs(container, prefix='file5')[0]
+        self.assertEqual(26, blob.size)
+        self.assertEqual(blob.etag, blob.properties['Etag'])
+        self.assertEqual(blob.size, blob.content_length())
+        self.assertEqual(self.service.get_blob_url(container, 'file5.ext'), blob.url)
+        self.assertEqual({}, blob.metadata)
+
+        columns = self.service.list_blob_columns(container, page_size=2)
+        self.assertSetEqual(names, set(columns.names))
+        self.assertEqual([26] * len(names), list(columns.sizes))
+        self.assertEqual(blob.last_modified.timestamp(), columns.last_modified[columns.names.index('file5.ext')])
+
+        self.service.delete_container(container)
+
+    def test_delete_blobs(self):
+        container = '%s-test5' % self.CONTAINER_PREFIX
+        self.create_container(container)
+
+        names = ['file%d.ext' % i for i in range(5)]
+        for name in names:
+            self.service.create_blob(container, name, bytearray(b'THIS FILE SHOULD BE DELETED'))
+
+        results = self.service.delete_blobs(container, names + ['missing.ext'])
+        self.assertDictEqual(dict({name: 202 for name in names}, **{'missing.ext': 404}), results)
+        self.assertListEqual([], self.service.list_blobs(container))
+
+        if self.emulator is not None:
+            # a refused batch falls back to single requests, but only a missing endpoint disables batches for good
+            for status, code, supported in [(400, 'InvalidQueryParameterValue', True), (501, 'NotImplemented', False)]:
+                self.emulator.batch_error = (status, code)
+                for name in names:
+                    self.service.create_blob(container, name, b'THIS FILE SHOULD BE DELETED')
+
+                self.assertDictEqual({name: 202 for name in names}, self.service.delete_blobs(container, names))
+                self.assertEqual(supported, self.service._batch_supported)
+                self.assertListEqual([], self.service.list_blobs(container))
+                self.service._batch_supported = True
+
+            # batches that fail despite retries are deleted one by one, keeping the results of other batches
+            self.service.max_batch_size = 2
+            self.service.retry_policy = RetryPolicy(max_retries=1, backoff=0.01)
+            for name in names:
+                self.service.create_blob(container, name, b'THIS FILE SHOULD BE DELETED')
+            self.emulator.batch_error = (503, 'ServerBusy')
+            sent = self.emulator.requests
+            self.assertDictEqual({name: 202 for name in names}, self.service.delete_blobs(container, names))
+            # three batches sent twice each, then five single deletions
+            self.assertEqual(sent + 3 * 2 + 5, self.emulator.requests)
+            self.assertTrue(self.service._batch_supported)
+            self.assertListEqual([], self.service.list_blobs(container))
+
+            # malformed requests are raised
+            self.emulator.batch_error = (400, 'InvalidInput')
+            with self.assertRaises(HTTPError):
+                self.service.delete_blobs(container, names)
+            self.assertTrue(self.service._batch_supported)
+
+        self.service.delete_container(container)
+
+    def test_set_blobs_metadata_and_properties(self):
+        container = '%s-test21' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+
+        names = ['file%d.ext' % i for i in range(3)]
+        for name in names:
+            self.service.create_blob(container, name, b'THIS FILE SHOULD BE UPDATED')
+
+        results = self.service.set_blobs_metadata(container, dict({name: {'index': name[4]} for name in names},
+                                                                  **{'missing.ext': {'index': 'x'}}))
+        self.assertDictEqual(dict({name: 200 for name in names}, **{'missing.ext': 404}), results)
+
+        results = self.service.set_blobs_properties(container, names + ['missing.ext'], content_type='text/plain',
+                                                    cache_control='public, max-age=60')
+        self.assertDictEqual(dict({name: 200 for name in names}, **{'missing.ext': 404}), results)
+
+        for name in names:
+            blob = self.service.get_blob(container, name, with_content=False)
+            self.assertEqual({'index': name[4]}, blob.metadata)
+            self.assertEqual('text/plain', blob.properties['Content-Type'])
+            self.assertEqual('public, max-age=60', blob.properties['Cache-Control'])
+
+    def test_instrumentation(self):
+        container = '%s-test6' % self.CONTAINER_PREFIX
+        self.create_container(container)
+
+        events = []
+        instrumentation = self.service.instrument()
+        instrumentation.add_sink(events.append)
+
+        self.service.create_blob(container, 'file.ext', bytearray(b'THIS FILE SHOULD BE MEASURED'))
+        self.service.get_blob(container, 'file.ext')
+        self.service.get_blob(container, 'missing.ext')
+
+        metrics = instrumentation.metrics.snapshot()
+        self.assertEqual(1, metrics['create_blob']['requests'])
+        self.assertEqual(28, metrics['create_blob']['bytes_sent'])
+        self.assertEqual(2, metrics['get_blob']['requests'])
+        self.assertEqual(1, metrics['get_blob']['errors'])
+        self.assertEqual({200: 1, 404: 1}, metrics['get_blob']['statuses'])
+        self.assertEqual(['create_blob', 'get_blob', 'get_blob'], [event.operation for event in events])
+        self.assertEqual((container, 'file.ext'), (events[0].container, events[0].blob))
+        self.assertEqual(28, events[1].bytes_received)
+
+        # HEAD responses announce the size of the content without transferring it
+        self.service.get_blob(container, 'file.ext', with_content=False)
+        self.assertEqual(('HEAD', 200, 0), (events[-1].method, events[-1].status, events[-1].bytes_received))
+
+        self.service.instrumentation = None
+        self.service.delete_container(container)
+
+    def test_blob_exists(self):
+        container = '%s-test9' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+        self.service.create_blob(container, 'file.ext', bytearray(b'THIS FILE SHOULD EXIST'))
+
+        # private containers are checked with authenticated requests
+        self.assertTrue(self.service.blob_exists(container, 'file.ext'))
+        self.assertFalse(self.service.blob_exists(container, 'missing.ext'))
+
+    def test_copy_and_move_blob(self):
+        container = '%s-test8' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+        self.service.create_blob(container, 'file.ext', bytearray(b'THIS FILE SHOULD BE COPIED'))
+
+        # let the emulator complete copies asynchronously
+        if self.emulator is not None:
+            self.emulator.copy_duration = 0.2
+        self.service.copy_poll_interval = 0.05
+
+        self.assertEqual('success', self.service.copy_blob(container, 'copy.ext', container, 'file.ext'))
+        self.assertEqual(b'THIS FILE SHOULD BE COPIED', self.service.get_blob(container, 'copy.ext').content)
+
+        self.assertTrue(self.service.move_blob(container, 'moved.ext', container, 'copy.ext', {'moved': 'yes'}))
+        moved = self.service.get_blob(container, 'moved.ext')
+        self.assertEqual(b'THIS FILE SHOULD BE COPIED', moved.content)
+        self.assertEqual({'moved': 'yes'}, moved.metadata)
+        self.assertIsNone(self.service.get_blob(container, 'copy.ext'))
+
+    def test_append_blob(self):
+        container = '%s-test10' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+
+        self.assertTrue(self.service.create_append_blob(container, 'log.txt'))
+        self.assertEqual(0, self.service.append_block(container, 'log.txt', b'first line\n', append_position=0))
+        self.assertEqual(11, self.service.append_block(container, 'log.txt', b'second line\n'))
+
+        # appends at an outdated position are rejected
+        with self.assertRaises(HTTPError) as context:
+            self.service.append_block(container, 'log.txt', b'lost line\n', append_position=11)
+        self.assertEqual(412, context.exception.response.status_code)
+
+        with self.service.open_append_blob(container, 'log.txt', flush_size=8) as writer:
+            writer.write(b'third line\n')
+            self.assertEqual(b'ne\n', bytes(writer._buffer))
+            writer.write(b'fourth line\n')
+
+        self.assertEqual(b'first line\nsecond line\nthird line\nfourth line\n',
+                         self.service.get_blob(container, 'log.txt').content)
+
+        # buffered data is appended after the flush interval
+        writer = self.service.open_append_blob(container, 'events.txt', flush_interval=0.05)
+        writer.write(b'event\n')
+        time.sleep(0.5)
+        self.assertEqual(b'event\n', self.service.get_blob(container, 'events.txt').content)
+        writer.close()
+
+    def test_compression(self):
+        container = '%s-test11' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+
+        css = b'body { margin: 0; padding: 0; }\n' * 1000
+        self.assertTrue(self.service.create_blob(container, 'style.css', css, compress=True))
+        self.assertTrue(self.service.create_blob(container, 'image.jpg', b'\xff\xd8\xff\xe0', compress=True))
+
+        blob = self.service.get_blob(container, 'style.css', with_content=False)
+        self.assertEqual('gzip', blob.properties['Content-Encoding'])
+        self.assertLess(blob.content_length(), len(css) / 10)
+        self.assertNotIn('Content-Encoding', self.service.get_blob(container, 'image.jpg', with_content=False).properties)
+
+        with self.service.open_blob(container, 'style.css', decompress=True) as file:
+            self.assertEqual(css, file.read())
+
+        # content is decoded whether it is downloaded with a single request or in ranges
+        self.assertEqual(css, self.service.get_blob_content(container, 'style.css'))
+        self.service.download_chunk_size = 64
+        self.assertEqual(css, self.service.get_blob_content(container, 'style.css', max_connections=4))
+        self.service.download_chunk_size = BlobService.download_chunk_size
+
+        # larger content is compressed while it is uploaded in blocks
+        content = json.dumps([random() for _ in range(100000)]).encode('utf-8')
+        with TemporaryFile() as file:
+            file.write(content)
+            file.seek(0)
+            self.service.create_blob(container, 'data.json', file, block_size=64 * 1024, compress='gzip')
+
+        with self.service.open_blob(container, 'data.json', decompress=True) as file:
+            self.assertEqual(content, file.read())
+
+    def test_download_in_ranges(self):
+        container = '%s-test18' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+        content = os.urandom(300 * 1024 + 17)
+        self.service.create_blob(container, 'file.bin', content)
+
+        # private blobs are downloaded with signed requests
+        self.assertEqual(content, self.service.get_blob_content(container, 'file.bin'))
+        with self.assertRaises(HTTPError):
+            self.service.get_blob_content(container, 'missing.bin')
+
+        # several ranges of 64 KB are downloaded in parallel
+        self.service.download_chunk_size = 64 * 1024
+        instrumentation = self.service.instrument()
+        self.assertEqual(content, self.service.get_blob_content(container, 'file.bin', max_connections=4))
+        self.assertEqual(5, instrumentation.metrics.snapshot()['get_blob']['requests'])
+
+        with TemporaryFile() as file:
+            file.write(b'header')
+            self.service.download_blob(container, 'file.bin', file, max_connections=3)
+            self.assertEqual(6 + len(content), file.tell())
+            file.seek(0)
+            self.assertEqual(b'header' + content, file.read())
+
+        buffer = bytearray(len(content))
+        self.service.download_blob(container, 'file.bin', buffer)
+        self.assertEqual(content, buffer)
+
+    def test_open_blob(self):
+        container = '%s-test19' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+        content = os.urandom(10000)
+        self.service.create_blob(container, 'file.bin', content)
+
+        with self.service.open_blob(container, 'file.bin', read_ahead_size=1024) as file:
+            self.assertFalse(hasattr(file, 'name'))
+            file.seek(5000)
+            self.assertEqual(content[5000:5100], file.read(100))
+            file.seek(-100, os.SEEK_END)
+            self.assertEqual(content[-100:], file.read())
+
+        if self.emulator is not None:
+            # the remainder is read with a single request, and small reads fetch read_ahead_size bytes
+            sent = self.emulator.requests
+            with self.service.open_blob(container, 'file.bin', read_ahead_size=1024) as file:
+                self.assertEqual(content, file.read())
+            self.assertEqual(sent + 1, self.emulator.requests)
+
+            sent = self.emulator.requests
+            with self.service.open_blob(container, 'file.bin', read_ahead_size=4096) as file:
+                file.seek(100)
+                self.assertEqual(content[100:], b''.join(iter(lambda: file.read(16), b'')))
+            reader = BlobReader(self.service, container, 'file.bin', read_ahead_size=4096)
+            self.assertEqual(content[:10], reader.read(10))
+            self.assertEqual(content[10:20], reader.read(10))
+            self.assertEqual(content[20:], reader.read())
+            self.assertEqual(b'', reader.read())
+            self.assertEqual(sent + 3 + 2, self.emulator.requests)
+
+        # reading a blob that is replaced meanwhile fails instead of mixing both versions
+        with self.service.open_blob(container, 'file.bin', read_ahead_size=1024) as file:
+            self.assertEqual(content[:1024], file.read(1024))
+            self.service.create_blob(container, 'file.bin', os.urandom(10000))
+            with self.assertRaises(IOError):
+                file.read(1024)
+
+    def test_content_cache(self):
+        container = '%s-test7' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+
+        with TemporaryDirectory() as directory:
+            self.service.content_cache = DiskCache(directory, max_size=100, max_entry_size=60)
+            self.service.create_blob(container, 'file.ext', bytearray(b'THIS FILE SHOULD BE CACHED'))
+
+            self.assertEqual(b'THIS FILE SHOULD BE CACHED', self.service.get_blob_content(container, 'file.ext'))
+            self.assertEqual(b'THIS FILE SHOULD BE CACHED', self.service.get_blob_content(container, 'file.ext'))
+            self.assertEqual({'hits': 1, 'misses': 1}, {key: value for key, value
+                             in self.service.content_cache.stats().items() if key in ('hits', 'misses')})
+
+            # changed blobs are downloaded again
+            self.service.create_blob(container, 'file.ext', bytearray(b'THIS FILE WAS CHANGED'))
+            self.assertEqual('THIS FILE WAS CHANGED', self.service.get_blob_content(container, 'file.ext', text=True))
+
+            # least recently used contents are evicted
+            for i in range(5):
+                self.service.create_blob(container, 'file%d.ext' % i, bytearray(b'THIS FILE SHOULD BE EVICTED'))
+                self.service.get_blob_content(container, 'file%d.ext' % i)
+
+            stats = self.service.content_cache.stats()
+            self.assertLessEqual(stats['size'], 100)
+            self.assertLess(0, stats['evictions'])
+            self.assertIsNone(self.service.content_cache.get('/%s/file.ext' % container))
+
+            # the statistics of existing contents are read without evicting them
+            cache = DiskCache(directory, max_size=10)
+            self.assertEqual((stats['size'], 0), (cache.stats()['size'], cache.stats()['evictions']))
+            self.assertEqual(stats['size'], DiskCache(directory).stats()['size'])
+
+            self.service.content_cache = None
+
+    def test_retry(self):
+        # throttling is simulated by a dedicated emulator, even when testing against a real account
+        with BlobEmulator(throttle_rate=0.3, seed=1) as emulator:
+            service = emulator.service()
+            service.retry_policy = RetryPolicy(max_retries=10, backoff=0.01)
+            instrumentation = service.instrument()
+
+            service.create_container('retried')
+            for i in range(20):
+                service.create_blob('retried', 'file%d.ext' % i, bytearray(b'THIS FILE SHOULD BE RETRIED'))
+            self.assertEqual(20, len(service.list_blobs('retried')))
+
+            metrics = instrumentation.metrics.snapshot()
+            self.assertEqual(0, sum(operation['errors'] for operation in metrics.values()))
+            self.assertLess(0, sum(operation['retries'] for operation in metrics.values()))
+
+            # non-idempotent requests are not retried
+            emulator.throttle_rate = 1
+            with self.assertRaises(HTTPError):
+                service._request('post', '/', params={'comp': 'batch'})
+            self.assertEqual(0, instrumentation.metrics.snapshot()['batch']['retries'])
+
+        # deadlines bound the time spent on a request including retries
+        with BlobEmulator(latency=0.5) as emulator:
+            service = emulator.service()
+            service.retry_policy = RetryPolicy(deadlines={'list': 0.2})
+            with self.assertRaises(Timeout):
+                service.list_containers()
+
+    def test_sharding(self):
+        # adding a node only moves keys to the new node, and about a share of them
+        names = ['images/file%05d.jpg' % i for i in range(10000)]
+        ring = HashRing(['account1', 'account2', 'account3'])
+        grown = HashRing(['account1', 'account2', 'account3', 'account4'])
+
+        placed = [ring.node_for(name) for name in names]
+        for node in ring.nodes:
+            self.assertAlmostEqual(len(names) / 3, placed.count(node), delta=len(names) / 10)
+
+        moved = [name for name, node in zip(names, placed) if grown.node_for(name) != node]
+        self.assertTrue(all(grown.node_for(name) == 'account4' for name in moved))
+        self.assertAlmostEqual(len(names) / 4, len(moved), delta=len(names) / 10)
+
+        # blobs are streamed between accounts with their encoding and metadata
+        container = '%s-test12' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+        self.service.create_blob(container, 'style.css', b'body { margin: 0; }\n' * 100, compress=True)
+        self.service.set_blob_metadata(container, 'style.css', {'shard': 'yes'})
+
+        with BlobEmulator() as emulator:
+            target = emulator.service()
+            target.create_container(container)
+            transfer_blob(self.service, target, container, 'style.css')
+
+            blob = target.get_blob(container, 'style.css', with_content=False)
+            self.assertEqual('gzip', blob.properties['Content-Encoding'])
+            self.assertEqual({'shard': 'yes'}, blob.metadata)
+            with target.open_blob(container, 'style.css', decompress=True) as file:
+                self.assertEqual(b'body { margin: 0; }\n' * 100, file.read())
+
+    def test_download_blobs(self):
+        container = '%s-test13' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+        for i in range(10):
+            self.service.create_blob(container, 'export/dir%d/file%d.ext' % (i % 3, i), bytearray(b'EXPORTED %d' % i))
+        self.service.create_blob(container, 'other.ext', bytearray(b'NOT EXPORTED'))
+
+        with TemporaryDirectory() as directory:
+            results = self.service.download_blobs(container, directory, prefix='export/', max_connections=4)
+            self.assertEqual(['downloaded'] * 10, list(results.values()))
+            with open(os.path.join(directory, 'export', 'dir1', 'file4.ext'), 'rb') as file:
+                self.assertEqual(b'EXPORTED 4', file.read())
+            self.assertFalse(os.path.exists(os.path.join(directory, 'other.ext')))
+
+            # unchanged files are skipped, changed ones are downloaded again
+            self.service.create_blob(container, 'export/dir0/file0.ext', bytearray(b'CHANGED'))
+            os.utime(os.path.join(directory, 'export', 'dir0', 'file3.ext'), (0, 0))
+            results = self.service.download_blobs(container, directory, prefix='export/')
+            self.assertEqual(['export/dir0/file0.ext', 'export/dir0/file3.ext'],
+                             sorted(name for name, result in results.items() if result == 'downloaded'))
+            with open(os.path.join(directory, 'export', 'dir0', 'file0.ext'), 'rb') as file:
+                self.assertEqual(b'CHANGED', file.read())
+
+    def test_scheduler(self):
+        scheduler = Scheduler(requests_per_second=50, burst=0.02)
+        admitted = []
+
+        def request(priority):
+            scheduler.acquire(priority)
+            admitted.append(priority)
+
+        # interactive requests overtake waiting background requests
+        threads = [threading.Thread(target=request, args=(BACKGROUND,)) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        threads += [threading.Thread(target=request, args=(INTERACTIVE,)) for _ in range(3)]
+        for thread in threads[10:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([INTERACTIVE] * 3, admitted[admitted.index(INTERACTIVE):][:3])
+        self.assertLess(admitted.index(INTERACTIVE), 6)
+        stats = scheduler.stats()
+        self.assertEqual(10, stats[BACKGROUND]['requests'])
+        self.assertLessEqual(6, stats[BACKGROUND]['max_queued'])
+        self.assertLess(stats[INTERACTIVE]['max_wait'], stats[BACKGROUND]['max_wait'])
+
+        # downloaded bytes count against the bandwidth of subsequent requests
+        container = '%s-test14' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+        self.service.create_blob(container, 'file.ext', bytearray(100000))
+
+        self.service.scheduler = Scheduler(bytes_per_second=400000, burst=0.1)
+        try:
+            start = time.perf_counter()
+            for _ in range(3):
+                self.service.get_blob(container, 'file.ext')
+            self.assertLess(0.3, time.perf_counter() - start)
+        finally:
+            self.service.scheduler = None
+
+    def test_shared_access_signature(self):
+        container = '%s-test15' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+        self.service.create_blob(container, 'private.ext', bytearray(b'THIS FILE SHOULD BE SIGNED'))
+
+        # private blobs can be read with a signed URL only
+        url = self.service.get_blob_sas_url(container, 'private.ext', expiry=60)
+        self.assertEqual(b'THIS FILE SHOULD BE SIGNED', requests.get(url).content)
+        self.assertEqual(404, requests.get(url.split('?')[0]).status_code)
+        self.assertEqual(403, requests.get(self.service.get_blob_sas_url(container, 'private.ext', expiry=-60))
+                         .status_code)
+        self.assertEqual(403, requests.delete(url).status_code)
+
+        # clients upload directly to signed upload URLs
+        url = self.service.get_upload_url(container, 'uploaded.ext')
+        response = requests.put(url, data=b'THIS FILE WAS UPLOADED', headers={'x-ms-blob-type': 'BlockBlob'})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(b'THIS FILE WAS UPLOADED', self.service.get_blob(container, 'uploaded.ext').content)
+        self.assertEqual(403, requests.put(url.replace('uploaded.ext', 'other.ext'), data=b'NOT UPLOADED',
+                                           headers={'x-ms-blob-type': 'BlockBlob'}).status_code)
+
+        # container signatures apply to all blobs of the container
+        sas = self.service.get_container_sas(container, 'rl')
+        self.assertEqual(b'THIS FILE WAS UPLOADED',
+                         requests.get(self.service.get_blob_url(container, 'uploaded.ext') + '?' + sas).content)
+        with self.assertRaises(ValueError):
+            self.service.get_blob_sas_url(container, 'private.ext', 'rl')
+
+    def test_caching_headers(self):
+        container = '%s-test16' % self.CONTAINER_PREFIX
+        self.create_container(container)
+        self.container_names.append(container)
+
+        rules = HeaderRules({'static/': 'public, max-age=31536000, immutable', 'image/*': 'public, max-age=86400'})
+        self.assertEqual('public, max-age=31536000, immutable', rules.value_for('static/logo.png'))
+        self.assertEqual('public, max-age=86400', rules.value_for('media/photo.jpg'))
+        self.assertIsNone(rules.value_for('media/report.pdf'))
+
+        self.service.create_blob(container, 'static/app.js', b'var app;', cache_control=rules.value_for('static/app.js'))
+        self.service.create_blob(container, 'report.pdf', bytearray(100000), block_size=64 * 1024,
+                                 cache_control='private', content_disposition='attachment; filename="report.pdf"')
+
+        properties = self.service.get_blob(container, 'static/app.js', with_content=False).properties
+        self.assertEqual('public, max-age=31536000, immutable', properties['Cache-Control'])
+        properties = self.service.get_blob(container, 'report.pdf', with_content=False).properties
+        self.assertEqual('private', properties['Cache-Control'])
+        self.assertEqual('attachment; filename="report.pdf"', properties['Content-Disposition'])
+
+        self.assertEqual('https://cdn.example.com/%s/static/app.js?v=1a2b' % container,
+                         cdn_url('https://cdn.example.com/', self.service.get_blob_url(container, 'static/app.js'), '1a2b'))
+
+    @skipIf(aiohttp is None, 'requires aiohttp')
+    def test_async_blob_service(self):
+        container = '%s-test20' % self.CONTAINER_PREFIX
+        self.container_names.append(container)
+
+        async def run():
+            async with AsyncBlobService.from_service(self.service) as service:
+                self.assertTrue(await service.create_container(container))
+                await asyncio.gather(*[service.create_blob(container, 'file%d.ext' % i, b'ASYNC FILE %d' % i)
+                                       for i in range(5)])
+
+                # small pages are followed by their markers
+                names = [blob.name async for blob in service.iter_blobs(container, page_size=2)]
+                self.assertEqual(['file%d.ext' % i for i in range(5)], names)
+
+                self.assertTrue(await service.blob_exists(container, 'file3.ext'))
+                self.assertEqual(b'ASYNC FILE 3', (await service.get_blob(container, 'file3.ext')).content)
+                self.assertTrue(await service.delete_blob(container, 'file3.ext'))
+                self.assertFalse(await service.blob_exists(container, 'file3.ext'))
+                self.assertIsNone(await service.get_blob(container, 'file3.ext'))
+
+                self.assertTrue(await service.enable_cors(['http://example.com']))
+
+        asyncio.run(run())
@@ -0,0 +1,97 @@
+"""
+Measures throughput and latency of the BlobService operations create, get, exists, list and delete for a range of
+blob sizes, against the in-process emulator or any other endpoint. For each operation and size it reports
+operations per second, median and 99th percentile latency and MB/s, followed by the peak RSS of the process.
+
+Usage: python benchmarks/bench_blobservice.py [--count N] [--threads N] [--sizes 1024,1048576]
+                                              [--latency SECONDS] [--bandwidth BYTES_PER_SECOND]
+                                              [--endpoint URL --account-name NAME --account-key KEY]
+"""
+import argparse
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from azurepython3.blobservice import BlobService
+from azurepython3.emulator import BlobEmulator
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(label, size, fn, items, threads):
+    """ Calls fn for each item using the given number of threads and prints the statistics """
+    def timed(item):
+        start = time.perf_counter()
+        fn(item)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = list(executor.map(timed, items))
+    elapsed = time.perf_counter() - start
+
+    print('%-8s %10d %10.1f %10.2f %10.2f %10.2f' % (
+        label, size, len(items) / elapsed, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+        size * len(items) / elapsed / 1024 / 1024 if size else 0))
+
+
+def run(service, container, size, count, threads):
+    content = os.urandom(size)
+    names = ['bench/%d/%06d' % (size, i) for i in range(count)]
+
+    measure('create', size, lambda name: service.create_blob(container, name, content), names, threads)
+    measure('get', size, lambda name: service.download_blob(container, name), names, threads)
+    measure('exists', 0, lambda name: service.get_blob(container, name, with_content=False), names, threads)
+    measure('list', 0, lambda _: list(service.iter_blobs(container, prefix='bench/%d/' % size)),
+            range(max(1, count // 100)), 1)
+    measure('delete', 0, lambda name: service.delete_blob(container, name), names, threads)
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--count', type=int, default=200, help='operations per size')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--sizes', default='1024,65536,1048576,8388608')
+    parser.add_argument('--latency', type=float, default=0, help='simulated latency of the emulator')
+    parser.add_argument('--bandwidth', type=float, default=None, help='simulated bandwidth of the emulator')
+    parser.add_argument('--endpoint', help='benchmark this endpoint instead of the in-process emulator')
+    parser.add_argument('--account-name', default=BlobEmulator.account_name)
+    parser.add_argument('--account-key', default=BlobEmulator.account_key)
+    parser.add_argument('--container', default='azurepython3-benchmark')
+    args = parser.parse_args()
+
+    emulator = None
+    if args.endpoint:
+        service = BlobService(args.account_name, args.account_key, endpoint=args.endpoint, pool_size=args.threads)
+    else:
+        emulator = BlobEmulator(latency=args.latency, bandwidth=args.bandwidth)
+        emulator.start()
+        service = emulator.service(pool_size=args.threads)
+
+    service.create_container(args.container)
+
+    try:
+        print('%-8s %10s %10s %10s %10s %10s' % ('op', 'size', 'ops/s', 'p50 ms', 'p99 ms', 'MB/s'))
+        for size in [int(size) for size in args.sizes.split(',')]:
+            run(service, args.container, size, args.count, args.threads)
+    finally:
+        service.delete_container(args.container)
+        if emulator is not None:
+            emulator.stop()
+
+    print('peak RSS: %.1f MB' % peak_rss_mb())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Compares time and memory of parsing large blob listings into dict-based Blob objects (as before), into compact
+Blob objects and into columnar form. The listing pages are fetched from the in-process emulator once and then
+parsed from memory, so that only the parsing is measured. Memory is the size of the retained listing as traced
+by tracemalloc.
+
+Usage: python benchmarks/bench_listing.py [--count N] [--page-size N]
+"""
+import argparse
+import io
+import time
+import tracemalloc
+import xml.etree.ElementTree as etree
+
+from azurepython3.blobservice import Blob, BlobColumns, ListingPage
+from azurepython3.emulator import BlobEmulator, EmulatedBlob, EmulatedContainer
+
+
+class LegacyBlob:
+    """ The previous representation of listed blobs, with a dict for properties and metadata each """
+
+    def __init__(self, name, url, properties, metadata):
+        self.name = name
+        self.url = url
+        self.properties = properties
+        self.metadata = metadata
+        self.content = None
+
+    @classmethod
+    def from_element(cls, element : etree.Element):
+        properties = dict([(p.tag, p.text) for p in element.find('Properties')])
+
+        if element.find('Metadata') != None:
+            metadata = dict([(e.tag, e.text) for e in element.find('Metadata')])
+        else:
+            metadata = {}
+
+        return LegacyBlob(element.find('Name').text, element.find('Url').text, properties, metadata)
+
+
+class RecordedResponse:
+    """ Replays the body of a listing response """
+
+    def __init__(self, body):
+        self.raw = io.BytesIO(body)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def measure(label, count, fn):
+    start = time.perf_counter()
+    listing = fn()
+    elapsed = time.perf_counter() - start
+    del listing
+
+    # memory is traced in a separate run, since tracing slows down the parsing
+    tracemalloc.start()
+    listing = fn()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    assert len(listing) == count
+    print('%-10s %10.2f %12.0f %12.1f %10.0f' % (label, elapsed, count / elapsed, retained / 1024 / 1024,
+                                                 retained / count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--page-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    with BlobEmulator() as emulator:
+        container = emulator.containers['bench'] = EmulatedContainer()
+        for i in range(args.count):
+            container.blobs['folder%03d/file%08d.jpg' % (i % 1000, i)] = EmulatedBlob(b'x' * (i % 4096))
+
+        service = emulator.service()
+        query = { 'restype': 'container', 'comp': 'list', 'maxresults': args.page_size }
+        pages = []
+        marker = None
+
+        while True:
+            pages.append(service._request('get', '/bench', params=dict(query, marker=marker)).content)
+            marker = etree.fromstring(pages[-1]).findtext('NextMarker')
+            if not marker:
+                break
+
+    def parse(factory):
+        entries = []
+        for body in pages:
+            entries.extend(ListingPage(RecordedResponse(body), { 'Blob': factory }))
+        return entries
+
+    def columns():
+        listing = BlobColumns()
+        for body in pages:
+            ListingPage(RecordedResponse(body), { 'Blob': listing.append }).exhaust()
+        return listing
+
+    print('%-10s %10s %12s %12s %10s' % ('mode', 'seconds', 'blobs/s', 'MB', 'B/blob'))
+    measure('dicts', args.count, lambda: parse(LegacyBlob.from_element))
+    measure('compact', args.count, lambda: parse(lambda element: Blob.from_element(element, 'bench', service)))
+    measure('columns', args.count, columns)
+
+    # the properties of compact blobs are turned into dicts on demand
+    blob = parse(lambda element: Blob.from_element(element, 'bench', service))[0]
+    assert blob.properties['Content-Length'] == str(blob.size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares the request throughput of a pooled AzureService session against the former behaviour
+of creating a new session (and therefore a new connection) for every request.
+
+The in-process emulator stands in for the storage account, so the numbers only include the
+TCP handshake. Against the real service, where each new connection also pays for a TLS handshake
+and a higher round trip time, the difference is considerably larger.
+
+Usage: python benchmarks/bench_session.py [requests] [threads]
+"""
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from azurepython3.emulator import BlobEmulator
+
+
+def unpooled_head(url):
+    # this is what every request did before the service owned a session
+    session = requests.session()
+    session.mount('http://', HTTPAdapter(max_retries=5))
+    session.mount('https://', HTTPAdapter(max_retries=5))
+    return session.head(url)
+
+
+def run(label, fn, total, threads):
+    per_thread = total // threads
+
+    def worker():
+        for _ in range(per_thread):
+            fn()
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    print('%-24s %8.0f requests/sec' % (label, per_thread * threads / elapsed))
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    emulator = BlobEmulator()
+    emulator.start()
+
+    service = emulator.service(pool_size=threads, warm_up=threads)
+    url = service.get_blob_url('container', 'blob')
+
+    print('%d requests, %d threads' % (total, threads))
+    run('session per request', lambda: unpooled_head(url), total, threads)
+    run('pooled session', lambda: service.session.head(url), total, threads)
+
+    service.close()
+    emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Measures how many requests per second SharedKeyAuthentication can sign, compared with the former
+implementation that decoded the account key and formatted the date for every request. Both
+implementations must produce byte-identical Authorization headers.
+
+Usage: python benchmarks/bench_signing.py [iterations]
+"""
+import base64
+import hashlib
+import hmac
+import sys
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+
+import requests
+
+from azurepython3.auth import SharedKeyAuthentication
+from azurepython3.blobservice import BlobService
+
+
+class LegacySharedKeyAuthentication:
+    """ The signing code as it was before the signing context was precomputed """
+
+    def __init__(self, account_name, account_key):
+        self.account_name = account_name
+        self.account_key = account_key
+
+    def auth_header(self, request, content_length = None):
+        signature = self._signature(request, content_length)
+        return 'SharedKey %s:%s' % (self.account_name, self._sign(signature))
+
+    def _signature(self, request, content_length = None):
+        headers = {str(name).lower(): value for name, value in request.headers.items() if not value is None}
+        if content_length > 0:
+            headers['content-length'] = str(content_length)
+
+        signature = request.method.upper() + '\n'
+        headers_to_sign = ['content-encoding', 'content-language', 'content-length',
+                           'content-md5', 'content-type', 'date', 'if-modified-since',
+                           'if-match', 'if-none-match', 'if-unmodified-since', 'range']
+        signature += "\n".join(headers.get(h, '') for h in headers_to_sign) + "\n"
+        signature += ''.join("%s:%s\n" % (k, v) for k, v in sorted(headers.items()) if v and 'x-ms' in k)
+        signature += '/' + self.account_name + urlparse(request.url).path
+        signature += ''.join("\n%s:%s" % (k, v) for k, v in sorted(request.params.items()) if v)
+        return signature
+
+    def _sign(self, string):
+        decode_account_key = base64.b64decode(self.account_key)
+        signed_hmac_sha256 = hmac.HMAC(decode_account_key, string.encode('utf-8'), hashlib.sha256)
+        digest = signed_hmac_sha256.digest()
+        return base64.b64encode(digest).decode('utf-8')
+
+
+def legacy_headers():
+    return {
+        'x-ms-version': '2011-08-18',
+        'x-ms-date': datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT'),
+        'Content-Type': 'application/octet-stream Charset=UTF-8'
+    }
+
+
+def sample_requests(service):
+    headers = service._headers()
+    yield requests.Request('GET', service.get_url('/container/folder/file.jpg'), headers=dict(headers),
+                           params={'timeout': None}), 0
+    yield requests.Request('PUT', service.get_url('/container/file with spaces.txt'),
+                           headers=dict(headers, **{'x-ms-blob-type': 'BlockBlob', 'Content-Type': 'text/plain'}),
+                           params={'timeout': 30}), 1024
+    yield requests.Request('GET', service.get_url('/container'), headers=dict(headers),
+                           params={'restype': 'container', 'comp': 'list', 'prefix': 'images/', 'marker': None}), 0
+    yield requests.Request('DELETE', service.get_url('/container/old.bin'),
+                           headers=dict(headers, **{'Content-Length': '0'}), params={}), 0
+
+
+def measure(label, fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+    print('%-32s %10.0f /sec' % (label, iterations / elapsed))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    account_key = base64.b64encode(b'benchmark account key of 64 bytes, like a real one.............').decode()
+    service = BlobService('benchmark', account_key)
+
+    legacy = LegacySharedKeyAuthentication('benchmark', account_key)
+    current = SharedKeyAuthentication('benchmark', account_key)
+    samples = list(sample_requests(service))
+
+    for request, content_length in samples:
+        assert legacy.auth_header(request, content_length) == current.auth_header(request, content_length)
+    print('signatures are identical for %d sample requests' % len(samples))
+
+    request, content_length = samples[1]
+    measure('legacy signatures', lambda: legacy.auth_header(request, content_length), iterations)
+    measure('current signatures', lambda: current.auth_header(request, content_length), iterations)
+    measure('legacy request headers', legacy_headers, iterations)
+    measure('current request headers', service._headers, iterations)
+
+
+if __name__ == '__main__':
+    main()